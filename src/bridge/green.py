@@ -0,0 +1,56 @@
+"""
+Cooperative server for the bridge project, built on gevent.
+
+Every client connection is served by a greenlet instead of an OS thread, and
+sockets, locks, sleeps and threads are patched to yield to the event loop while
+they wait. A slow client or a slow S3 request then costs a few kilobytes of
+greenlet stack rather than a worker thread, so one process can hold thousands
+of mounted clients. The DAV handlers, boto and the streaming bodies run
+unchanged; the worker threads of uploads, copies and downloads become greenlets
+as well.
+
+Run it with
+
+    python -m bridge.green [host:]port
+
+or under gunicorn with ``gunicorn -k gevent bridge.green:application``.
+
+Database connections are opened per greenlet, so use a database server that
+copes with as many connections as there are concurrent PROPFIND and PROPPATCH
+requests.
+"""
+from gevent import monkey
+# Before anything imports socket, threading or time.
+if not monkey.is_module_patched('socket'):
+    monkey.patch_all()
+
+import os
+import sys
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "bridge.settings")
+
+from django.conf import settings
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+from bridge.wsgi import application
+from s3dav import server
+
+# Client connections served at once; further ones wait to be accepted.
+GREEN_MAX_CLIENTS = getattr(settings, 'GREEN_MAX_CLIENTS', 10000)
+
+# boto connections may be shared by greenlets: they only switch while waiting
+# on a socket, and boto takes a free HTTP connection from its own pool for each
+# request. Pooling per greenlet would open a connection for every request.
+server.connection_pool.ident = monkey.get_original('thread', 'get_ident')
+
+def make_server(address, **kwargs):
+    return WSGIServer(address, application, spawn=Pool(GREEN_MAX_CLIENTS), **kwargs)
+
+def main(argv):
+    address = argv[1] if len(argv) > 1 else '8000'
+    host, _, port = address.rpartition(':')
+    make_server((host or '0.0.0.0', int(port))).serve_forever()
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -145,7 +145,10 @@ LOGGING = {
             'level': 'ERROR',
             'filters': ['require_debug_false'],
             'class': 'django.utils.log.AdminEmailHandler'
-        }
+        },
+        'null': {
+            'class': 'django.utils.log.NullHandler',
+        },
     },
     'loggers': {
         'django.request': {
@@ -153,6 +156,19 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        # One JSON record per WebDAV request: S3 calls, bytes, cache use and
+        # timings. Point it at a real handler to collect them.
+        's3dav.requests': {
+            'handlers': ['null'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        # Uploads acknowledged in write-back mode that S3 refused for good.
+        's3dav.writeback': {
+            'handlers': ['mail_admins'],
+            'level': 'ERROR',
+            'propagate': True,
+        },
     }
 }
 
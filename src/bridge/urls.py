@@ -15,6 +15,7 @@ urlpatterns = patterns('',
         {'document_root': 'static'}),
     # Uncomment the next line to enable the admin:
     url(r'^admin/', include(admin.site.urls)),
+    url(r'^metrics$', 's3dav.views.export_metrics'),
     url(r'^(?P<bucket>[^/]+)/(?P<key>.*)$', 's3dav.views.export'),
     url(r'^(?P<bucket>[^/]+)$', 's3dav.views.notfound'),
     url(r'^$', 's3dav.views.export', {'bucket': '', 'key': ''}),
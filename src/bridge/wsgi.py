@@ -30,3 +30,7 @@ application = get_wsgi_application()
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)
+
+# Let the server send local files with wsgi.file_wrapper, e.g. by sendfile().
+from s3dav.django_webdav import serve_files
+application = serve_files(application)
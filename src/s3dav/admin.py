@@ -1,5 +1,5 @@
 from django.contrib import admin
-from s3dav.models import S3Account
+from s3dav.models import DeadProperty, S3Account
 
-for cls in [S3Account]:
+for cls in [S3Account, DeadProperty]:
     admin.site.register(cls)
@@ -0,0 +1,45 @@
+import threading
+import Queue
+
+def run_concurrently(func, items, concurrency):
+    '''Call func(item) for every item from up to concurrency threads. items is
+    consumed lazily as workers free up, so it can be a listing that is still
+    being paged through. Returns (item, exception) pairs for the calls that
+    raised; a failure does not stop the other items.'''
+    queue = Queue.Queue(concurrency * 2)
+    failures = []
+
+    def worker():
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            try:
+                func(item)
+            except Exception, e:
+                failures.append((item, e))
+
+    workers = [threading.Thread(target=worker) for i in range(concurrency)]
+    for t in workers:
+        t.daemon = True
+        t.start()
+    try:
+        for item in items:
+            queue.put(item)
+    finally:
+        for t in workers:
+            queue.put(None)
+        for t in workers:
+            t.join()
+    return failures
+
+def chunked(items, size):
+    '''Yield lists of up to size consecutive items.'''
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
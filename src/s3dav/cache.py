@@ -0,0 +1,186 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from s3dav import metrics
+
+S3_METADATA_CACHE_TTL = getattr(settings, 'S3_METADATA_CACHE_TTL', 30)
+S3_METADATA_CACHE_SIZE = getattr(settings, 'S3_METADATA_CACHE_SIZE', 10000)
+# How long a name that turned out not to exist is answered as missing without
+# asking S3 again. Writes through this server invalidate it at once.
+S3_NEGATIVE_CACHE_TTL = getattr(settings, 'S3_NEGATIVE_CACHE_TTL', 10)
+# Names operating systems probe for, or leave behind, in every folder they
+# open: Finder metadata, AppleDouble files and Explorer thumbnails. Once S3 has
+# said one does not exist, that is remembered for S3_JUNK_TTL seconds rather
+# than S3_NEGATIVE_CACHE_TTL, as clients probe for them over and over.
+S3_JUNK_NAMES = getattr(settings, 'S3_JUNK_NAMES', (
+    r'\._.+',
+    r'\.DS_Store',
+    r'\.hidden',
+    r'\.localized',
+    r'\.Spotlight-V100',
+    r'\.Trashes',
+    r'\.fseventsd',
+    r'\.metadata_never_index',
+    r'\.ql_.+',
+    r'desktop\.ini',
+    r'Thumbs\.db',
+    r'autorun\.inf',
+))
+S3_JUNK_TTL = getattr(settings, 'S3_JUNK_TTL', 300)
+JUNK_NAME = re.compile(r'(?:%s)$' % '|'.join(S3_JUNK_NAMES), re.IGNORECASE)
+S3_AUTH_CACHE_TTL = getattr(settings, 'S3_AUTH_CACHE_TTL', 60)
+S3_AUTH_CACHE_SIZE = getattr(settings, 'S3_AUTH_CACHE_SIZE', 1000)
+
+class TTLCache(object):
+    '''A thread-safe mapping whose entries expire ttl seconds after they were set
+    and which drops the least recently used entries once it holds more than size.'''
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires < time.time():
+                return default
+            # Re-inserting moves the entry to the most recently used end.
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + ttl, value)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_matching(self, predicate):
+        '''Delete every entry whose key satisfies predicate.'''
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def is_junk(key):
+    '''Return True if the last segment of key is a well-known junk name.'''
+    return bool(JUNK_NAME.match(key.rstrip('/').rsplit('/', 1)[-1]))
+
+class MetadataCache(object):
+    '''Remembers which buckets exist and the attributes of keys (size, etag,
+    last_modified and whether they are directories) so repeated lookups of the
+    same resource do not go back to S3. Listings fill it in, writes evict.'''
+    def __init__(self, ttl, size, missing_ttl=S3_NEGATIVE_CACHE_TTL, junk_ttl=S3_JUNK_TTL):
+        self.buckets = TTLCache(ttl, size)
+        self.keys = TTLCache(ttl, size)
+        self.missing = TTLCache(missing_ttl, size)
+        self.junk_ttl = junk_ttl
+
+    def clear(self):
+        self.buckets.clear()
+        self.keys.clear()
+        self.missing.clear()
+
+    def lookup_bucket(self, s3, account, bucket_name):
+        '''Return the bucket, validating its existence against S3 only when the
+        account has not seen it recently.'''
+        if self.buckets.get((account, bucket_name)):
+            metrics.record_cache('metadata', True)
+            return s3.get_bucket(bucket_name, validate=False)
+        metrics.record_cache('metadata', False)
+        bucket = s3.get_bucket(bucket_name)
+        self.add_bucket(account, bucket_name)
+        return bucket
+
+    def add_bucket(self, account, bucket_name):
+        self.buckets.set((account, bucket_name), True)
+
+    def lookup_key(self, bucket, key_name):
+        '''Return the key for key_name, or None if it does not exist. A HEAD
+        request is issued only on a cache miss.'''
+        info = self.keys.get((bucket.name, key_name))
+        metrics.record_cache('metadata', info is not None)
+        if info is not None:
+            key = bucket.new_key(key_name)
+            key.size, key.etag, key.last_modified = info
+            return key
+        key = bucket.get_key(key_name)
+        if key is not None:
+            self.add_key(key)
+        return key
+
+    def lookup_prefix(self, bucket, prefix):
+        '''Return a key standing for the directory prefix if anything is stored
+        below it, with or without a marker object, or None. A miss costs one
+        single-entry listing instead of a HEAD that cannot see bare prefixes.'''
+        cached = self.keys.get((bucket.name, prefix)) is not None
+        metrics.record_cache('metadata', cached)
+        if not cached:
+            if not len(bucket.get_all_keys(prefix=prefix, delimiter='/', max_keys=1)):
+                return None
+            self.add_prefix(bucket.name, prefix)
+        return bucket.new_key(prefix)
+
+    def is_missing(self, bucket_name, key_name):
+        '''Return True if key_name was found not to exist a moment ago.'''
+        missing = self.missing.get((bucket_name, key_name)) is not None
+        metrics.record_cache('negative', missing)
+        return missing
+
+    def add_missing(self, bucket_name, key_name):
+        ttl = is_junk(key_name) and self.junk_ttl or self.missing.ttl
+        if ttl > 0:
+            self.missing.set((bucket_name, key_name), True, ttl)
+
+    def _exists(self, bucket_name, key_name):
+        '''key_name may exist now, and so may the directories above it, with or
+        without a trailing slash.'''
+        parts = key_name.rstrip('/').split('/')
+        for i in range(1, len(parts) + 1):
+            name = '/'.join(parts[:i])
+            self.missing.delete((bucket_name, name))
+            self.missing.delete((bucket_name, name + '/'))
+
+    def add_key(self, key):
+        self.keys.set((key.bucket.name, key.name), (key.size, key.etag, key.last_modified))
+        self._exists(key.bucket.name, key.name)
+
+    def add_prefix(self, bucket_name, prefix):
+        '''Record a common prefix from a listing as an existing directory.'''
+        self.keys.set((bucket_name, prefix), (0, None, None))
+        self._exists(bucket_name, prefix)
+
+    def forget(self, bucket_name, key_name):
+        self.keys.delete((bucket_name, key_name))
+        self._exists(bucket_name, key_name)
+
+    def forget_prefix(self, bucket_name, prefix):
+        '''Forget key_name and everything below it.'''
+        match = lambda k: k[0] == bucket_name and k[1].startswith(prefix)
+        self.keys.delete_matching(match)
+        self.missing.delete_matching(match)
+        self._exists(bucket_name, prefix)
+
+metadata = MetadataCache(S3_METADATA_CACHE_TTL, S3_METADATA_CACHE_SIZE)
+
+# Keyed digest of an Authorization header -> (aws_key, aws_secret) it resolved to.
+credentials = TTLCache(S3_AUTH_CACHE_TTL, S3_AUTH_CACHE_SIZE)
@@ -16,13 +16,19 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with django-webdav.  If not, see <http://www.gnu.org/licenses/>.
 import sys
-import os, datetime, mimetypes, time, shutil, urllib, urlparse, httplib, re, calendar
+import threading
+import os, datetime, mimetypes, time, shutil, urllib, urlparse, httplib, re, calendar, uuid
+import itertools
+import zlib
 from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+from contextlib import contextmanager
 from django.conf import settings
+from django.core.cache import get_cache
 from django.http import HttpResponse, HttpResponseForbidden, HttpResponseNotFound, \
-HttpResponseNotAllowed, HttpResponseBadRequest, HttpResponseNotModified
+HttpResponseNotAllowed, HttpResponseBadRequest, HttpResponseNotModified, StreamingHttpResponse
 from django.http import Http404 as HttpNotFound
-from django.utils import hashcompat, synch
+from django.utils import hashcompat
 from django.utils.http import http_date, parse_etags
 from django.utils.encoding import smart_unicode
 from django.shortcuts import render_to_response
@@ -31,8 +37,43 @@ try:
 except ImportError:
     from email.Utils import parsedate_tz
 
+# Serialize DAV: elements with the conventional D: prefix rather than ns0:.
+ElementTree.register_namespace('D', 'DAV:')
+
 PATTERN_IF_DELIMITER = re.compile(r'(\<([^>]+)\>)|(\(([^\)]+)\))')
 
+PATTERN_IF_CONDITION = re.compile(r'(Not\s+)?(?:<([^>]*)>|\[([^\]]*)\])', re.I)
+
+# Lock timeouts in seconds: used when a client does not ask for one, and the
+# most a client is granted. DAV_LOCK_CACHE names a Django cache to keep locks
+# in so that several worker processes share them; by default they are kept
+# in the memory of each process.
+DAV_LOCK_DEFAULT_TIMEOUT = getattr(settings, 'DAV_LOCK_DEFAULT_TIMEOUT', 600)
+DAV_LOCK_MAX_TIMEOUT = getattr(settings, 'DAV_LOCK_MAX_TIMEOUT', 3600)
+DAV_LOCK_CACHE = getattr(settings, 'DAV_LOCK_CACHE', None)
+
+# How many resources of a PROPFIND listing get their dead properties loaded at once.
+DAV_PROPERTY_BATCH_SIZE = getattr(settings, 'DAV_PROPERTY_BATCH_SIZE', 500)
+
+# Render PROPFIND responses from pre-rendered markup where possible, rather than
+# building and serializing an ElementTree for every resource.
+DAV_MULTISTATUS_TEMPLATES = getattr(settings, 'DAV_MULTISTATUS_TEMPLATES', True)
+
+# The most byte ranges a GET is answered with, after merging those that overlap
+# or touch; each may cost a request to the backend. Beyond this the Range header
+# is ignored and the whole entity sent.
+DAV_MAX_RANGES = getattr(settings, 'DAV_MAX_RANGES', 16)
+
+# Reason phrases httplib does not know about.
+DAV_REASONS = {
+    httplib.MULTI_STATUS: 'Multi-Status',
+    httplib.LOCKED: 'Locked',
+    httplib.FAILED_DEPENDENCY: 'Failed Dependency',
+}
+
+# Size of the chunks file bodies are streamed in.
+BLOCK_SIZE = 64 * 1024
+
 # Sun, 06 Nov 1994 08:49:37 GMT  ; RFC 822, updated by RFC 1123
 FORMAT_RFC_822 = '%a, %d %b %Y %H:%M:%S GMT'
 # Sunday, 06-Nov-94 08:49:37 GMT ; RFC 850, obsoleted by RFC 1036
@@ -53,6 +94,11 @@ def safe_join(root, *paths):
         root += '/' + path
     return root
 
+def covers(path, paths):
+    '''Return True if one of paths is path or lies below it.'''
+    below = path and path + '/'
+    return any(p == path or p.startswith(below) for p in paths)
+
 def url_join(base, *paths):
     '''Assuming base is the scheme and host (and perhaps path) we will join the remaining
     path elements to it.'''
@@ -99,6 +145,89 @@ def parse_time(time):
         return
     return calendar.timegm(result)
 
+def parse_range(header, size):
+    '''Parse a Range header into a list of inclusive (start, end) byte offsets within
+    an entity of the given size. Returns None if the header is malformed, in which case
+    it must be ignored, and an empty list if none of the ranges can be satisfied.'''
+    units, sep, spec = header.partition('=')
+    if units.strip().lower() != 'bytes' or not sep:
+        return None
+    ranges = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition('-')
+        first, last = first.strip(), last.strip()
+        if not sep or not (first or last) or not (first + last).isdigit():
+            return None
+        if first:
+            start = int(first)
+            if not last:
+                end = size - 1
+            elif int(last) < start:
+                return None
+            else:
+                end = int(last)
+        else:
+            # A suffix range: the last N bytes.
+            start, end = max(size - int(last), 0), size - 1
+            if int(last) == 0:
+                continue
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+    return ranges
+
+def merge_ranges(ranges):
+    '''Merge the (start, end) ranges that overlap or are adjacent, in order of offset.'''
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def iter_blocks(f, size=BLOCK_SIZE):
+    '''Yield the rest of file f in blocks of size bytes, then close it.'''
+    try:
+        while True:
+            data = f.read(size)
+            if not data:
+                break
+            yield data
+    finally:
+        f.close()
+
+def status_line(status):
+    '''Return the status line for a multistatus response.'''
+    reason = httplib.responses.get(status) or DAV_REASONS.get(status, '')
+    return 'HTTP/1.1 %d %s' % (status, reason)
+
+def parse_timeout(header):
+    '''Return the lock timeout in seconds asked for by a Timeout header, capped at
+    DAV_LOCK_MAX_TIMEOUT. The first option the server understands wins.'''
+    for option in (header or '').split(','):
+        option = option.strip().lower()
+        if option == 'infinite':
+            return DAV_LOCK_MAX_TIMEOUT
+        if option.startswith('second-') and option[7:].isdigit():
+            return min(int(option[7:]), DAV_LOCK_MAX_TIMEOUT)
+    return DAV_LOCK_DEFAULT_TIMEOUT
+
+def parse_if(header):
+    '''Parse an If header into a list of (url, conditions) pairs, one per list. url
+    is None for untagged lists, conditions a list of (negate, token, etag).'''
+    lists, url = [], None
+    for tagged, tag, listed, content in PATTERN_IF_DELIMITER.findall(header):
+        if tagged:
+            url = tag
+            continue
+        conditions = [(bool(negate), token or None, etag if not token else None)
+                      for negate, token, etag in PATTERN_IF_CONDITION.findall(content)]
+        lists.append((url, conditions))
+    return lists
+
 
 # When possible, code returns an HTTPResponse sub-class. In some situations, we want to be able
 # to raise an exception to control the response (error conditions within utility functions). In
@@ -140,6 +269,66 @@ class HttpResponseMultiStatus(HttpResponse):
     status_code = httplib.MULTI_STATUS
 
 
+class StreamingHttpResponseMultiStatus(StreamingHttpResponse):
+    status_code = httplib.MULTI_STATUS
+
+
+class StreamingHttpResponsePartialContent(StreamingHttpResponse):
+    status_code = httplib.PARTIAL_CONTENT
+
+
+class StreamedFile(object):
+    '''The file a FileHttpResponse streams, as handed to wsgi.file_wrapper. Closing
+    it closes the response, which the WSGI server no longer sees.'''
+    def __init__(self, f, close):
+        self.f = f
+        self.close = close
+
+    def read(self, size=-1):
+        return self.f.read(size)
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def tell(self):
+        return self.f.tell()
+
+
+class FileHttpResponse(StreamingHttpResponse):
+    '''Streams an open file in BLOCK_SIZE blocks. Behind serve_files, servers that
+    provide wsgi.file_wrapper get the file itself and may send it with sendfile(),
+    without the content passing through Python.'''
+    block_size = BLOCK_SIZE
+
+    def __init__(self, f, *args, **kwargs):
+        super(FileHttpResponse, self).__init__(iter_blocks(f, self.block_size), *args, **kwargs)
+        self._close_file = f.close
+        self.file_to_stream = StreamedFile(f, self.close)
+
+    def close(self):
+        try:
+            self._close_file()
+        finally:
+            super(FileHttpResponse, self).close()
+
+
+def serve_files(application):
+    '''WSGI middleware passing the file of a FileHttpResponse to the server's
+    wsgi.file_wrapper. Django returns the response object itself, which the
+    server cannot tell apart from any other iterable.'''
+    def wrapper(environ, start_response):
+        response = application(environ, start_response)
+        filelike = getattr(response, 'file_to_stream', None)
+        if filelike is not None and environ.get('wsgi.file_wrapper'):
+            return environ['wsgi.file_wrapper'](filelike, response.block_size)
+        return response
+    return wrapper
+
+
+class HttpResponseRequestedRangeNotSatisfiable(HttpResponse):
+    status_code = httplib.REQUESTED_RANGE_NOT_SATISFIABLE
+
+
 class HttpNotAllowed(HttpError):
     status_code = httplib.METHOD_NOT_ALLOWED
 
@@ -164,6 +353,18 @@ class HttpResponsePreconditionFailed(HttpResponse):
     status_code = httplib.PRECONDITION_FAILED
 
 
+class HttpForbidden(HttpError):
+    status_code = httplib.FORBIDDEN
+
+
+class HttpLocked(HttpError):
+    status_code = httplib.LOCKED
+
+
+class HttpResponseLocked(HttpResponse):
+    status_code = httplib.LOCKED
+
+
 class HttpMediatypeNotSupported(HttpError):
     status_code = httplib.UNSUPPORTED_MEDIA_TYPE
 
@@ -182,6 +383,10 @@ class HttpBadGateway(HttpError):
 class HttpResponseBadGateway(HttpResponse):
     status_code = httplib.BAD_GATEWAY
 
+
+class HttpServiceUnavailable(HttpError):
+    status_code = httplib.SERVICE_UNAVAILABLE
+
 class HttpBadRequest(HttpError):
     status_code = httplib.BAD_REQUEST
 
@@ -298,8 +503,38 @@ class DavResource(object):
         '''Open the resource, mode is the same as the Python file() object.'''
         return open(self.get_abs_path(), mode)
 
+    def iter_content(self):
+        '''Return an iterable over the content of the resource, used as the body of
+        GET responses.'''
+        return iter_blocks(self.open('rb'))
+
+    def get_local_path(self):
+        '''Return the path of a complete copy of the content on the local disk, or
+        None if there is none.'''
+        return self.get_abs_path()
+
+    def get_sendfile_path(self):
+        '''Return the path a front proxy may send in place of the content, or None.'''
+        return self.get_local_path()
+
+    def read_range(self, start, end):
+        '''Return an iterator over the bytes from offset start to end inclusive.'''
+        f = self.open('rb')
+        try:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = f.read(min(BLOCK_SIZE, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+        finally:
+            f.close()
+
     def delete(self):
-        '''Delete the resource, recursive is implied.'''
+        '''Delete the resource, recursive is implied. May return (url, status) pairs
+        for members of a collection that could not be deleted.'''
         if self.isdir():
             for child in self.get_children():
                 child.delete()
@@ -316,6 +551,11 @@ class DavResource(object):
                 import traceback
                 traceback.print_exc()
 
+    def create_empty(self):
+        '''Create an empty file in the location of this resource.'''
+        with self.open('w'):
+            pass
+
     def mkdir(self):
         '''Create a directory in the location of this resource.'''
         os.mkdir(self.get_abs_path())
@@ -397,164 +637,508 @@ class DavProperty(object):
         '{DAV:}getetag', '{DAV:}getcontentlength', '{DAV:}creationdate',
         '{DAV:}getlastmodified', '{DAV:}resourcetype', '{DAV:}displayname'
     ]
+    # Only reported when asked for by name, as looking them up costs extra.
+    LOCK_PROPERTIES = ['{DAV:}lockdiscovery', '{DAV:}supportedlock']
+    # Live property name -> name of the method computing its value.
+    LIVE_GETTERS = dict([(name, 'get_' + ns_split(name)[1])
+                         for name in LIVE_PROPERTIES + LOCK_PROPERTIES + ['{DAV:}href']])
 
     def __init__(self, server):
+        # One instance serves a single request, so nothing here is shared
+        # between threads.
         self.server = server
-        self.lock = synch.RWLock()
 
     def get_dead_names(self, res):
         return []
 
     def get_dead_value(self, res, name):
-        '''Implements "dead" property retrival. Thread synchronization is handled outside this method.'''
+        '''Implements "dead" property retrival.'''
         return
 
     def set_dead_value(self, res, name, value):
-        '''Implements "dead" property storage. Thread synchronization is handled outside this method.'''
+        '''Implements "dead" property storage.'''
         return
 
     def del_dead_prop(self, res, name):
-        '''Implements "dead" property removal. Thread synchronizatioin is handled outside this method.'''
+        '''Implements "dead" property removal.'''
+        return
+
+    def prefetch(self, resources):
+        '''Called with each batch of resources of a listing before their properties are
+        read, so that a backend can load the dead properties of all of them at once.'''
         return
 
     def get_prop_names(self, res, *names):
         return self.LIVE_PROPERTIES + self.get_dead_names(res)
 
-    def get_prop_value(self, res, name):
-        self.lock.reader_enters()
-        try:
-            ns, bare_name = ns_split(name)
+    def get_getetag(self, res):
+        return res.get_etag()
+
+    def get_getcontentlength(self, res):
+        return str(res.get_size())
+
+    def get_creationdate(self, res):
+        return rfc3339_date(res.get_ctime_stamp())     # RFC3339:
 
-            if ns != 'DAV':
-                return self.get_dead_value(res, name)
+    def get_getlastmodified(self, res):
+        return http_date(res.get_mtime_stamp())
+
+    def get_resourcetype(self, res):
+        if res.isdir():
+            return []
+        return ''
+
+    def get_displayname(self, res):
+        return res.get_name()
+
+    def get_href(self, res):
+        return res.get_url()
+
+    def get_lockdiscovery(self, res):
+        value = ElementTree.Element('{DAV:}lockdiscovery')
+        for lock in self.server.locks.get(res):
+            value.append(self.server.locks.get_activelock(lock))
+        return value
+
+    def get_supportedlock(self, res):
+        value = ElementTree.Element('{DAV:}supportedlock')
+        for scope in ('exclusive', 'shared'):
+            entry = ElementTree.SubElement(value, '{DAV:}lockentry')
+            ElementTree.SubElement(ElementTree.SubElement(entry, '{DAV:}lockscope'), '{DAV:}' + scope)
+            ElementTree.SubElement(ElementTree.SubElement(entry, '{DAV:}locktype'), '{DAV:}write')
+        return value
+
+    def get_prop_value(self, res, name):
+        getter = self.LIVE_GETTERS.get(name)
+        if getter is not None:
+            return getattr(self, getter)(res)
+        if not name.startswith('{DAV:}'):
+            return self.get_dead_value(res, name)
+
+    def get_prop_values(self, res, names):
+        '''Resolve the given properties of res in one pass. Returns the (name, value)
+        pairs of the properties res has, and the names of those it does not.'''
+        found, missing = [], []
+        getters = self.LIVE_GETTERS
+        for name in names:
+            getter = getters.get(name)
+            if getter is not None:
+                found.append((name, getattr(self, getter)(res)))
+                continue
+            value = None
+            if not name.startswith('{DAV:}'):
+                value = self.get_dead_value(res, name)
+            if value is None:
+                missing.append(name)
             else:
-                value = None
-                if bare_name == 'getetag':
-                    value = res.get_etag()
-                elif bare_name == 'getcontentlength':
-                    value = str(res.get_size())
-                elif bare_name == 'creationdate':
-                    value = rfc3339_date(res.get_ctime_stamp())     # RFC3339:
-                elif bare_name == 'getlastmodified':
-                    t = res.get_mtime_stamp()
-                    value = http_date(t)
-                elif bare_name == 'resourcetype':
-                    if res.isdir():
-                        value = []
-                    else:
-                        value = ''
-                elif bare_name == 'displayname':
-                    value = res.get_name()
-                elif bare_name == 'href':
-                    value = res.get_url()
-            return value
-        finally:
-            self.lock.reader_leaves()
+                found.append((name, value))
+        return found, missing
 
     def set_prop_value(self, res, name, value):
-        self.lock.writer_enters()
-        try:
+        ns, bare_name = ns_split(name)
+        if ns == 'DAV':
+            pass # TODO: handle set-able "live" properties?
+        else:
+            self.set_dead_value(res, name, value)
+
+    def del_props(self, res, *names, **kwargs):
+        '''Without names, drop all properties of res, unless it is or holds one of
+        the paths in keep, members an operation failed on.'''
+        if covers(res.get_path().strip('/'), kwargs.get('keep', ())):
+            return
+        avail_names = self.get_prop_names(res)
+        if not names:
+            names = avail_names
+        for name in names:
             ns, bare_name = ns_split(name)
             if ns == 'DAV':
-                pass # TODO: handle set-able "live" properties?
+                pass # TODO: handle delete-able "live" properties?
             else:
-                self.set_dead_value(res, name, value)
-        finally:
-            self.lock.writer_leaves()
-
-    def del_props(self, res, *names):
-        self.lock.writer_enters()
-        try:
-            avail_names = self.get_prop_names(res)
-            if not names:
-                names = avail_names
-            for name in names:
-                ns, bare_name = ns_split(name)
-                if ns == 'DAV':
-                    pass # TODO: handle delete-able "live" properties?
-                else:
-                    self.del_dead_prop(res, name)
-        finally:
-            self.lock.writer_leaves()
+                self.del_dead_prop(res, name)
 
     def copy_props(self, src, dst, *names, **kwargs):
+        '''Copy, or with move=True move, the properties of src to dst. Paths in
+        failed, relative to the root, were not copied or moved; their properties
+        stay where they are.'''
         move = kwargs.get('move', False)
-        self.lock.writer_enters()
-        try:
-            names = self.get_prop_names(src)
-            for name in names:
-                ns, bare_name = ns_split(name)
-                if ns == 'DAV':
-                    continue
-                self.set_dead_value(dst, name, self.get_prop_value(src, name))
-                if move:
-                    self.del_dead_prop(self, name)
-        finally:
-            self.lock.writer_leaves()
+        failed = kwargs.get('failed', ())
+        path = src.get_path().strip('/')
+        if path in failed:
+            return
+        move = move and not covers(path, failed)
+        names = self.get_prop_names(src)
+        for name in names:
+            ns, bare_name = ns_split(name)
+            if ns == 'DAV':
+                continue
+            self.set_dead_value(dst, name, self.get_prop_value(src, name))
+            if move:
+                self.del_dead_prop(src, name)
+
+    def patch_props(self, res, updates):
+        '''Apply the (name, value) pairs in updates in order, a value of None removes
+        the property. Values are serialized property elements.'''
+        for name, value in updates:
+            if value is None:
+                self.del_props(res, name)
+            else:
+                self.set_prop_value(res, name, value)
 
     def get_propstat(self, res, el, *names):
-        '''Returns the XML representation of a resource's properties. Thread synchronization is handled
-        in the get_prop_value() method individually for each property.'''
-        el404, el200 = None, None
-        avail_names = self.get_prop_names(res)
+        '''Returns the XML representation of a resource's properties. All the
+        requested properties are resolved in one pass, without names all the
+        properties of the resource are.'''
         if not names:
-            names = avail_names
+            names = self.get_prop_names(res)
+        found, missing = self.get_prop_values(res, names)
+        if found:
+            propstat = ElementTree.SubElement(el, '{DAV:}propstat')
+            prop = ElementTree.SubElement(propstat, '{DAV:}prop')
+            for name, value in found:
+                if ElementTree.iselement(value):
+                    prop.append(value)
+                    continue
+                item = ElementTree.SubElement(prop, name)
+                if isinstance(value, list):
+                    item.append(ElementTree.Element("{DAV:}collection"))
+                elif value:
+                    item.text = smart_unicode(value)
+            ElementTree.SubElement(propstat, '{DAV:}status').text = 'HTTP/1.1 200 OK'
+        if missing:
+            propstat = ElementTree.SubElement(el, '{DAV:}propstat')
+            prop = ElementTree.SubElement(propstat, '{DAV:}prop')
+            for name in missing:
+                ElementTree.SubElement(prop, name)
+            ElementTree.SubElement(propstat, '{DAV:}status').text = 'HTTP/1.1 404 Not Found'
+
+    def get_response(self, res, *names):
+        '''Returns the DAV:response element for res.'''
+        response = ElementTree.Element('{DAV:}response')
+        ElementTree.SubElement(response, '{DAV:}href').text = res.get_url()
+        self.get_propstat(res, response, *names)
+        return response
+
+    def get_responses(self, resources, *names):
+        '''Yield a DAV:response element for each of a batch of resources, with the
+        dead properties of the whole batch loaded up front.'''
+        self.prefetch(resources)
+        for res in resources:
+            yield self.get_response(res, *names)
+
+    # Compiled render plans by tuple of property names, shared by all requests.
+    _render_plans = {}
+
+    def get_render_plan(self, names):
+        '''Compile the markup for rendering the given properties. Returns None when
+        a property needs the ElementTree path: dead and lock properties.
+
+        A plan is a list of (getter, markup) pairs for the live properties, where
+        markup holds the open and close tags, the empty element and the collection
+        resourcetype, and the pre-rendered 404 propstat of the DAV: names that
+        are not supported.'''
+        plan = self._render_plans.get(names)
+        if plan is not None:
+            return plan
+        found, missing = [], []
         for name in names:
-            if name in avail_names:
-                value = self.get_prop_value(res, name)
-                if el200 is None:
-                    el200 = ElementTree.SubElement(el, '{DAV:}propstat')
-                    ElementTree.SubElement(el200, '{DAV:}status').text = 'HTTP/1.1 200 OK'
-                prop = ElementTree.SubElement(el200, '{DAV:}prop')
-                prop = ElementTree.SubElement(prop, name)
+            ns, bare_name = ns_split(name)
+            if ns != 'DAV' or name in self.LOCK_PROPERTIES or name == '{DAV:}href':
+                # Not cached, the same names may render fine for other resources
+                # once their dead properties are known.
+                return None
+            if name in self.LIVE_GETTERS:
+                found.append((self.LIVE_GETTERS[name], (
+                    u'<D:%s>' % bare_name, u'</D:%s>' % bare_name, u'<D:%s/>' % bare_name,
+                    u'<D:%s><D:collection/></D:%s>' % (bare_name, bare_name))))
+            else:
+                missing.append(u'<D:%s/>' % bare_name)
+        missing_block = u''
+        if missing:
+            missing_block = (u'<D:propstat><D:prop>%s</D:prop>'
+                             u'<D:status>HTTP/1.1 404 Not Found</D:status></D:propstat>' % u''.join(missing))
+        plan = (found, missing_block)
+        # Clients ask for a handful of distinct sets, keep odd ones from piling up.
+        if len(self._render_plans) < 1000:
+            self._render_plans[names] = plan
+        return plan
+
+    def render_response(self, res, plan):
+        '''Render the DAV:response of res with a compiled plan. Only the dynamic
+        values get escaped.'''
+        found, missing_block = plan
+        out = [u'<D:response><D:href>', escape(smart_unicode(res.get_url())), u'</D:href>']
+        if found:
+            out.append(u'<D:propstat><D:prop>')
+            for getter, (open_tag, close_tag, empty, collection) in found:
+                value = getattr(self, getter)(res)
                 if isinstance(value, list):
-                    prop.append(ElementTree.Element("{DAV:}collection"))
+                    out.append(collection)
                 elif value:
-                    prop.text = smart_unicode(value)
+                    out.extend((open_tag, escape(smart_unicode(value)), close_tag))
+                else:
+                    out.append(empty)
+            out.append(u'</D:prop><D:status>HTTP/1.1 200 OK</D:status></D:propstat>')
+        out.append(missing_block)
+        out.append(u'</D:response>')
+        return u''.join(out).encode('utf-8')
+
+    def render_responses(self, resources, *names):
+        '''Yield the serialized DAV:response of each of a batch of resources, from
+        compiled templates when the properties allow it. Produces the same
+        document as serializing get_responses().'''
+        self.prefetch(resources)
+        for res in resources:
+            res_names = names or tuple(self.get_prop_names(res))
+            plan = self.get_render_plan(res_names)
+            if plan is None:
+                yield ElementTree.tostring(self.get_response(res, *res_names), 'utf-8')
             else:
-                if el404 is None:
-                    el404 = ElementTree.SubElement(el, '{DAV:}propstat')
-                    ElementTree.SubElement(el404, '{DAV:}status').text = 'HTTP/1.1 404 Not Found'
-                prop = ElementTree.SubElement(el404, '{DAV:}prop')
-                prop = ElementTree.SubElement(prop, name)
+                yield self.render_response(res, plan)
+
+
+class DavLockStore(object):
+    '''Keeps lock records and the indexes over them in the memory of this process.
+    Values are never changed in place, only replaced. Subclasses keep them
+    somewhere shared by overriding the primitives below.'''
+    def __init__(self):
+        self._data = {}
+        self._mutex = threading.RLock()
+
+    @contextmanager
+    def mutex(self):
+        '''Serialize updates.'''
+        with self._mutex:
+            yield
+
+    def get_many(self, keys):
+        data = self._data
+        return dict((key, data[key]) for key in keys if key in data)
+
+    def set(self, key, value):
+        self._data[key] = value
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+
+class DavCacheLockStore(DavLockStore):
+    '''Keeps locks in a Django cache, so that every process using the same cache
+    sees the same locks. Updates are serialized with a mutex entry in the cache.'''
+    prefix = 'davlock:'
+    mutex_timeout = 10
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    @contextmanager
+    def mutex(self):
+        key = self.prefix + 'mutex'
+        token = uuid.uuid4().hex
+        deadline = time.time() + self.mutex_timeout
+        # The entry expires by itself if its holder dies.
+        while not self.cache.add(key, token, self.mutex_timeout):
+            if time.time() >= deadline:
+                raise HttpServiceUnavailable('Timed out waiting for the lock store.')
+            time.sleep(0.01)
+        try:
+            yield
+        finally:
+            # Unless it expired and another process took it meanwhile.
+            if self.cache.get(key) == token:
+                self.cache.delete(key)
+
+    def get_many(self, keys):
+        found = self.cache.get_many([self.prefix + key for key in keys])
+        return dict((key[len(self.prefix):], value) for key, value in found.iteritems())
+
+    def set(self, key, value):
+        # Everything is rewritten whenever a lock changes, and no lock outlives this.
+        self.cache.set(self.prefix + key, value, DAV_LOCK_MAX_TIMEOUT + 60)
+
+    def delete(self, key):
+        self.cache.delete(self.prefix + key)
+
+
+def get_lock_store():
+    if DAV_LOCK_CACHE:
+        return DavCacheLockStore(get_cache(DAV_LOCK_CACHE))
+    return DavLockStore()
+
+lock_store = get_lock_store()
 
 
 class DavLock(object):
-    def __init__(self, server):
+    '''Write locks, as dicts with token, path, type, scope ('exclusive' or 'shared'),
+    depth (0, or -1 for infinity), owner (serialized XML), timeout and expires.
+
+    Besides the lock records, the store holds for every path a map of the tokens
+    of the locks on it, and one of the locks anywhere below it. Finding the locks
+    that cover a resource, or that lie below it, takes a fixed number of store
+    lookups per path segment however many locks there are.
+
+    The maps of the locks below the root and below its members (the buckets, in
+    s3dav) would grow with every lock there is, and be rewritten by every LOCK
+    and UNLOCK. They are split into below_shards entries by token instead, so
+    each change touches one small entry and a depth infinity check at those
+    levels reads all of them at once. All changes are made under store.mutex().'''
+    below_shards = 64
+
+    def __init__(self, server, store=None):
         self.server = server
-        self.lock = synch.RWLock()
+        self.store = store or lock_store
+
+    def get_lock_path(self, res):
+        return res.get_path().strip('/')
+
+    def get_ancestors(self, path):
+        if not path:
+            return []
+        parts = path.split('/')
+        return ['/'.join(parts[:i]) for i in range(len(parts))]
+
+    def get_below_keys(self, path, token=None):
+        '''Return the keys of the map of the locks below path, or with a token the
+        one key the lock with that token is listed under.'''
+        if '/' in path:
+            return ['below:' + path]
+        if token is not None:
+            return ['below:%s#%d' % (path, (zlib.crc32(token) & 0xffffffff) % self.below_shards)]
+        return ['below:%s#%d' % (path, shard) for shard in range(self.below_shards)]
+
+    def _load(self, index_keys):
+        '''Return the unexpired locks listed in the given indexes.'''
+        now = time.time()
+        tokens = set()
+        for index in self.store.get_many(index_keys).itervalues():
+            tokens.update(token for token, expires in index.iteritems() if expires > now)
+        if not tokens:
+            return []
+        records = self.store.get_many(['token:' + token for token in tokens])
+        return [lock for lock in records.itervalues() if lock['expires'] > now]
+
+    def _index(self, lock, add):
+        '''Add lock to, or remove it from, the indexes of its path and ancestors.
+        Expired locks met on the way are dropped for good.'''
+        path = lock['path']
+        index_keys = ['path:' + path] + [self.get_below_keys(p, lock['token'])[0]
+                                         for p in self.get_ancestors(path)]
+        indexes = self.store.get_many(index_keys)
+        now = time.time()
+        expired = set()
+        for key in index_keys:
+            index = {}
+            for token, expires in indexes.get(key, {}).iteritems():
+                if token == lock['token']:
+                    continue
+                if expires <= now:
+                    expired.add(token)
+                else:
+                    index[token] = expires
+            if add:
+                index[lock['token']] = lock['expires']
+            if index:
+                self.store.set(key, index)
+            else:
+                self.store.delete(key)
+        # The shards an expired lock is listed under need not be the ones this
+        # lock is, so unlist it from all of its own.
+        for key, record in self.store.get_many(['token:' + token for token in expired]).iteritems():
+            self.store.delete(key)
+            self._index(record, add=False)
 
     def get(self, res):
-        '''Gets all active locks for the requested resource. Returns a list of locks.'''
-        self.lock.reader_enters()
-        try:
-            pass
-        finally:
-            self.lock.reader_leaves()
+        '''Gets all active locks for the requested resource, including the depth
+        infinity locks of its ancestors. Returns a list of locks.'''
+        path = self.get_lock_path(res)
+        index_keys = ['path:' + p for p in [path] + self.get_ancestors(path)]
+        return [lock for lock in self._load(index_keys)
+                if lock['path'] == path or lock['depth'] == -1]
+
+    def get_below(self, res):
+        '''Gets all active locks on members of the requested collection.'''
+        return self._load(self.get_below_keys(self.get_lock_path(res)))
+
+    def get_lock(self, token):
+        '''Gets the active lock with the given token, or None.'''
+        lock = self.store.get_many(['token:' + token]).get('token:' + token)
+        if lock is not None and lock['expires'] > time.time():
+            return lock
 
     def acquire(self, res, type, scope, depth, owner, timeout):
-        '''Creates a new lock for the given resource.'''
-        self.lock.writer_enters()
-        try:
-            pass
-        finally:
-            self.lock.writer_leaves()
+        '''Creates a new lock for the given resource. Raises HttpLocked if it
+        conflicts with an existing lock.'''
+        with self.store.mutex():
+            existing = self.get(res)
+            if depth == -1:
+                existing.extend(self.get_below(res))
+            if existing and (scope == 'exclusive' or
+                             [lock for lock in existing if lock['scope'] == 'exclusive']):
+                raise HttpLocked()
+            lock = {
+                'token': 'opaquelocktoken:%s' % uuid.uuid4(),
+                'path': self.get_lock_path(res),
+                'type': type,
+                'scope': scope,
+                'depth': depth,
+                'owner': owner,
+                'timeout': timeout,
+                'expires': time.time() + timeout,
+            }
+            self.store.set('token:' + lock['token'], lock)
+            self._index(lock, add=True)
+        return lock
+
+    def refresh(self, token, timeout):
+        '''Restarts the timeout of a lock. Returns the lock, or None if it is gone.'''
+        with self.store.mutex():
+            lock = self.get_lock(token)
+            if lock is None:
+                return None
+            lock = dict(lock, timeout=timeout, expires=time.time() + timeout)
+            self.store.set('token:' + token, lock)
+            self._index(lock, add=True)
+        return lock
 
     def release(self, lock):
         '''Releases the lock referenced by the given lock id.'''
-        self.lock.writer_enters()
-        try:
-            pass
-        finally:
-            self.lock.writer_leaves()
-
-    def del_locks(self, res):
-        '''Releases all locks for the given resource.'''
-        self.lock.writer_enters()
-        try:
-            pass
-        finally:
-            self.lock.writer_leaves()
+        with self.store.mutex():
+            record = self.store.get_many(['token:' + lock]).get('token:' + lock)
+            if record is not None:
+                self.store.delete('token:' + lock)
+                self._index(record, add=False)
+
+    def get_activelock(self, lock):
+        '''Returns the DAV:activelock element describing lock.'''
+        el = ElementTree.Element('{DAV:}activelock')
+        ElementTree.SubElement(ElementTree.SubElement(el, '{DAV:}locktype'), '{DAV:}' + lock['type'])
+        ElementTree.SubElement(ElementTree.SubElement(el, '{DAV:}lockscope'), '{DAV:}' + lock['scope'])
+        ElementTree.SubElement(el, '{DAV:}depth').text = lock['depth'] == -1 and 'infinity' or '0'
+        if lock['owner']:
+            el.append(ElementTree.fromstring(lock['owner']))
+        remaining = max(int(lock['expires'] - time.time()), 0)
+        ElementTree.SubElement(el, '{DAV:}timeout').text = 'Second-%d' % remaining
+        token = ElementTree.SubElement(el, '{DAV:}locktoken')
+        ElementTree.SubElement(token, '{DAV:}href').text = lock['token']
+        root = ElementTree.SubElement(el, '{DAV:}lockroot')
+        ElementTree.SubElement(root, '{DAV:}href').text = url_join(
+            self.server.request.get_base_url(), lock['path'])
+        return el
+
+    def del_locks(self, res, keep=()):
+        '''Releases all locks for the given resource, and those of its members,
+        except the locks on the paths in keep and on the collections holding them.'''
+        path = self.get_lock_path(res)
+        with self.store.mutex():
+            indexes = self.store.get_many(['path:' + path] + self.get_below_keys(path))
+            tokens = set()
+            for index in indexes.itervalues():
+                tokens.update(index)
+            records = self.store.get_many(['token:' + token for token in tokens])
+            for key, lock in records.iteritems():
+                if covers(lock['path'], keep):
+                    continue
+                self.store.delete(key)
+                self._index(lock, add=False)
 
 
 class DavServer(object):
@@ -628,13 +1212,86 @@ class DavServer(object):
         if cond_if_modified_since:
             # This previously evaluated True and is not being ignored...
             raise HttpNotModified()
-        # TODO: complete If header handling...
-        cond_if = self.request.META.get('HTTP_IF', None)
-        if cond_if:
-            if not cond_if.startswith('<'):
-                cond_if = '<*>' + cond_if
-            #for (tmpurl, url, tmpcontent, content) in PATTERN_IF_DELIMITER.findall(cond_if):
-                
+        if not self.if_header_matches(res):
+            raise HttpPreconditionFailed()
+
+    def get_if_lists(self):
+        header = self.request.META.get('HTTP_IF')
+        if not header:
+            return []
+        return parse_if(header)
+
+    def get_submitted_tokens(self):
+        '''Return the lock tokens the client submitted in the If header.'''
+        return set(token for url, conditions in self.get_if_lists()
+                   for negate, token, etag in conditions if token and not negate)
+
+    def get_failed_paths(self, errors, res=None, dst=None):
+        '''Return the paths, relative to the root, of the resources the (url, status)
+        pairs in errors report. Those below dst are mapped to the same place below
+        res, the source of a copy or move.'''
+        failed = set()
+        src_path = res is not None and res.get_path().strip('/')
+        dst_path = dst is not None and dst.get_path().strip('/')
+        for url, status in errors or ():
+            path = self.url_to_path(url).strip('/')
+            if dst_path and (path == dst_path or path.startswith(dst_path + '/')):
+                path = src_path + path[len(dst_path):]
+            failed.add(path)
+        return failed
+
+    def url_to_path(self, url):
+        path = urllib.unquote(urlparse.urlparse(url).path)
+        base = self.request.get_base()
+        if path.startswith(base):
+            path = path[len(base):]
+        return path
+
+    def if_header_matches(self, res):
+        '''Evaluate the If header against res, or the resources its lists are
+        tagged with. True if any of the lists holds, or if there is no header.'''
+        lists = self.get_if_lists()
+        if not lists:
+            return True
+        for url, conditions in lists:
+            if url is None:
+                target = res
+            else:
+                target = self.get_resource(self.url_to_path(url))
+            if all(self.condition_holds(target, *condition) for condition in conditions):
+                return True
+        return False
+
+    def condition_holds(self, res, negate, token, etag):
+        if token:
+            held = token in [lock['token'] for lock in self.locks.get(res)]
+        else:
+            held = res.exists() and (res.get_etag() or '').strip('"') == etag.strip('"')
+        return held != negate
+
+    def check_locks(self, res, depth=0):
+        '''Make sure the client may modify res, and with depth -1 its members.
+        Raises HttpPreconditionFailed if the If header does not hold and
+        HttpLocked if a lock is in the way whose token was not submitted.'''
+        if not self.if_header_matches(res):
+            raise HttpPreconditionFailed()
+        self.check_lock_tokens(res, depth)
+
+    def check_lock_tokens(self, res, depth=0):
+        '''Raise HttpLocked if res, or with depth -1 one of its members, holds a
+        lock whose token the client did not submit.'''
+        locks = self.locks.get(res)
+        if depth == -1:
+            locks.extend(self.locks.get_below(res))
+        if not locks:
+            return
+        submitted = self.get_submitted_tokens()
+        # One token is enough to get past any number of shared locks.
+        shared_ok = [lock for lock in locks if lock['scope'] == 'shared' and lock['token'] in submitted]
+        for lock in locks:
+            if lock['token'] in submitted or (lock['scope'] == 'shared' and shared_ok):
+                continue
+            raise HttpLocked('%s is locked.' % lock['path'])
 
     def get_response(self):
         handler = getattr(self, 'do' + self.request.method, None)
@@ -667,29 +1324,101 @@ class DavServer(object):
                 response = HttpResponseNotFound()
             else:
                 use_sendfile = getattr(settings, 'DAV_USE_SENDFILE', '').split()
-                if len(use_sendfile) > 0 and use_sendfile[0].lower() == 'x-sendfile':
-                    full_path = res.get_abs_path().encode('utf-8')
+                # The front proxy can only send what is on disk already.
+                sendfile_path = use_sendfile and res.get_sendfile_path()
+                if sendfile_path and use_sendfile[0].lower() == 'x-sendfile':
+                    full_path = sendfile_path.encode('utf-8')
                     if len(use_sendfile) == 2 and use_sendfile[1] == 'escape':
                         full_path = urllib.quote(full_path)
                     response = HttpResponse()
                     response['X-SendFile'] = full_path
-                elif len(use_sendfile) == 2 and use_sendfile[0].lower() == 'x-accel-redir':
-                    full_path = res.get_abs_path().encode('utf-8')
+                elif sendfile_path and len(use_sendfile) == 2 and use_sendfile[0].lower() == 'x-accel-redir':
+                    full_path = sendfile_path.encode('utf-8')
                     full_path = url_join(use_sendfile[1], full_path)
                     response = HttpResponse()
                     response['X-Accel-Redirect'] = full_path
                     response['X-Accel-Charset'] = 'utf-8'
                 else:
-                    # Do things the slow way:
-                    response =  HttpResponse(res.open('r'))
+                    ranges = self.get_ranges(res)
+                    if ranges is not None:
+                        return self.get_range_response(res, ranges)
+                    response = self.get_content_response(res, res.get_local_path())
             if res.exists():
-                response['Content-Type'] = mimetypes.guess_type(res.get_name())
+                response['Content-Type'] = self.get_content_type(res)
                 response['Content-Length'] = res.get_size()
                 response['Last-Modified'] = http_date(res.get_mtime_stamp())
                 response['ETag'] = res.get_etag()
+                response['Accept-Ranges'] = 'bytes'
             response['Date'] = http_date()
         return response
 
+    def get_content_response(self, res, local_path):
+        '''Send a local copy as a file, which the WSGI server may pass to sendfile(),
+        and anything else from res.iter_content().'''
+        if local_path:
+            try:
+                return FileHttpResponse(open(local_path, 'rb'))
+            except IOError:
+                # Gone since, e.g. evicted from a cache.
+                pass
+        return StreamingHttpResponse(res.iter_content())
+
+    def get_content_type(self, res):
+        return mimetypes.guess_type(res.get_name())[0] or 'application/octet-stream'
+
+    def get_ranges(self, res):
+        '''Return the byte ranges a GET asks for, an empty list if none of them can
+        be satisfied, or None if the whole entity should be sent.'''
+        header = self.request.META.get('HTTP_RANGE')
+        if not header or not res.isfile():
+            return None
+        if_range = self.request.META.get('HTTP_IF_RANGE')
+        if if_range and if_range.strip() not in (res.get_etag(), http_date(res.get_mtime_stamp())):
+            return None
+        ranges = parse_range(header, res.get_size())
+        if ranges is None:
+            return None
+        ranges = merge_ranges(ranges)
+        if len(ranges) > DAV_MAX_RANGES:
+            return None
+        return ranges
+
+    def get_range_response(self, res, ranges):
+        '''Build a 206 response for ranges, as multipart/byteranges when there are
+        several of them.'''
+        size = res.get_size()
+        if not ranges:
+            response = HttpResponseRequestedRangeNotSatisfiable()
+            response['Content-Range'] = 'bytes */%d' % size
+            return response
+        content_type = self.get_content_type(res)
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            response = StreamingHttpResponsePartialContent(res.read_range(start, end),
+                                                           mimetype=content_type)
+            response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+            response['Content-Length'] = end - start + 1
+        else:
+            boundary = uuid.uuid4().hex
+            response = StreamingHttpResponsePartialContent(
+                self.iter_byteranges(res, ranges, boundary, content_type),
+                mimetype='multipart/byteranges; boundary=%s' % boundary)
+        response['Last-Modified'] = http_date(res.get_mtime_stamp())
+        response['ETag'] = res.get_etag()
+        response['Accept-Ranges'] = 'bytes'
+        response['Date'] = http_date()
+        return response
+
+    def iter_byteranges(self, res, ranges, boundary, content_type):
+        size = res.get_size()
+        for start, end in ranges:
+            yield '--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (
+                boundary, content_type, start, end, size)
+            for data in res.read_range(start, end):
+                yield data
+            yield '\r\n'
+        yield '--%s--\r\n' % boundary
+
     def doHEAD(self):
         return self.doGET(head=True)
 
@@ -705,6 +1434,7 @@ class DavServer(object):
         acl = self.get_access(res.get_abs_path())
         if not acl.write:
             return HttpResponseForbidden()
+        self.check_locks(res)
 
         created = not res.exists()
         with res.open('w') as f:
@@ -722,9 +1452,14 @@ class DavServer(object):
         acl = self.get_access(res.get_abs_path())
         if not acl.delete:
             return HttpResponseForbidden()
-        self.locks.del_locks(res)
-        self.props.del_props(res)
-        res.delete()
+        self.check_locks(res, depth=-1)
+        errors = res.delete()
+        # Whatever could not be deleted keeps its locks and properties.
+        failed = self.get_failed_paths(errors)
+        self.locks.del_locks(res, keep=failed)
+        self.props.del_props(res, keep=failed)
+        if errors:
+            return self.get_errors_response(errors)
         response = HttpResponseNoContent()
         response['Date'] = http_date()
         return response
@@ -741,13 +1476,14 @@ class DavServer(object):
         acl = self.get_access(res.get_abs_path())
         if not acl.create:
             return HttpResponseForbidden()
+        self.check_locks(res)
         res.mkdir()
         return HttpResponseCreated()
 
     def doCOPY(self, move=False):
         res = self.get_resource(self.request.path)
         if not res.exists():
-            return HtpResponseNotFound()
+            return HttpResponseNotFound()
         acl = self.get_access(res.get_abs_path())
         if not acl.relocate:
             return HttpResponseForbidden()
@@ -774,6 +1510,13 @@ class DavServer(object):
             return HttpResponseBadRequest()
         if depth not in (0, -1):
             return HttpResponseBadRequest()
+        # Untagged If lists apply to the Request-URI only; the destination
+        # just must not be locked by someone else.
+        if not self.if_header_matches(res):
+            raise HttpPreconditionFailed()
+        if move:
+            self.check_lock_tokens(res, depth=-1)
+        self.check_lock_tokens(dst, depth=-1)
         dst_exists = dst.exists()
         if move:
             if dst_exists:
@@ -783,26 +1526,92 @@ class DavServer(object):
             errors = res.move(dst)
         else:
             errors = res.copy(dst, depth=depth)
-        #print 'copy props', res, dst, self.props
-        #self.props.copy(res, dst, move=move)
+        # Members that were not copied or moved keep their properties and locks.
+        failed = self.get_failed_paths(errors, res, dst)
+        self.props.copy_props(res, dst, move=move, depth=depth, failed=failed)
         if move:
-            self.locks.del_locks(res)
+            self.locks.del_locks(res, keep=failed)
         if errors:
-            response = HttpResponseMultiStatus()
+            response = self.get_errors_response(errors)
         elif dst_exists:
             response = HttpResponseNoContent()
         else:
             response = HttpResponseCreated()
         return response
 
+    def get_errors_response(self, errors):
+        '''Build a 207 Multi-Status response reporting the status of each (url, status)
+        pair in errors.'''
+        msr = ElementTree.Element('{DAV:}multistatus')
+        for url, status in errors:
+            response = ElementTree.SubElement(msr, '{DAV:}response')
+            ElementTree.SubElement(response, '{DAV:}href').text = url
+            ElementTree.SubElement(response, '{DAV:}status').text = status_line(status)
+        return HttpResponseMultiStatus(ElementTree.tostring(msr, 'UTF-8'), mimetype='application/xml')
+
     def doMOVE(self):
         return self.doCOPY(move=True)
 
     def doLOCK(self):
-        raise HttpNotImplemented()
+        res = self.get_resource(self.request.path)
+        acl = self.get_access(res.get_abs_path())
+        if not acl.write:
+            return HttpResponseForbidden()
+        timeout = parse_timeout(self.request.META.get('HTTP_TIMEOUT'))
+        length = self.request.META.get('CONTENT_LENGTH', 0)
+        if not length or int(length) == 0:
+            # No body, a refresh of the lock named in the If header.
+            held = set(lock['token'] for lock in self.locks.get(res))
+            for token in self.get_submitted_tokens() & held:
+                lock = self.locks.refresh(token, timeout)
+                if lock is not None:
+                    return self.get_lock_response(lock)
+            return HttpResponsePreconditionFailed('No lock to refresh.')
+        depth = self.get_depth()
+        if depth == 1:
+            return HttpResponseBadRequest('Depth must be 0 or infinity.')
+        try:
+            info = ElementTree.parse(self.request).getroot()
+        except SyntaxError:
+            return HttpResponseBadRequest('Malformed lockinfo.')
+        scope = 'exclusive'
+        if info.find('{DAV:}lockscope/{DAV:}shared') is not None:
+            scope = 'shared'
+        if info.find('{DAV:}locktype/{DAV:}write') is None:
+            return HttpResponseBadRequest('Only write locks are supported.')
+        owner = info.find('{DAV:}owner')
+        if owner is not None:
+            owner = ElementTree.tostring(owner, 'utf-8')
+        created = not res.exists()
+        if created and not res.get_parent().exists():
+            return HttpResponseConflict()
+        lock = self.locks.acquire(res, 'write', scope, depth, owner, timeout)
+        if created:
+            # Locking an unmapped URL creates an empty resource.
+            res.create_empty()
+        response = self.get_lock_response(lock, status=created and httplib.CREATED or httplib.OK)
+        response['Lock-Token'] = '<%s>' % lock['token']
+        return response
+
+    def get_lock_response(self, lock, status=httplib.OK):
+        prop = ElementTree.Element('{DAV:}prop')
+        discovery = ElementTree.SubElement(prop, '{DAV:}lockdiscovery')
+        discovery.append(self.locks.get_activelock(lock))
+        return HttpResponse(ElementTree.tostring(prop, 'UTF-8'), status=status,
+                            mimetype='application/xml')
 
     def doUNLOCK(self):
-        raise HttpNotImplemented()
+        res = self.get_resource(self.request.path)
+        acl = self.get_access(res.get_abs_path())
+        if not acl.write:
+            return HttpResponseForbidden()
+        token = self.request.META.get('HTTP_LOCK_TOKEN', '').strip().strip('<>')
+        if not token:
+            return HttpResponseBadRequest('Lock-Token header missing.')
+        if token not in [lock['token'] for lock in self.locks.get(res)]:
+            return HttpResponseConflict('Lock-Token does not match a lock on the resource.')
+        self.locks.release(token)
+        return HttpResponseNoContent()
 
     def doOPTIONS(self):
         response = HttpResponse(mimetype='text/html')
@@ -821,7 +1630,7 @@ class DavServer(object):
             response['Allow'] = 'OPTIONS HEAD GET DELETE PROPFIND PROPPATCH COPY MOVE LOCK UNLOCK'
         else:
             response['Allow'] = 'OPTIONS HEAD GET PUT DELETE PROPFIND PROPPATCH COPY MOVE LOCK UNLOCK'
-            response['Allow-Ranges'] = 'bytes'
+            response['Accept-Ranges'] = 'bytes'
         return response
 
     def doPROPFIND(self):
@@ -835,7 +1644,7 @@ class DavServer(object):
         depth = self.get_depth()
         names_only, props = False, []
         length = self.request.META.get('CONTENT_LENGTH', 0)
-        if not length or int(length) != 0:
+        if length and int(length) != 0:
             #Otherwise, empty prop list is treated as request for ALL props.
             for ev, el in ElementTree.iterparse(self.request):
                 if el.tag == '{DAV:}allprop':
@@ -848,19 +1657,92 @@ class DavServer(object):
                         return HttpResponseBadRequest()
                     for pr in el:
                         props.append(pr.tag)
-        msr = ElementTree.Element('{DAV:}multistatus')
-        for child in res.get_descendants(depth=depth, include_self=True):
-            response = ElementTree.SubElement(msr, '{DAV:}response')
-            ElementTree.SubElement(response, '{DAV:}href').text = child.get_url()
-            self.props.get_propstat(child, response, *props)
-        response = HttpResponseMultiStatus(ElementTree.tostring(msr, 'UTF-8'), mimetype='application/xml')
+        descendants = res.get_descendants(depth=depth, include_self=True)
+        response = StreamingHttpResponseMultiStatus(self.iter_multistatus(descendants, props),
+                                                    mimetype='application/xml')
         response['Date'] = http_date()
         return response
 
+    def iter_multistatus(self, resources, props):
+        '''Yield a multistatus document piece by piece. Each <response> is built and
+        serialized on its own as the resources iterator produces it, so neither the
+        listing nor the XML tree for it is ever held in memory as a whole.'''
+        yield "<?xml version='1.0' encoding='UTF-8'?>\n"
+        yield '<D:multistatus xmlns:D="DAV:">'
+        try:
+            resources = iter(resources)
+            while True:
+                batch = list(itertools.islice(resources, DAV_PROPERTY_BATCH_SIZE))
+                if not batch:
+                    break
+                if DAV_MULTISTATUS_TEMPLATES:
+                    for chunk in self.props.render_responses(batch, *props):
+                        yield chunk
+                else:
+                    for response in self.props.get_responses(batch, *props):
+                        yield ElementTree.tostring(response, 'utf-8')
+        except:
+            # The status line is already sent, all we can do is log and cut the body.
+            import traceback
+            traceback.print_exc()
+            raise
+        yield '</D:multistatus>'
+
     def doPROPPATCH(self):
         res = self.get_resource(self.request.path)
         if not res.exists():
             return HttpResponseNotFound()
-        depth = self.get_depth(default=0)
+        depth = self.get_depth(default='0')
         if depth != 0:
             return HttpResponseBadRequest('Invalid depth header value %s' % depth)
+        acl = self.get_access(res.get_abs_path())
+        if not acl.write:
+            return HttpResponseForbidden()
+        self.check_locks(res)
+        try:
+            update = ElementTree.parse(self.request).getroot()
+        except SyntaxError:
+            return HttpResponseBadRequest('Malformed propertyupdate.')
+        updates = []
+        for instruction in update:
+            if instruction.tag not in ('{DAV:}set', '{DAV:}remove'):
+                continue
+            for prop in instruction.findall('{DAV:}prop'):
+                for el in prop:
+                    if instruction.tag == '{DAV:}set':
+                        updates.append((el.tag, ElementTree.tostring(el, 'utf-8')))
+                    else:
+                        updates.append((el.tag, None))
+        names = []
+        for name, value in updates:
+            if name not in names:
+                names.append(name)
+        # Live properties are protected. The update is all or nothing, so when
+        # one instruction fails the others fail with it.
+        statuses = {}
+        for name, value in updates:
+            if ns_split(name)[0] == 'DAV':
+                statuses[name] = httplib.FORBIDDEN
+        if statuses:
+            for name, value in updates:
+                statuses.setdefault(name, httplib.FAILED_DEPENDENCY)
+        else:
+            try:
+                self.props.patch_props(res, updates)
+            except HttpError, e:
+                for name, value in updates:
+                    statuses[name] = e.status_code
+            else:
+                for name, value in updates:
+                    statuses[name] = httplib.OK
+        msr = ElementTree.Element('{DAV:}multistatus')
+        response = ElementTree.SubElement(msr, '{DAV:}response')
+        ElementTree.SubElement(response, '{DAV:}href').text = res.get_url()
+        for status in sorted(set(statuses.values())):
+            propstat = ElementTree.SubElement(response, '{DAV:}propstat')
+            prop = ElementTree.SubElement(propstat, '{DAV:}prop')
+            for name in names:
+                if statuses[name] == status:
+                    ElementTree.SubElement(prop, name)
+            ElementTree.SubElement(propstat, '{DAV:}status').text = status_line(status)
+        return HttpResponseMultiStatus(ElementTree.tostring(msr, 'UTF-8'), mimetype='application/xml')
@@ -0,0 +1,127 @@
+import os
+import threading
+import uuid
+from s3dav.django_webdav import BLOCK_SIZE
+
+_downloads = {}
+_downloads_lock = threading.Lock()
+
+def fetch(bucket, key_name, path, connect=None, callback=None):
+    '''Return the download of key_name into path, starting one unless it is already
+    in progress. Concurrent readers of the same cold object share that download.
+
+    connect, if given, is called from the download thread to get a connection of
+    its own, since boto connections must not be shared between threads. callback,
+    if given, is called with the path, the size and the etag of the downloaded
+    version once the copy is complete.'''
+    with _downloads_lock:
+        download = _downloads.get(path)
+        if download is None:
+            download = Download(bucket, key_name, path, connect, callback)
+            _downloads[path] = download
+            thread = threading.Thread(target=download.run)
+            thread.daemon = True
+            thread.start()
+    return download
+
+class Download(object):
+    '''Copies one object into the cache through a temporary file, which is renamed
+    into place once complete. Readers can follow the bytes as they are written.'''
+    def __init__(self, bucket, key_name, path, connect=None, callback=None):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.path = path
+        self.connect = connect
+        self.callback = callback
+        self.tmp_path = '%s.%s.part' % (path, uuid.uuid4().hex)
+        self.written = 0
+        self.etag = None
+        self.complete = False
+        self.done = False
+        self.error = None
+        self.cond = threading.Condition()
+        # Created up front so followers can open it before the first byte arrives.
+        self.fp = open(self.tmp_path, 'wb')
+
+    def run(self):
+        try:
+            if self.connect is not None:
+                bucket = self.connect().get_bucket(self.bucket.name, validate=False)
+            else:
+                bucket = self.bucket
+            key = bucket.new_key(self.key_name)
+            key.open_read()
+            self.etag = key.etag
+            try:
+                while True:
+                    data = key.read(BLOCK_SIZE)
+                    if not data:
+                        break
+                    self.fp.write(data)
+                    self.fp.flush()
+                    with self.cond:
+                        self.written += len(data)
+                        self.cond.notify_all()
+            finally:
+                key.close()
+            self.fp.close()
+            with self.cond:
+                os.rename(self.tmp_path, self.path)
+                self.complete = True
+            if self.callback is not None:
+                try:
+                    self.callback(self.path, self.written, etag=self.etag)
+                except Exception:
+                    import traceback
+                    traceback.print_exc()
+        except Exception, e:
+            import traceback
+            traceback.print_exc()
+            self.error = e
+            self.fp.close()
+            try:
+                os.remove(self.tmp_path)
+            except OSError:
+                pass
+        finally:
+            with _downloads_lock:
+                if _downloads.get(self.path) is self:
+                    del _downloads[self.path]
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+
+    def wait(self):
+        '''Block until the download has finished, raising its error if it failed.'''
+        with self.cond:
+            while not self.done:
+                self.cond.wait(1)
+        if self.error:
+            raise self.error
+
+    def follow(self):
+        '''Yield the content of the object as it lands on disk.'''
+        with self.cond:
+            if self.error:
+                raise self.error
+            # Once renamed, the temporary file is gone but the complete copy is in place.
+            if self.complete:
+                f = open(self.path, 'rb')
+            else:
+                f = open(self.tmp_path, 'rb')
+        try:
+            pos = 0
+            while True:
+                with self.cond:
+                    while pos >= self.written and not self.done:
+                        self.cond.wait(1)
+                    if self.error:
+                        raise self.error
+                    available = self.written - pos
+                if not available:
+                    break
+                data = f.read(min(available, BLOCK_SIZE))
+                pos += len(data)
+                yield data
+        finally:
+            f.close()
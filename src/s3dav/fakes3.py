@@ -0,0 +1,328 @@
+'''
+A small in-process stand-in for the S3 REST API, enough of it for boto and
+s3dav: buckets, listings with prefix/delimiter/marker paging, HEAD/GET with
+ranges, PUT, server-side copy, single and multi-object delete, and multipart
+uploads. Requests are not authenticated. Every request is counted by operation,
+so the upstream cost of a WebDAV request can be measured offline. latency adds
+a delay to every request, as a remote endpoint would.
+'''
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import threading
+import time
+import urllib
+import urlparse
+import uuid
+from collections import defaultdict
+from email.utils import formatdate
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+S3_NS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+def iso_date(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(t))
+
+class FakeObject(object):
+    def __init__(self, data, etag=None):
+        self.data = data
+        self.etag = etag or '"%s"' % hashlib.md5(data).hexdigest()
+        self.mtime = time.time()
+
+class FakeS3(object):
+    '''The state of the fake: bucket name -> {key name: FakeObject}.'''
+    def __init__(self, latency=0):
+        self.buckets = {}
+        self.uploads = {}
+        self.latency = latency
+        self.calls = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def count(self, operation):
+        with self.lock:
+            self.calls[operation] += 1
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls.clear()
+
+    def put(self, bucket, key, data):
+        '''Store an object directly, without going through HTTP.'''
+        with self.lock:
+            self.buckets.setdefault(bucket, {})[key] = FakeObject(data)
+
+class FakeS3Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def s3(self):
+        return self.server.s3
+
+    def log_message(self, format, *args):
+        pass
+
+    def parse(self):
+        url = urlparse.urlparse(self.path)
+        parts = url.path.lstrip('/').split('/', 1)
+        self.bucket = urllib.unquote(parts[0])
+        self.key = urllib.unquote(parts[1]) if len(parts) > 1 else ''
+        self.query = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length) if length else ''
+        if self.s3.latency:
+            time.sleep(self.s3.latency)
+
+    def send(self, status, body='', headers=None, head=False):
+        self.send_response(status)
+        headers = dict(headers or {})
+        headers.setdefault('Content-Length', str(len(body)))
+        if body:
+            headers.setdefault('Content-Type', 'application/xml')
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        if body and not head:
+            self.wfile.write(body)
+
+    def send_error_xml(self, status, code):
+        self.send(status, '<?xml version="1.0" encoding="UTF-8"?><Error><Code>%s</Code>'
+                          '<Message>%s</Message></Error>' % (code, code))
+
+    def get_object(self):
+        objects = self.s3.buckets.get(self.bucket)
+        if objects is None:
+            self.send_error_xml(404, 'NoSuchBucket')
+            return None
+        obj = objects.get(self.key)
+        if obj is None:
+            self.send_error_xml(404, 'NoSuchKey')
+        return obj
+
+    def object_headers(self, obj):
+        return {
+            'ETag': obj.etag,
+            'Last-Modified': formatdate(obj.mtime, usegmt=True),
+            'Content-Type': 'application/octet-stream',
+        }
+
+    def do_HEAD(self):
+        self.parse()
+        if not self.key:
+            self.s3.count('HeadBucket')
+            self.send(self.bucket in self.s3.buckets and 200 or 404)
+            return
+        self.s3.count('HeadObject')
+        obj = self.s3.buckets.get(self.bucket, {}).get(self.key)
+        if obj is None:
+            self.send(404)
+            return
+        headers = self.object_headers(obj)
+        headers['Content-Length'] = str(len(obj.data))
+        self.send(200, headers=headers)
+
+    def do_GET(self):
+        self.parse()
+        if not self.bucket:
+            self.s3.count('ListBuckets')
+            self.list_buckets()
+        elif not self.key:
+            self.s3.count('ListObjects')
+            self.list_objects()
+        elif 'uploadId' in self.query:
+            self.s3.count('ListParts')
+            self.list_parts()
+        else:
+            self.s3.count('GetObject')
+            obj = self.get_object()
+            if obj is None:
+                return
+            headers = self.object_headers(obj)
+            data = obj.data
+            status = 200
+            spec = self.headers.get('Range', '')
+            if spec.startswith('bytes='):
+                first, last = spec[6:].split('-')
+                start = int(first)
+                end = min(int(last) if last else len(data) - 1, len(data) - 1)
+                headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(data))
+                data = data[start:end + 1]
+                status = 206
+            headers['Content-Type'] = 'application/octet-stream'
+            self.send(status, data, headers)
+
+    def list_buckets(self):
+        buckets = ''.join('<Bucket><Name>%s</Name><CreationDate>%s</CreationDate></Bucket>'
+                          % (escape(name), iso_date(0)) for name in sorted(self.s3.buckets))
+        self.send(200, '<?xml version="1.0" encoding="UTF-8"?><ListAllMyBucketsResult xmlns="%s">'
+                       '<Owner><ID>fake</ID><DisplayName>fake</DisplayName></Owner>'
+                       '<Buckets>%s</Buckets></ListAllMyBucketsResult>' % (S3_NS, buckets))
+
+    def list_objects(self):
+        objects = self.s3.buckets.get(self.bucket)
+        if objects is None:
+            self.send_error_xml(404, 'NoSuchBucket')
+            return
+        prefix = self.query.get('prefix', '')
+        delimiter = self.query.get('delimiter', '')
+        marker = self.query.get('marker', '')
+        max_keys = int(self.query.get('max-keys') or 1000)
+        contents, prefixes, truncated, last = [], [], False, ''
+        for name in sorted(objects):
+            if not name.startswith(prefix) or name <= marker:
+                continue
+            rest = name[len(prefix):]
+            if delimiter and delimiter in rest:
+                common = prefix + rest[:rest.index(delimiter) + len(delimiter)]
+                if common <= marker or (prefixes and prefixes[-1] == common):
+                    continue
+                entry = common
+            else:
+                entry = None
+            if len(contents) + len(prefixes) == max_keys:
+                truncated = True
+                break
+            if entry is not None:
+                prefixes.append(entry)
+                last = entry
+            else:
+                obj = objects[name]
+                contents.append('<Contents><Key>%s</Key><LastModified>%s</LastModified>'
+                                '<ETag>%s</ETag><Size>%d</Size><StorageClass>STANDARD</StorageClass>'
+                                '</Contents>' % (escape(name), iso_date(obj.mtime),
+                                                 escape(obj.etag), len(obj.data)))
+                last = name
+        common = ''.join('<CommonPrefixes><Prefix>%s</Prefix></CommonPrefixes>' % escape(p)
+                         for p in prefixes)
+        next_marker = truncated and '<NextMarker>%s</NextMarker>' % escape(last) or ''
+        self.send(200, '<?xml version="1.0" encoding="UTF-8"?><ListBucketResult xmlns="%s">'
+                       '<Name>%s</Name><Prefix>%s</Prefix><Marker>%s</Marker><MaxKeys>%d</MaxKeys>'
+                       '<Delimiter>%s</Delimiter><IsTruncated>%s</IsTruncated>%s%s%s</ListBucketResult>'
+                       % (S3_NS, escape(self.bucket), escape(prefix), escape(marker), max_keys,
+                          escape(delimiter), truncated and 'true' or 'false', next_marker,
+                          ''.join(contents), common))
+
+    def list_parts(self):
+        upload = self.s3.uploads.get(self.query['uploadId'])
+        if upload is None:
+            self.send_error_xml(404, 'NoSuchUpload')
+            return
+        parts = ''.join('<Part><PartNumber>%d</PartNumber><LastModified>%s</LastModified>'
+                        '<ETag>%s</ETag><Size>%d</Size></Part>'
+                        % (number, iso_date(part.mtime), escape(part.etag), len(part.data))
+                        for number, part in sorted(upload.items()))
+        self.send(200, '<?xml version="1.0" encoding="UTF-8"?><ListPartsResult xmlns="%s">'
+                       '<Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId>'
+                       '<MaxParts>10000</MaxParts><IsTruncated>false</IsTruncated>%s</ListPartsResult>'
+                       % (S3_NS, escape(self.bucket), escape(self.key),
+                          escape(self.query['uploadId']), parts))
+
+    def do_PUT(self):
+        self.parse()
+        if not self.key:
+            self.s3.count('CreateBucket')
+            with self.s3.lock:
+                self.s3.buckets.setdefault(self.bucket, {})
+            self.send(200)
+            return
+        if self.bucket not in self.s3.buckets:
+            self.send_error_xml(404, 'NoSuchBucket')
+            return
+        if 'uploadId' in self.query:
+            self.s3.count('UploadPart')
+            upload = self.s3.uploads.get(self.query['uploadId'])
+            if upload is None:
+                self.send_error_xml(404, 'NoSuchUpload')
+                return
+            part = FakeObject(self.body)
+            upload[int(self.query['partNumber'])] = part
+            self.send(200, headers={'ETag': part.etag})
+            return
+        source = self.headers.get('x-amz-copy-source')
+        if source:
+            self.s3.count('CopyObject')
+            src_bucket, src_key = urllib.unquote(source).lstrip('/').split('/', 1)
+            src = self.s3.buckets.get(src_bucket, {}).get(src_key)
+            if src is None:
+                self.send_error_xml(404, 'NoSuchKey')
+                return
+            obj = FakeObject(src.data, src.etag)
+            with self.s3.lock:
+                self.s3.buckets[self.bucket][self.key] = obj
+            self.send(200, '<?xml version="1.0" encoding="UTF-8"?><CopyObjectResult xmlns="%s">'
+                           '<LastModified>%s</LastModified><ETag>%s</ETag></CopyObjectResult>'
+                           % (S3_NS, iso_date(obj.mtime), escape(obj.etag)))
+            return
+        self.s3.count('PutObject')
+        obj = FakeObject(self.body)
+        with self.s3.lock:
+            self.s3.buckets[self.bucket][self.key] = obj
+        self.send(200, headers={'ETag': obj.etag})
+
+    def do_POST(self):
+        self.parse()
+        if 'delete' in self.query:
+            self.s3.count('DeleteObjects')
+            request = ElementTree.fromstring(self.body)
+            with self.s3.lock:
+                objects = self.s3.buckets.get(self.bucket, {})
+                for el in request.iter('Key'):
+                    objects.pop(el.text, None)
+            self.send(200, '<?xml version="1.0" encoding="UTF-8"?><DeleteResult xmlns="%s">'
+                           '</DeleteResult>' % S3_NS)
+        elif 'uploads' in self.query:
+            self.s3.count('CreateMultipartUpload')
+            upload_id = uuid.uuid4().hex
+            self.s3.uploads[upload_id] = {}
+            self.send(200, '<?xml version="1.0" encoding="UTF-8"?><InitiateMultipartUploadResult '
+                           'xmlns="%s"><Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId>'
+                           '</InitiateMultipartUploadResult>'
+                           % (S3_NS, escape(self.bucket), escape(self.key), upload_id))
+        elif 'uploadId' in self.query:
+            self.s3.count('CompleteMultipartUpload')
+            parts = self.s3.uploads.pop(self.query['uploadId'], None)
+            if parts is None:
+                self.send_error_xml(404, 'NoSuchUpload')
+                return
+            data = ''.join(parts[number].data for number in sorted(parts))
+            obj = FakeObject(data, '"%s-%d"' % (hashlib.md5(data).hexdigest(), len(parts)))
+            with self.s3.lock:
+                self.s3.buckets[self.bucket][self.key] = obj
+            self.send(200, '<?xml version="1.0" encoding="UTF-8"?><CompleteMultipartUploadResult '
+                           'xmlns="%s"><Location>/%s/%s</Location><Bucket>%s</Bucket><Key>%s</Key>'
+                           '<ETag>%s</ETag></CompleteMultipartUploadResult>'
+                           % (S3_NS, escape(self.bucket), escape(self.key), escape(self.bucket),
+                              escape(self.key), escape(obj.etag)))
+        else:
+            self.send_error_xml(400, 'InvalidRequest')
+
+    def do_DELETE(self):
+        self.parse()
+        if 'uploadId' in self.query:
+            self.s3.count('AbortMultipartUpload')
+            self.s3.uploads.pop(self.query['uploadId'], None)
+        else:
+            self.s3.count('DeleteObject')
+            with self.s3.lock:
+                self.s3.buckets.get(self.bucket, {}).pop(self.key, None)
+        self.send(204)
+
+class FakeS3Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    # Many clients connect at once in the concurrency tests.
+    request_queue_size = 128
+
+    def __init__(self, address=('127.0.0.1', 0)):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeS3Handler)
+        self.s3 = FakeS3()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        '''Serve from a daemon thread.'''
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
@@ -0,0 +1,149 @@
+import base64
+import math
+import resource
+import shutil
+import tempfile
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.test.client import Client
+from django.test.utils import override_settings
+from s3dav import server
+from s3dav import django_webdav as dw
+from s3dav.cache import credentials, metadata
+from s3dav.fakes3 import FakeS3Server
+from s3dav.objcache import ObjectCache
+from s3dav.views import credentials_key
+
+BUCKET = 'bench'
+PROPFIND_BODY = ('<?xml version="1.0" encoding="utf-8"?>'
+                 '<D:propfind xmlns:D="DAV:"><D:allprop/></D:propfind>')
+
+def percentile(values, p):
+    '''Nearest-rank percentile of a sorted list.'''
+    return values[max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)]
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+class Command(BaseCommand):
+    help = ('Time WebDAV requests through the Django test client against an in-process '
+            'fake S3 endpoint, reporting latency percentiles, S3 calls per request and '
+            'peak RSS. Needs a synced database, as PROPFIND reads dead properties.')
+    option_list = BaseCommand.option_list + (
+        make_option('--iterations', type='int', default=20,
+                    help='Requests timed per scenario.'),
+        make_option('--files', type='int', default=500,
+                    help='Objects in the folders that are listed, moved and deleted.'),
+        make_option('--small-kb', type='int', default=4,
+                    help='Size of the small PUT.'),
+        make_option('--large-kb', type='int', default=20 * 1024,
+                    help='Size of the large PUT, multipart beyond S3_MULTIPART_PART_SIZE.'),
+    )
+
+    def handle(self, *args, **options):
+        self.iterations = options['iterations']
+        self.files = options['files']
+        self.fake = FakeS3Server().start()
+        cache_dir = tempfile.mkdtemp()
+        saved = server.S3_CACHE_DIR, server.objects
+        server.S3_CACHE_DIR, server.objects = cache_dir, ObjectCache(cache_dir)
+        metadata.clear()
+        try:
+            with override_settings(AWS_HOST='127.0.0.1', AWS_PORT=self.fake.port):
+                self.client = self.get_client()
+                self.populate()
+                self.run_scenarios(options['small_kb'] * 1024, options['large_kb'] * 1024)
+        finally:
+            server.S3_CACHE_DIR, server.objects = saved
+            server.connection_pool.clear()
+            metadata.clear()
+            self.fake.shutdown()
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        self.stdout.write('peak RSS: %.1f MB' % peak_rss_mb())
+
+    def get_client(self):
+        auth = 'Basic ' + base64.b64encode('bench:secret')
+        # The fake accepts any credentials, skip the user lookup.
+        credentials.set(credentials_key(auth), ('bench', 'secret'))
+        return Client(HTTP_AUTHORIZATION=auth)
+
+    def put_tree(self, prefix, dirs=0):
+        for i in range(self.files):
+            if dirs:
+                name = '%sd%02d/f%05d' % (prefix, i % dirs, i)
+            else:
+                name = '%sf%05d' % (prefix, i)
+            self.fake.s3.put(BUCKET, name, 'x' * 1024)
+
+    def populate(self):
+        self.fake.s3.buckets[BUCKET] = {}
+        self.put_tree('flat/')
+        self.put_tree('tree/', dirs=10)
+        self.fake.s3.put(BUCKET, 'blob', 'b' * (1024 * 1024))
+        # PUT needs an existing parent collection.
+        self.fake.s3.put(BUCKET, 'put/', '')
+
+    def run_scenarios(self, small_size, large_size):
+        self.stdout.write('%-28s %5s %9s %9s %9s %9s  %s' % (
+            'scenario', 'n', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'S3 calls/request'))
+        c = self.client
+        self.measure('PROPFIND depth 0', lambda i: self.propfind('/%s/flat/' % BUCKET, '0'))
+        self.measure('PROPFIND depth 1', lambda i: self.propfind('/%s/flat/' % BUCKET, '1'))
+        self.measure('PROPFIND depth 1 (etree)', lambda i: self.propfind('/%s/flat/' % BUCKET, '1'),
+                     templates=False)
+        self.measure('PROPFIND depth infinity', lambda i: self.propfind('/%s/tree/' % BUCKET, 'infinity'))
+        self.measure('GET cold', lambda i: c.get('/%s/blob' % BUCKET), prepare=self.drop_cache)
+        self.measure('GET warm', lambda i: c.get('/%s/blob' % BUCKET))
+        small = 's' * small_size
+        self.measure('PUT small', lambda i: c.generic('PUT', '/%s/put/small-%d' % (BUCKET, i), small))
+        large = 'l' * large_size
+        self.measure('PUT large', lambda i: c.generic('PUT', '/%s/put/large-%d' % (BUCKET, i), large),
+                     iterations=max(self.iterations // 4, 1))
+        self.measure('MOVE tree', self.move_tree)
+        self.measure('DELETE tree', lambda i: c.delete('/%s/scratch/' % BUCKET),
+                     prepare=lambda i: self.put_tree('scratch/', dirs=10))
+
+    def propfind(self, path, depth):
+        return self.client.generic('PROPFIND', path, PROPFIND_BODY, content_type='text/xml',
+                                   HTTP_DEPTH=depth)
+
+    def move_tree(self, i):
+        # Back and forth, so every move has the same amount of work.
+        src, dst = ('tree', 'moved') if i % 2 == 0 else ('moved', 'tree')
+        return self.client.generic('MOVE', '/%s/%s/' % (BUCKET, src),
+                                   HTTP_DESTINATION='http://testserver/%s/%s/' % (BUCKET, dst))
+
+    def drop_cache(self, i):
+        shutil.rmtree(server.S3_CACHE_DIR, ignore_errors=True)
+        server.objects = ObjectCache(server.S3_CACHE_DIR)
+
+    def measure(self, name, request, prepare=None, iterations=None, templates=True):
+        iterations = iterations or self.iterations
+        saved_templates = dw.DAV_MULTISTATUS_TEMPLATES
+        dw.DAV_MULTISTATUS_TEMPLATES = templates
+        self.fake.s3.reset_calls()
+        times = []
+        try:
+            for i in range(iterations):
+                if prepare is not None:
+                    prepare(i)
+                start = time.time()
+                response = request(i)
+                if response.streaming:
+                    for chunk in response.streaming_content:
+                        pass
+                else:
+                    response.content
+                times.append(time.time() - start)
+                if response.status_code >= 400:
+                    raise CommandError('%s: status %d' % (name, response.status_code))
+        finally:
+            dw.DAV_MULTISTATUS_TEMPLATES = saved_templates
+        times.sort()
+        calls = ' '.join('%s=%.3g' % (op, float(count) / iterations)
+                         for op, count in sorted(self.fake.s3.calls.items()))
+        self.stdout.write('%-28s %5d %9.1f %9.1f %9.1f %9.1f  %s' % (
+            name, iterations, percentile(times, 50) * 1000, percentile(times, 90) * 1000,
+            percentile(times, 99) * 1000, times[-1] * 1000, calls))
@@ -0,0 +1,240 @@
+'''
+Per-request accounting of upstream S3 calls, and process-wide counters and
+histograms rendered in the Prometheus text format.
+
+A RequestStats is made active for the thread serving a request, and for every
+worker thread that asks the request's server for a connection, so the S3 calls
+made on behalf of a request are charged to it wherever they run.
+'''
+import bisect
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+import boto.s3.connection
+
+logger = logging.getLogger('s3dav.requests')
+
+_local = threading.local()
+
+def classify(method, bucket, key, headers, query_args):
+    '''Name the S3 operation of a request, as in the S3 API reference.'''
+    query_args = query_args or ''
+    if method == 'HEAD':
+        return key and 'HeadObject' or 'HeadBucket'
+    if method == 'GET':
+        if not bucket:
+            return 'ListBuckets'
+        if not key:
+            return 'ListObjects'
+        return 'uploadId' in query_args and 'ListParts' or 'GetObject'
+    if method == 'PUT':
+        if not key:
+            return 'CreateBucket'
+        if 'partNumber' in query_args:
+            return 'UploadPart'
+        if headers and 'x-amz-copy-source' in headers:
+            return 'CopyObject'
+        return 'PutObject'
+    if method == 'POST':
+        if query_args.startswith('delete'):
+            return 'DeleteObjects'
+        return 'uploads' in query_args and 'CreateMultipartUpload' or 'CompleteMultipartUpload'
+    if method == 'DELETE':
+        if 'uploadId' in query_args:
+            return 'AbortMultipartUpload'
+        return key and 'DeleteObject' or 'DeleteBucket'
+    return method
+
+class Counter(object):
+    def __init__(self, name, help, labelnames):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self.lock:
+            self.values[labels] += amount
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append('%s%s %r' % (self.name, format_labels(self.labelnames, labels), value))
+        return lines
+
+class Histogram(Counter):
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, help, labelnames, buckets=BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames)
+        self.buckets = buckets
+        # labels -> [count per bucket..., sum, count]
+        self.values = {}
+
+    def observe(self, labels, value):
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [0] * (len(self.buckets) + 2)
+            entry[bisect.bisect_left(self.buckets, value)] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        names = self.labelnames + ('le',)
+        with self.lock:
+            for labels, entry in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, entry):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (self.name, format_labels(names, labels + (repr(float(bound)),)), cumulative))
+                lines.append('%s_bucket%s %d' % (self.name, format_labels(names, labels + ('+Inf',)), entry[-1]))
+                lines.append('%s_sum%s %r' % (self.name, format_labels(self.labelnames, labels), entry[-2]))
+                lines.append('%s_count%s %d' % (self.name, format_labels(self.labelnames, labels), entry[-1]))
+        return lines
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, unicode(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in zip(names, values))
+
+requests_total = Counter('s3dav_requests_total', 'WebDAV requests served.', ('method', 'status'))
+request_seconds = Histogram('s3dav_request_duration_seconds', 'Wall time of WebDAV requests.', ('method',))
+s3_calls_total = Counter('s3dav_s3_calls_total', 'Requests made to S3.', ('operation',))
+s3_call_seconds = Histogram('s3dav_s3_call_duration_seconds',
+                            'Time until S3 answered with headers.', ('operation',))
+s3_bytes_total = Counter('s3dav_s3_bytes_total', 'Bytes sent to and received from S3.', ('direction',))
+cache_lookups_total = Counter('s3dav_cache_lookups_total', 'Cache lookups by outcome.', ('cache', 'result'))
+write_back_failures_total = Counter('s3dav_write_back_failures_total',
+                                    'Acknowledged uploads S3 refused for good.', ('bucket',))
+METRICS = [requests_total, request_seconds, s3_calls_total, s3_call_seconds, s3_bytes_total,
+           cache_lookups_total, write_back_failures_total]
+
+_gauges = []
+
+def register_gauges(prefix, func):
+    '''Report the dict of numbers func returns as gauges named prefix_key.'''
+    _gauges.append((prefix, func))
+
+def render():
+    '''Return all metrics in the Prometheus text exposition format.'''
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for prefix, func in _gauges:
+        for key, value in sorted(func().items()):
+            if isinstance(value, (int, long, float)):
+                lines.append('# TYPE %s_%s gauge' % (prefix, key))
+                lines.append('%s_%s %r' % (prefix, key, value))
+    return '\n'.join(lines) + '\n'
+
+class RequestStats(object):
+    '''What one WebDAV request cost upstream.'''
+    def __init__(self, method, path, depth=None):
+        self.method = method
+        self.path = path
+        self.depth = depth
+        self.calls = defaultdict(int)
+        self.call_seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cache = defaultdict(int)
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def add_call(self, operation, seconds, bytes_in, bytes_out):
+        with self.lock:
+            self.calls[operation] += 1
+            self.call_seconds += seconds
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def add_cache(self, cache, hit):
+        with self.lock:
+            self.cache['%s_%s' % (cache, hit and 'hits' or 'misses')] += 1
+
+    def as_dict(self, status, error=None):
+        record = {
+            'method': self.method,
+            'path': self.path,
+            'depth': self.depth,
+            'status': status,
+            'seconds': round(time.time() - self.start, 6),
+            's3_calls': dict(self.calls),
+            's3_seconds': round(self.call_seconds, 6),
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'cache': dict(self.cache),
+        }
+        if error is not None:
+            record['error'] = error
+        return record
+
+def activate(stats):
+    '''Charge the S3 calls of the calling thread to stats.'''
+    _local.stats = stats
+
+def deactivate():
+    _local.stats = None
+
+def current():
+    return getattr(_local, 'stats', None)
+
+def record_call(operation, seconds, bytes_in, bytes_out):
+    s3_calls_total.inc((operation,))
+    s3_call_seconds.observe((operation,), seconds)
+    s3_bytes_total.inc(('in',), bytes_in)
+    s3_bytes_total.inc(('out',), bytes_out)
+    stats = current()
+    if stats is not None:
+        stats.add_call(operation, seconds, bytes_in, bytes_out)
+
+def record_cache(cache, hit):
+    cache_lookups_total.inc((cache, hit and 'hit' or 'miss'))
+    stats = current()
+    if stats is not None:
+        stats.add_cache(cache, hit)
+
+def finish(stats, status, error=None):
+    '''Log the record of a request and add it to the metrics.'''
+    record = stats.as_dict(status, error)
+    requests_total.inc((stats.method, status))
+    request_seconds.observe((stats.method,), record['seconds'])
+    logger.info(json.dumps(record, sort_keys=True))
+    return record
+
+def finish_streaming(stats, response, content):
+    '''Finish the record once a streamed body has been sent, or abandoned.'''
+    error = None
+    activate(stats)
+    try:
+        for chunk in content:
+            yield chunk
+    except Exception, e:
+        error = repr(e)
+        raise
+    finally:
+        finish(stats, response.status_code, error)
+        deactivate()
+
+class MeteredS3Connection(boto.s3.connection.S3Connection):
+    '''An S3Connection that reports every request it makes.'''
+    def make_request(self, method, bucket='', key='', headers=None, data='', query_args=None,
+                     sender=None, **kwargs):
+        operation = classify(method, bucket, key, headers, query_args)
+        bytes_out = len(data or '') or int((headers or {}).get('Content-Length') or 0)
+        start = time.time()
+        bytes_in = 0
+        try:
+            response = super(MeteredS3Connection, self).make_request(
+                method, bucket, key, headers, data, query_args, sender, **kwargs)
+            bytes_in = int(response.getheader('content-length') or 0)
+            return response
+        finally:
+            record_call(operation, time.time() - start, bytes_in, bytes_out)
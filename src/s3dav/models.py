@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
 from django.db import models
+from django.db.models.signals import post_save, post_delete
 from django.contrib.auth.models import User
+from s3dav.cache import credentials
 
 class S3Account(models.Model):
     user = models.ForeignKey(User, unique=True)
@@ -14,3 +17,38 @@ class S3Account(models.Model):
 
     def __unicode__(self):
         return self.user.username
+
+def path_digest(bucket, key):
+    '''Fixed-length stand-in for bucket and key in indexes, which could not
+    hold a key of up to 1024 characters on every database.'''
+    return hashlib.sha1((u'%s/%s' % (bucket, key)).encode('utf-8')).hexdigest()
+
+class DeadProperty(models.Model):
+    '''A WebDAV property set by a client with PROPPATCH, on a key of a bucket.
+    value holds the property element serialized as XML. Exact lookups go by
+    digest, which save() fills in; bulk_create() callers must set it.'''
+    bucket = models.CharField(max_length=63, db_index=True)
+    key = models.CharField(max_length=1024)
+    digest = models.CharField(max_length=40, editable=False)
+    name = models.CharField(max_length=255)
+    value = models.TextField()
+
+    class Meta:
+        verbose_name = u'WebDAV属性'
+        verbose_name_plural = verbose_name
+        unique_together = ('digest', 'name')
+
+    def __unicode__(self):
+        return u'%s/%s %s' % (self.bucket, self.key, self.name)
+
+    def save(self, *args, **kwargs):
+        self.digest = path_digest(self.bucket, self.key)
+        super(DeadProperty, self).save(*args, **kwargs)
+
+def clear_credentials(sender, **kwargs):
+    '''Changed passwords or accounts must not be served from the auth cache.'''
+    credentials.clear()
+
+for sender in (User, S3Account):
+    post_save.connect(clear_credentials, sender=sender, dispatch_uid='s3dav.clear_credentials')
+    post_delete.connect(clear_credentials, sender=sender, dispatch_uid='s3dav.clear_credentials')
@@ -0,0 +1,231 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from django.conf import settings
+from django.utils.encoding import smart_unicode
+
+# Budgets for the files kept in S3_CACHE_DIR. None disables a limit.
+S3_CACHE_MAX_BYTES = getattr(settings, 'S3_CACHE_MAX_BYTES', 10 * 1024 * 1024 * 1024)
+S3_CACHE_MAX_FILES = getattr(settings, 'S3_CACHE_MAX_FILES', 100000)
+# Maps a bucket name to the most bytes its objects may take in the cache.
+S3_CACHE_BUCKET_QUOTAS = getattr(settings, 'S3_CACHE_BUCKET_QUOTAS', {})
+# How often, in seconds, a changed access index is written back to disk.
+S3_CACHE_INDEX_SYNC_INTERVAL = getattr(settings, 'S3_CACHE_INDEX_SYNC_INTERVAL', 60)
+
+INDEX_NAME = '.s3dav-index.json'
+
+class ObjectCache(object):
+    '''Keeps track of the files in the local object cache in least recently used
+    order and evicts from the cold end whenever the byte or file budget, or the
+    quota of a bucket, is exceeded.
+
+    The index is kept in memory and saved under the cache root, so the access
+    order survives restarts. If it is missing it is rebuilt from the files on
+    disk, oldest access time first. Every process evicts according to its own
+    view; files it does not know about are adopted the first time they are hit.'''
+    def __init__(self, root, max_bytes=S3_CACHE_MAX_BYTES, max_files=S3_CACHE_MAX_FILES,
+                 quotas=S3_CACHE_BUCKET_QUOTAS, sync_interval=S3_CACHE_INDEX_SYNC_INTERVAL):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.quotas = quotas
+        self.sync_interval = sync_interval
+        self.index_path = os.path.join(root, INDEX_NAME)
+        self._entries = None
+        self._total = 0
+        # Bucket name -> bytes its files take, and its own entries in least
+        # recently used order, for the quotas.
+        self._bucket_bytes = defaultdict(int)
+        self._bucket_entries = defaultdict(OrderedDict)
+        self._dirty = False
+        self._saved = time.time()
+        self._lock = threading.RLock()
+
+    @property
+    def entries(self):
+        '''Relative path -> entry dict, least recently used first. Loaded lazily.'''
+        if self._entries is None:
+            self._load()
+        return self._entries
+
+    @property
+    def total_bytes(self):
+        self.entries
+        return self._total
+
+    def relpath(self, path):
+        return smart_unicode(os.path.relpath(path, self.root))
+
+    def _load(self):
+        entries = None
+        try:
+            with open(self.index_path) as f:
+                entries = OrderedDict((name, entry) for name, entry in json.load(f)['entries'])
+        except (IOError, ValueError, KeyError, TypeError):
+            entries = self._scan()
+        self._entries = OrderedDict()
+        self._total = 0
+        self._bucket_bytes.clear()
+        self._bucket_entries.clear()
+        for name, entry in entries.iteritems():
+            self._put(name, entry)
+
+    def _scan(self):
+        found = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if path == self.index_path or filename.endswith('.part'):
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                found.append((st.st_atime, self.relpath(path), st.st_size))
+        found.sort()
+        return OrderedDict((name, {'size': size, 'atime': atime}) for atime, name, size in found)
+
+    def save(self):
+        with self._lock:
+            if self._entries is None or not self._dirty:
+                return
+            data = {'entries': self._entries.items()}
+            self._dirty = False
+            self._saved = time.time()
+        if not os.path.isdir(self.root):
+            return
+        tmp_path = '%s.%d.tmp' % (self.index_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_path, self.index_path)
+
+    def _put(self, name, entry):
+        '''Insert entry at the hot end.'''
+        bucket = self._bucket_of(name)
+        self.entries[name] = entry
+        self._bucket_entries[bucket][name] = entry
+        self._total += entry['size']
+        self._bucket_bytes[bucket] += entry['size']
+
+    def _pop(self, name):
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            bucket = self._bucket_of(name)
+            bucket_entries = self._bucket_entries[bucket]
+            del bucket_entries[name]
+            if not bucket_entries:
+                del self._bucket_entries[bucket]
+            self._total -= entry['size']
+            self._bucket_bytes[bucket] -= entry['size']
+        return entry
+
+    def _changed(self):
+        self._dirty = True
+        if time.time() - self._saved >= self.sync_interval:
+            self.save()
+
+    def touch(self, path):
+        '''Record a hit on the cached file at path.'''
+        name = self.relpath(path)
+        with self._lock:
+            entry = self._pop(name)
+            adopted = entry is None
+            if adopted:
+                try:
+                    entry = {'size': os.path.getsize(path)}
+                except OSError:
+                    return
+            entry['atime'] = time.time()
+            self._put(name, entry)
+            self._changed()
+        if adopted:
+            self.evict(name)
+
+    def add(self, path, size, **attrs):
+        '''Record a file that has just been written into the cache.'''
+        name = self.relpath(path)
+        with self._lock:
+            self._pop(name)
+            self._put(name, dict(attrs, size=size, atime=time.time()))
+            self._changed()
+        self.evict(name)
+
+    def get(self, path):
+        '''Return the index entry for path, or None.'''
+        with self._lock:
+            return self.entries.get(self.relpath(path))
+
+    def remove(self, path):
+        '''Forget the file at path.'''
+        with self._lock:
+            if self._pop(self.relpath(path)) is not None:
+                self._changed()
+
+    def remove_tree(self, path):
+        '''Forget path and everything below it. Goes through the whole index.'''
+        name = self.relpath(path)
+        prefix = name + os.sep
+        with self._lock:
+            removed = [k for k in self.entries if k == name or k.startswith(prefix)]
+            for key in removed:
+                self._pop(key)
+            if removed:
+                self._changed()
+
+    def _bucket_of(self, name):
+        return name.split(os.sep, 1)[0]
+
+    def evict(self, keep=None):
+        '''Delete least recently used files until every budget is met. keep, the
+        file that was just added or hit, goes last.'''
+        victims = []
+        chosen = set()
+        with self._lock:
+            entries = self.entries
+            # Only walk as far into the cold end as there is something to evict.
+            excess_bytes = self.max_bytes is not None and self._total - self.max_bytes
+            excess_files = self.max_files is not None and len(entries) - self.max_files
+            for name, entry in entries.iteritems():
+                if excess_bytes <= 0 and excess_files <= 0:
+                    break
+                if name != keep:
+                    victims.append(name)
+                    chosen.add(name)
+                    excess_bytes -= entry['size']
+                    excess_files -= 1
+            bucket = keep and self._bucket_of(keep)
+            quota = self.quotas.get(bucket)
+            if quota is not None:
+                excess = self._bucket_bytes[bucket] - quota
+                excess -= sum(entries[name]['size'] for name in victims
+                              if self._bucket_of(name) == bucket)
+                for name, entry in self._bucket_entries.get(bucket, {}).iteritems():
+                    if excess <= 0:
+                        break
+                    if name != keep and name not in chosen:
+                        victims.append(name)
+                        excess -= entry['size']
+            for name in victims:
+                self._pop(name)
+            if victims:
+                self._changed()
+        for name in victims:
+            self._unlink(name)
+        return victims
+
+    def _unlink(self, name):
+        path = os.path.join(self.root, name)
+        try:
+            os.remove(path)
+        except OSError:
+            return
+        # Drop directories left empty, they count against the inode budget too.
+        dirname = os.path.dirname(path)
+        while dirname != self.root and dirname.startswith(self.root):
+            try:
+                os.rmdir(dirname)
+            except OSError:
+                break
+            dirname = os.path.dirname(dirname)
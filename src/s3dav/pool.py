@@ -0,0 +1,85 @@
+import thread
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+
+S3_POOL_MAX_SIZE = getattr(settings, 'S3_POOL_MAX_SIZE', 64)
+S3_POOL_IDLE_TIMEOUT = getattr(settings, 'S3_POOL_IDLE_TIMEOUT', 300)
+
+class ConnectionPool(object):
+    '''Hands out boto connections keyed by credentials and endpoint. boto
+    connections are not safe to share between threads, so every thread gets its
+    own; each connection keeps its HTTP sockets alive for reuse by later requests
+    served by the same thread.
+
+    The pool holds at most max_size connections, dropping the least recently used
+    one beyond that, and closes connections that have been idle for longer than
+    idle_timeout seconds.
+
+    ident names the calling thread. Servers that run many requests on one OS
+    thread, such as bridge.green, pass a function naming the OS thread so its
+    requests share connections.'''
+    def __init__(self, factory, max_size=S3_POOL_MAX_SIZE, idle_timeout=S3_POOL_IDLE_TIMEOUT,
+                 ident=None):
+        self.factory = factory
+        self.ident = ident or thread.get_ident
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._conns = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, aws_key, aws_secret, host, port):
+        '''Return the calling thread's connection for these credentials and endpoint.'''
+        pool_key = (self.ident(), aws_key, aws_secret, host, port)
+        now = time.time()
+        stale = []
+        with self._lock:
+            entry = self._conns.pop(pool_key, None)
+            if entry is not None and now - entry[1] > self.idle_timeout:
+                stale.append(entry[0])
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                conn = None
+            else:
+                self.hits += 1
+                conn = entry[0]
+        if conn is None:
+            conn = self.factory(aws_key, aws_secret, host, port)
+        with self._lock:
+            self._conns[pool_key] = (conn, now)
+            while len(self._conns) > self.max_size:
+                stale.append(self._conns.popitem(last=False)[1][0])
+                self.evictions += 1
+            for idle_key, (idle_conn, last_used) in self._conns.items():
+                if now - last_used <= self.idle_timeout:
+                    break
+                del self._conns[idle_key]
+                stale.append(idle_conn)
+                self.evictions += 1
+        for conn_to_close in stale:
+            conn_to_close.close()
+        return conn
+
+    def stats(self):
+        '''Return usage counters for monitoring.'''
+        with self._lock:
+            return {
+                'size': len(self._conns),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def clear(self):
+        with self._lock:
+            conns = [entry[0] for entry in self._conns.itervalues()]
+            self._conns.clear()
+        for conn in conns:
+            conn.close()
@@ -1,34 +1,150 @@
+import atexit
 import boto
+import calendar
 import os
 import shutil
 import tempfile
 import time
+from cStringIO import StringIO
+from email.utils import formatdate
 import boto.s3.connection
 import boto.s3.key
+from boto.s3.prefix import Prefix
 from dateutil import parser
 import re
 from django.http import HttpResponse, HttpResponseForbidden, HttpResponseNotFound, \
 HttpResponseNotAllowed, HttpResponseBadRequest, HttpResponseNotModified
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from xml.etree import ElementTree
 from s3dav.django_webdav import DavServer, DavResource, safe_join, HttpResponseNoContent
 from s3dav.django_webdav import HttpResponseCreated, url_join
 import s3dav.django_webdav as dw
+from s3dav import download, metrics
+from s3dav.batch import run_concurrently, chunked
+from s3dav.cache import metadata
+from s3dav.models import DeadProperty, path_digest
+from s3dav.objcache import ObjectCache
+from s3dav.pool import ConnectionPool
+from s3dav.upload import MultipartUploader, TeeReader
+from s3dav.writeback import WriteBackJournal
 
 S3_CACHE_DIR=getattr(settings, 'S3_CACHE_DIR', os.path.abspath('cache'))
-
-_conn_pool = {}
-def connect_boto(aws_key, aws_secret):
+# How many server-side copies a COPY or MOVE of a collection runs at once.
+S3_COPY_CONCURRENCY=getattr(settings, 'S3_COPY_CONCURRENCY', 16)
+# Keys per multi-object delete request (S3 accepts at most 1000), and how many
+# such requests a DELETE of a collection runs at once.
+S3_DELETE_BATCH_SIZE=getattr(settings, 'S3_DELETE_BATCH_SIZE', 1000)
+S3_DELETE_CONCURRENCY=getattr(settings, 'S3_DELETE_CONCURRENCY', 8)
+# Keep a copy of uploaded bodies in S3_CACHE_DIR while they stream to S3.
+S3_CACHE_WRITE_THROUGH=getattr(settings, 'S3_CACHE_WRITE_THROUGH', False)
+# Acknowledge a PUT once its body is fsynced to the journal in S3_WRITE_BACK_DIR
+# and upload it from S3_WRITE_BACK_WORKERS background threads. Until then this
+# process serves the pending version. The journal belongs to a single process,
+# bridge.green for instance. DELETE, COPY and MOVE wait up to
+# S3_WRITE_BACK_SETTLE_TIMEOUT seconds for the uploads they touch.
+S3_WRITE_BACK=getattr(settings, 'S3_WRITE_BACK', False)
+S3_WRITE_BACK_DIR=getattr(settings, 'S3_WRITE_BACK_DIR', os.path.abspath('journal'))
+S3_WRITE_BACK_WORKERS=getattr(settings, 'S3_WRITE_BACK_WORKERS', 4)
+S3_WRITE_BACK_SETTLE_TIMEOUT=getattr(settings, 'S3_WRITE_BACK_SETTLE_TIMEOUT', 60)
+# GETs of large objects can be answered with a redirect to a presigned S3 URL,
+# so the body bypasses this server. Maps a bucket name ('*' for any other
+# bucket) to the smallest object size redirected; empty turns it off. Only
+# clients whose User-Agent matches S3_REDIRECT_USER_AGENTS are redirected, as
+# many WebDAV clients do not follow redirects.
+S3_REDIRECT_BUCKETS=getattr(settings, 'S3_REDIRECT_BUCKETS', {})
+S3_REDIRECT_USER_AGENTS=getattr(settings, 'S3_REDIRECT_USER_AGENTS',
+                                (r'Mozilla/', r'curl/', r'Wget/', r'rclone/'))
+REDIRECT_USER_AGENT = re.compile('|'.join(S3_REDIRECT_USER_AGENTS or ['$^']))
+# Seconds a presigned URL stays valid.
+S3_REDIRECT_EXPIRES=getattr(settings, 'S3_REDIRECT_EXPIRES', 300)
+
+# Multi-object delete error codes that map to something better than 500.
+DELETE_ERROR_STATUS = {
+    'AccessDenied': 403,
+    'SlowDown': 503,
+}
+
+objects = ObjectCache(S3_CACHE_DIR)
+atexit.register(objects.save)
+
+def new_boto(aws_key, aws_secret, host=None, port=None):
+    '''Open a new, unshared connection.'''
     #boto.set_stream_logger('boto')
-    s3 = _conn_pool.get(aws_key)
-    if s3 is None:
-        s3 =  boto.connect_s3(aws_access_key_id=aws_key,
-                              aws_secret_access_key=aws_secret,
-                              host=settings.AWS_HOST,
-                              port=settings.AWS_PORT,
-                              is_secure=False,
-                              calling_format=boto.s3.connection.OrdinaryCallingFormat())
-        _conn_pool[aws_key] = s3
-    return s3
+    return metrics.MeteredS3Connection(aws_access_key_id=aws_key,
+                                       aws_secret_access_key=aws_secret,
+                                       host=host or settings.AWS_HOST,
+                                       port=port or settings.AWS_PORT,
+                                       is_secure=False,
+                                       calling_format=boto.s3.connection.OrdinaryCallingFormat())
+
+connection_pool = ConnectionPool(new_boto)
+metrics.register_gauges('s3dav_connection_pool', connection_pool.stats)
+metrics.register_gauges('s3dav_object_cache',
+                        lambda: {'bytes': objects.total_bytes, 'files': len(objects.entries)})
+def connect_boto(aws_key, aws_secret):
+    '''Return a pooled connection for use by the calling thread only.'''
+    return connection_pool.get(aws_key, aws_secret, settings.AWS_HOST, settings.AWS_PORT)
+
+def upload_pending(entry):
+    '''Store a journaled body in S3.'''
+    connect = lambda: connect_boto(entry.aws_key, entry.aws_secret)
+    key = connect().get_bucket(entry.bucket, validate=False).new_key(entry.key)
+    with open(entry.path, 'rb') as f:
+        MultipartUploader(key, connect=connect).upload(f)
+    return key
+
+def pending_uploaded(entry, key):
+    '''Keep the body of a finished upload as the cached copy of the object.'''
+    metadata.forget(entry.bucket, entry.key)
+    path = safe_join(S3_CACHE_DIR, '%s/%s' % (entry.bucket, entry.key))
+    objects.remove(path)
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        os.rename(entry.path, path)
+    except OSError:
+        # Another filesystem, or a directory in the way. Read from S3 next time.
+        return
+    objects.add(path, entry.size, etag=key.etag)
+
+journal = None
+if S3_WRITE_BACK:
+    journal = WriteBackJournal(S3_WRITE_BACK_DIR, upload_pending, pending_uploaded,
+                               workers=S3_WRITE_BACK_WORKERS).start()
+metrics.register_gauges('s3dav_write_back', lambda: journal and journal.stats() or {})
+
+def pending_key(bucket, entry):
+    '''Return a key standing for the journaled version of an object.'''
+    key = bucket.new_key(entry.key)
+    key.size, key.etag = entry.size, entry.etag
+    key.last_modified = formatdate(entry.mtime, usegmt=True)
+    key.pending = entry
+    return key
+
+def resolve_key(bucket, key_name):
+    '''Return the key for key_name, treating prefixes that only exist implicitly
+    (no marker object) as directories. A name without a trailing slash that turns
+    out to be a directory resolves to the key of its prefix. Names found missing
+    are remembered for S3_NEGATIVE_CACHE_TTL, so clients probing for the same
+    file over and over cost no requests to S3. A version still waiting in the
+    write-back journal wins over S3.'''
+    if journal is not None:
+        entry = journal.get(bucket.name, key_name)
+        if entry is not None:
+            return pending_key(bucket, entry)
+    if metadata.is_missing(bucket.name, key_name):
+        return None
+    if key_name.endswith('/'):
+        key = metadata.lookup_prefix(bucket, key_name)
+    else:
+        key = metadata.lookup_key(bucket, key_name)
+        if key is None:
+            key = metadata.lookup_prefix(bucket, key_name + '/')
+    if key is None:
+        metadata.add_missing(bucket.name, key_name)
+    return key
 
 class S3DavRootResource(DavResource):
     def __init__(self, server):
@@ -50,6 +166,7 @@ class S3DavRootResource(DavResource):
         s3 = self.server.get_s3_connection()
         all_buckets = s3.get_all_buckets()
         for bucket in all_buckets:
+            metadata.add_bucket(self.server.request.aws_key, bucket.name)
             yield S3DavResource(self.server, bucket, None)
 
     def mkdir(self):
@@ -64,7 +181,7 @@ class S3DavRootResource(DavResource):
 
 
 class S3DavResource(DavResource):
-    _parent_key = None
+    _parent = None
 
     def __init__(self, server, bucket, key, key_name=''):
         if key:
@@ -82,6 +199,20 @@ class S3DavResource(DavResource):
         else:
             self.key_name = key_name
 
+    @property
+    def pending(self):
+        '''The write-back journal entry of this object, if it has not reached S3.'''
+        return getattr(self.key, 'pending', None)
+
+    def settle(self, discard=False):
+        '''Wait until the write-back uploads of this resource and of everything
+        below it are in S3, or with discard drop those not being uploaded yet.'''
+        if journal is None:
+            return
+        if not journal.settle(self.bucket.name, self.key_name, discard,
+                              timeout=S3_WRITE_BACK_SETTLE_TIMEOUT):
+            raise dw.HttpBadGateway()
+
     @property
     def cache_path(self):
         return safe_join(S3_CACHE_DIR, self.path)
@@ -89,21 +220,84 @@ class S3DavResource(DavResource):
     def get_abs_path(self):
         return self.cache_path
 
-    def put_file(self):
+    def get_upload_key(self):
         if self.key:
-            key = self.key
-        else:
-            key = boto.s3.key.Key(bucket=self.bucket)
-            key.key = self.key_name
+            return self.key
+        return self.bucket.new_key(self.key_name)
 
+    def put_file(self):
         with self.open('u') as f:
-            key.set_contents_from_file(f)
+            self.upload(f)
+
+    def upload(self, stream):
+        '''Upload the content of stream, as a multipart upload when it is larger than
+        one part.'''
+        key = self.get_upload_key()
+        uploader = MultipartUploader(key, connect=self.server.get_s3_connection)
+        try:
+            size = uploader.upload(stream)
+        finally:
+            metadata.forget(self.bucket.name, key.key)
+        self.key = key
+        return size
+
+    def write(self, stream):
+        '''Upload the request body in stream while it arrives. Only bounded
+        in-memory buffers are used; the body touches the local disk only when
+        S3_CACHE_WRITE_THROUGH asks for a copy to be kept in the cache. In write-back
+        mode the body goes to the journal instead, to be uploaded later.'''
+        if journal is not None:
+            self.discard_cache()
+            entry = journal.add(self.bucket.name, self.key_name, self.server.request.aws_key,
+                                self.server.request.aws_secret, stream)
+            metadata.forget(self.bucket.name, self.key_name)
+            self.key = pending_key(self.bucket, entry)
+            return entry.size
+        if not S3_CACHE_WRITE_THROUGH:
+            self.discard_cache()
+            return self.upload(stream)
+        try:
+            with self.open('w') as f:
+                size = self.upload(TeeReader(stream, f))
+        except:
+            self.discard_cache()
+            raise
+        objects.add(self.get_abs_path(), size, etag=self.key.etag)
+        return size
+
+    def discard_cache_tree(self):
+        '''Remove the cached copies of everything below this directory.'''
+        abspath = self.get_abs_path()
+        objects.remove_tree(abspath)
+        if os.path.isdir(abspath):
+            shutil.rmtree(abspath, ignore_errors=True)
+
+    def discard_cache(self):
+        '''Remove the cached copy of this file, if any.'''
+        abspath = self.get_abs_path()
+        objects.remove(abspath)
+        if os.path.isfile(abspath):
+            try:
+                os.remove(abspath)
+            except OSError:
+                import traceback
+                traceback.print_exc()
 
     def get_url(self):
-        relpath = '/%s/%s' % (self.bucket.name, self.key_name)
+        return self.get_key_url(self.key_name)
+
+    def get_key_url(self, key_name):
+        '''Return the url of key_name in this resource's bucket.'''
+        relpath = '/%s/%s' % (self.bucket.name, key_name)
         return url_join(self.server.request.get_base_url(), relpath)
 
     def open(self, mode):
+        if self.pending and 'r' in mode:
+            try:
+                return open(self.pending.path, mode)
+            except IOError:
+                # Uploaded meanwhile, and its body moved to the cache.
+                pass
         abspath = self.get_abs_path()
         if self.key and ('r' in mode):
             need_fetch = False
@@ -117,13 +311,11 @@ class S3DavResource(DavResource):
                         import traceback
                         traceback.print_exc()
                     need_fetch = True
-            elif not self.isdir() and os.stat(abspath).st_mtime < self.get_mtime_stamp():
+            elif not self.isdir() and not self.is_cached():
                 need_fetch = True
 
             if need_fetch:
-                f = open(abspath, 'wb')
-                self.key.get_contents_to_file(f)
-                f.close()
+                self.fetch().wait()
 
         if mode == 'u':
             mode = 'r'
@@ -134,6 +326,81 @@ class S3DavResource(DavResource):
                 os.makedirs(dirname)
         return super(S3DavResource, self).open(mode)
         
+    def fetch(self):
+        '''Start, or join, the download of this object into the cache.'''
+        return download.fetch(self.bucket, self.key_name, self.get_abs_path(),
+                              connect=self.server.get_s3_connection, callback=objects.add)
+
+    def iter_content(self):
+        '''Stream the object to the client while it is being downloaded into the
+        cache, rather than after the download has finished.'''
+        if not self.key or self.pending or self.is_cached():
+            return super(S3DavResource, self).iter_content()
+        dirname = os.path.dirname(self.get_abs_path())
+        if not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Another request created it in the meantime.
+                pass
+        return self.fetch().follow()
+
+    def get_local_path(self):
+        '''Only a cached copy of this very version of the object counts, or the
+        body of a pending upload.'''
+        if self.pending:
+            return self.pending.path
+        if self.key and self.is_cached():
+            return self.get_abs_path()
+        return None
+
+    def get_sendfile_path(self):
+        '''The journal is not meant to be exposed to the front proxy.'''
+        if self.pending:
+            return None
+        return self.get_local_path()
+
+    def is_cached(self):
+        '''Return True if the cache holds a copy of this very version of the object,
+        going by the ETag and size recorded in the cache index, and count that as a
+        use of the copy.'''
+        if not self.key or not self.key.etag:
+            return False
+        abspath = self.get_abs_path()
+        entry = objects.get(abspath)
+        if entry is None or entry.get('etag') != self.key.etag or entry['size'] != self.key.size:
+            metrics.record_cache('object', False)
+            return False
+        if not os.path.isfile(abspath):
+            objects.remove(abspath)
+            metrics.record_cache('object', False)
+            return False
+        objects.touch(abspath)
+        metrics.record_cache('object', True)
+        return True
+
+    def read_range(self, start, end):
+        '''Serve a byte range from the cached copy when there is a fresh one, and
+        with a ranged GET against S3 otherwise, so only the requested bytes are
+        transferred.'''
+        if self.pending or self.is_cached():
+            return super(S3DavResource, self).read_range(start, end)
+        return self._read_remote_range(start, end)
+
+    def _read_remote_range(self, start, end):
+        # A separate key object, open_read() overwrites size and the like from the
+        # partial response headers.
+        key = self.bucket.new_key(self.key_name)
+        key.open_read(headers={'Range': 'bytes=%d-%d' % (start, end)})
+        try:
+            while True:
+                data = key.read(dw.BLOCK_SIZE)
+                if not data:
+                    break
+                yield data
+        finally:
+            key.close()
+
     def isdir(self):
         if not self.exists():
             return False
@@ -156,55 +423,74 @@ class S3DavResource(DavResource):
         if self.key:
             return True
         elif self.key_name:
-            self.key = self.bucket.get_key(self.key_name)
-            if not self.key:
-                return False
+            self.key = resolve_key(self.bucket, self.key_name)
+            return bool(self.key)
         else:
             return True
 
+    def get_prefix(self):
+        '''Return the key prefix under which the children of this resource live.'''
+        if not self.key_name:
+            return ''
+        if self.key_name.endswith('/'):
+            return self.key_name
+        return self.key_name + '/'
+
     def get_children(self):
-        children = []
-        if not self.key:
-            for key in self.bucket.get_all_keys():
-                idx = key.key.find('/')
-                if idx < 0 or idx == len(key.key) - 1:
-                    children.append(self.__class__(self.server, self.bucket, key))
-        elif self.isdir():
-            for key in self.bucket.list(self.key.key):
-                child_keyname = key.key[len(self.key.key):]
-                if not child_keyname or child_keyname.startswith('/'):
-                    continue
-                children.append(self.__class__(self.server, self.bucket, key))
-        #print 'children of', self.path, 'is', [(c.isdir(), c.path) for c in children]
-        return children
-    
+        '''Iterate over direct children only. The listing uses S3's delimiter so nested
+        keys are folded into common prefixes on the server side, and boto pages
+        through truncated results by marker, so the cost is proportional to the
+        number of direct children rather than the size of the bucket.'''
+        if not self.isdir():
+            return
+        prefix = self.get_prefix()
+        pending = journal and journal.children(self.bucket.name, prefix) or {}
+        for item in self.bucket.list(prefix=prefix, delimiter='/'):
+            if isinstance(item, Prefix):
+                # A "directory" that may or may not have a marker key.
+                key = self.bucket.new_key(item.name)
+                metadata.add_prefix(self.bucket.name, item.name)
+            elif item.name == prefix:
+                # The directory marker of this very folder.
+                continue
+            elif item.name in pending:
+                key = pending_key(self.bucket, pending.pop(item.name))
+            else:
+                key = item
+                metadata.add_key(key)
+            yield self.__class__(self.server, self.bucket, key)
+        # Files written since that are not in S3 yet.
+        for name in sorted(pending):
+            yield self.__class__(self.server, self.bucket, pending_key(self.bucket, pending[name]))
+
     def get_parent(self):
         '''Return a DavResource for this resource's parent.'''
-        if not self.key:
+        if not self.key_name:
             return S3DavRootResource(self.server)
-        if self._parent_key:
-            return self._parent_key
-        parent_key_name = re.sub(r'[^/]+/?$', '', self.key.key)
-        if parent_key_name:
-            self._parent_key = self.bucket.get_key(parent_key_name)
-        else:
-            self._parent_key = None
-        return self.__class__(self.server, self.bucket, self._parent_key)
+        if self._parent is None:
+            parent_key_name = re.sub(r'[^/]+/?$', '', self.key_name)
+            if parent_key_name:
+                parent_key = resolve_key(self.bucket, parent_key_name)
+            else:
+                parent_key = None
+            self._parent = self.__class__(self.server, self.bucket, parent_key,
+                                          key_name=parent_key_name)
+        return self._parent
 
     def get_ctime_stamp(self):
         return self.get_mtime_stamp()
 
     def get_mtime_stamp(self):
-        if self.key:
+        if self.key and self.key.last_modified:
             d = parser.parse(self.key.last_modified)
-            tm = int(time.mktime(d.timetuple()))
+            tm = calendar.timegm(d.utctimetuple())
             return tm
         else:
             return int(time.time() - 1)
 
     def get_size(self):
         if self.key:
-            return self.key.size
+            return self.key.size or 0
         return 0
 
     def get_etag(self):
@@ -212,72 +498,293 @@ class S3DavResource(DavResource):
             return self.key.etag
 
     def delete(self):
-        super(S3DavResource, self).delete()
-        if self.key:
-            self.key.delete()
+        '''Delete this resource. A collection is listed once, recursively, and its
+        keys are removed with multi-object deletes. Returns (url, status) pairs for
+        the keys that could not be deleted.'''
+        self.settle(discard=True)
+        if not self.isdir():
+            self.discard_cache()
+            if self.key:
+                self.key.delete()
+            metadata.forget(self.bucket.name, self.key_name)
+            return []
+        names = (key.name for key in self.bucket.list(prefix=self.get_prefix()))
+        failures = self._delete_keys(names)
+        self.discard_cache_tree()
+        metadata.forget_prefix(self.bucket.name, self.get_prefix())
+        metadata.forget(self.bucket.name, self.key_name)
+        return [(self.get_key_url(name), status) for name, status in failures]
+
+    def _delete_keys(self, names):
+        '''Delete the keys in names, S3_DELETE_BATCH_SIZE per request with up to
+        S3_DELETE_CONCURRENCY requests in flight. Returns (key name, status) pairs
+        for the keys S3 refused to delete.'''
+        bucket_name = self.bucket.name
+        failures = []
+
+        def delete_batch(batch):
+            s3 = self.server.get_s3_connection()
+            result = s3.get_bucket(bucket_name, validate=False).delete_keys(batch, quiet=True)
+            for error in result.errors:
+                if error.code == 'NoSuchKey':
+                    continue
+                failures.append((error.key, DELETE_ERROR_STATUS.get(error.code, 500)))
+
+        batches = chunked(names, S3_DELETE_BATCH_SIZE)
+        for batch, e in run_concurrently(delete_batch, batches, S3_DELETE_CONCURRENCY):
+            failures.extend((name, getattr(e, 'status', 500)) for name in batch)
+        return failures
+
+    def create_empty(self):
+        self.write(StringIO(''))
 
     def mkdir(self):
         if not self.key_name.endswith('/'):
             self.key_name = self.key_name + '/'
-        key = boto.s3.key.Key(bucket=self.bucket)
-        key.key = self.key_name
+        key = self.bucket.new_key(self.key_name)
         key.set_contents_from_string('')
+        metadata.forget(self.bucket.name, self.key_name)
 
     def copy(self, destination, depth=0):
-        '''Called to copy a resource to a new location. Overwrite is assumed, the DAV server
-        will refuse to copy to an existing resource otherwise. This method needs to gracefully
-        handle a pre-existing destination of any type. It also needs to respect the depth 
-        parameter. depth == -1 is infinity.'''
-        if self.isdir():
-            if destination.isfile():
-                destination.delete()
-            if not destination.isdir():
-                destination.mkdir()
-            # If depth is less than 0, then it started out as -1.
-            # We need to keep recursing until we hit 0, or forever
-            # in case of infinity.
-            if depth != 0:
-                for child in self.get_children():
-                    child.copy(self.__class__(self.server, safe_join(destination.get_path(), child.get_name())), depth=depth-1)
-        else:
+        '''Copy this resource to destination with server-side S3 copies. A
+        collection is listed once, recursively, and its keys are copied on a
+        bounded pool of threads. Returns (url, status) pairs for the keys that
+        could not be copied.'''
+        self.settle()
+        destination.settle(discard=True)
+        if not self.isdir():
             if destination.isdir():
                 destination.delete()
             self.key.copy(destination.bucket.name, destination.key_name)
+            metadata.forget(destination.bucket.name, destination.key_name)
+            return []
+        if destination.isfile():
+            destination.delete()
+        if not destination.isdir():
+            destination.mkdir()
+        if depth == 0:
+            return []
+        return self._copy_tree(destination)
 
     def move(self, destination):
-        if self.isdir():
-            if destination.exist() and not destination.isdir():
-                destination.delete()
-            destination.mkdir()
-            for child in self.get_children():
-                child.move(self.__class__(self.server, safe_join(destination.get_path(), child.get_name())))
-            self.delete()
-        elif self.key:
+        '''Move this resource to destination. S3 cannot rename, so every key is
+        copied and the original deleted once its copy succeeded.'''
+        self.settle()
+        destination.settle(discard=True)
+        if not self.isdir():
             self.key.copy(destination.bucket.name, destination.key_name)
             self.key.delete()
-        else:
-            print 'No source key', self.key_name
+            metadata.forget(destination.bucket.name, destination.key_name)
+            metadata.forget(self.bucket.name, self.key_name)
+            self.discard_cache()
+            return []
+        if destination.exists() and not destination.isdir():
+            destination.delete()
+        errors = self._copy_tree(destination, move=True)
+        metadata.forget_prefix(self.bucket.name, self.get_prefix())
+        metadata.forget(self.bucket.name, self.key_name)
+        self.discard_cache_tree()
+        return errors
+
+    def _copy_tree(self, destination, move=False):
+        src_bucket, src_prefix = self.bucket.name, self.get_prefix()
+        dst_bucket, dst_prefix = destination.bucket.name, destination.get_prefix()
+
+        def pairs():
+            for key in self.bucket.list(prefix=src_prefix):
+                if src_bucket == dst_bucket and key.name.startswith(dst_prefix):
+                    # Copies made into a destination inside the source itself.
+                    continue
+                yield key.name, dst_prefix + key.name[len(src_prefix):]
+
+        copied = []
+        def copy_key((src_name, dst_name)):
+            s3 = self.server.get_s3_connection()
+            s3.get_bucket(dst_bucket, validate=False).copy_key(dst_name, src_bucket, src_name)
+            copied.append(src_name)
+
+        failures = run_concurrently(copy_key, pairs(), S3_COPY_CONCURRENCY)
+        metadata.forget_prefix(dst_bucket, dst_prefix)
+        errors = [(destination.get_key_url(dst_name), getattr(e, 'status', 500))
+                  for (src_name, dst_name), e in failures]
+        if move:
+            # Only the originals of keys that made it to the destination go.
+            errors.extend((self.get_key_url(name), status)
+                          for name, status in self._delete_keys(copied))
+        return errors
+
+class S3DavProperty(dw.DavProperty):
+    '''Keeps dead properties in the DeadProperty table, keyed by bucket and key
+    name. The properties of a listing are loaded with one query per batch of
+    resources and kept for the rest of the request.'''
+    def __init__(self, server):
+        super(S3DavProperty, self).__init__(server)
+        self._dead = {}
+
+    def get_ident(self, res):
+        bucket, sep, key = res.get_path().strip('/').partition('/')
+        return bucket, key
+
+    def tree_filter(self, bucket, key, depth=-1):
+        '''Return a filter matching the properties of key and, unless depth is 0,
+        of everything below it.'''
+        if depth == 0:
+            return Q(digest=path_digest(bucket, key))
+        if not key:
+            return Q(bucket=bucket)
+        return Q(digest=path_digest(bucket, key)) | Q(bucket=bucket, key__startswith=key + '/')
+
+    def prefetch(self, resources):
+        wanted = {}
+        for res in resources:
+            bucket, key = ident = self.get_ident(res)
+            if bucket and ident not in self._dead:
+                wanted.setdefault(bucket, []).append(key)
+                self._dead[ident] = {}
+        for bucket, keys in wanted.iteritems():
+            digests = [path_digest(bucket, name) for name in keys]
+            for prop in DeadProperty.objects.filter(digest__in=digests):
+                self._dead[(bucket, prop.key)][prop.name] = prop.value
+
+    def _get_dead(self, res):
+        ident = self.get_ident(res)
+        if ident not in self._dead:
+            self.prefetch([res])
+        return self._dead.get(ident, {})
+
+    def get_dead_names(self, res):
+        return self._get_dead(res).keys()
+
+    def get_dead_value(self, res, name):
+        value = self._get_dead(res).get(name)
+        if value is not None:
+            return ElementTree.fromstring(value)
+
+    def set_dead_value(self, res, name, value):
+        bucket, key = self.get_ident(res)
+        if not bucket:
+            raise dw.HttpForbidden('Properties cannot be set on the root.')
+        if not DeadProperty.objects.filter(digest=path_digest(bucket, key), name=name).update(value=value):
+            DeadProperty.objects.create(bucket=bucket, key=key, name=name, value=value)
+        self._dead.pop((bucket, key), None)
+
+    def del_dead_prop(self, res, name):
+        bucket, key = self.get_ident(res)
+        DeadProperty.objects.filter(digest=path_digest(bucket, key), name=name).delete()
+        self._dead.pop((bucket, key), None)
+
+    def get_digests(self, paths):
+        '''Return the digests of paths and of the collections holding them.'''
+        digests = set()
+        for path in paths:
+            bucket, sep, key = path.partition('/')
+            parts = key.split('/')
+            digests.update(path_digest(bucket, '/'.join(parts[:i])) for i in range(len(parts) + 1))
+        return digests
+
+    def del_props(self, res, *names, **kwargs):
+        '''Without names, drop the properties of res and of all its members, but
+        those of the paths in keep and the collections holding them.'''
+        if names:
+            return super(S3DavProperty, self).del_props(res, *names, **kwargs)
+        bucket, key = self.get_ident(res)
+        if bucket:
+            props = DeadProperty.objects.filter(self.tree_filter(bucket, key))
+            keep = kwargs.get('keep')
+            if keep:
+                props = props.exclude(digest__in=self.get_digests(keep))
+            props.delete()
+        self._dead.clear()
+
+    def copy_props(self, src, dst, *names, **kwargs):
+        '''Copy, or with move=True move, the properties of src and of its members
+        down to the given depth to dst, replacing those dst had. Paths in failed,
+        relative to the root, were not copied or moved: they are skipped, and on a
+        move they and the collections holding them keep their properties.'''
+        move = kwargs.get('move', False)
+        depth = kwargs.get('depth', -1)
+        failed = kwargs.get('failed', ())
+        src_bucket, src_key = self.get_ident(src)
+        dst_bucket, dst_key = self.get_ident(dst)
+        if not src_bucket or not dst_bucket:
+            return
+        with transaction.commit_on_success():
+            DeadProperty.objects.filter(self.tree_filter(dst_bucket, dst_key, depth)).delete()
+            props = DeadProperty.objects.filter(self.tree_filter(src_bucket, src_key, depth))
+            skipped = set()
+            for path in failed:
+                bucket, sep, key = path.partition('/')
+                skipped.add(path_digest(bucket, key))
+            copies = []
+            for prop in props:
+                if prop.digest in skipped:
+                    continue
+                rel = prop.key[len(src_key):].lstrip('/') if src_key else prop.key
+                key = '/'.join(part for part in (dst_key, rel) if part)
+                copies.append(DeadProperty(bucket=dst_bucket, key=key, digest=path_digest(dst_bucket, key),
+                                           name=prop.name, value=prop.value))
+            if move:
+                if failed:
+                    props = props.exclude(digest__in=self.get_digests(failed))
+                props.delete()
+            DeadProperty.objects.bulk_create(copies)
+        self._dead.clear()
+
+    def patch_props(self, res, updates):
+        with transaction.commit_on_success():
+            super(S3DavProperty, self).patch_props(res, updates)
+
 
 class S3DavServer(DavServer):
     def __init__(self, request, path, **kw):
+        kw.setdefault('property_class', S3DavProperty)
         super(S3DavServer, self).__init__(request, path, **kw)
         self.resource_class = S3DavResource
 
     def get_s3_connection(self):
+        '''Return a connection for the calling thread, which may be a worker of
+        this request rather than the thread serving it. The calls made through it
+        are charged to this request.'''
+        metrics.activate(getattr(self.request, 'dav_stats', None))
         return connect_boto(self.request.aws_key, self.request.aws_secret)
 
+
     def get_access(self, path):
         if path in ('', '/', S3_CACHE_DIR):
             return self.acl_class(read=True, list=True)
         return self.acl_class(all=True)
 
-    def doLOCK(self):
-        # FIXME: implement an exclusive or shared lock
-        return HttpResponse(status=200)
-
-    def doUNLOCK(self):
-        # FIXME: implement an exclusive or shared lock
-        return HttpResponse(status=200)
+    def doGET(self, head=False):
+        if not head and S3_REDIRECT_BUCKETS:
+            res = self.get_resource(self.request.path)
+            if self.should_redirect(res):
+                if not self.get_access(res.get_abs_path()).read:
+                    return HttpResponseForbidden()
+                return self.get_redirect_response(res)
+        return super(S3DavServer, self).doGET(head)
+
+    def should_redirect(self, res):
+        '''Return True if a GET of res should be sent to S3 directly.'''
+        if not isinstance(res, S3DavResource) or not res.isfile():
+            return False
+        if res.pending:
+            # Not in S3 yet.
+            return False
+        min_size = S3_REDIRECT_BUCKETS.get(res.bucket.name, S3_REDIRECT_BUCKETS.get('*'))
+        if min_size is None or res.get_size() < min_size:
+            return False
+        return bool(REDIRECT_USER_AGENT.match(self.request.META.get('HTTP_USER_AGENT', '')))
+
+    def get_redirect_response(self, res):
+        '''Send the client to a presigned URL of the object. The client repeats
+        its Range and conditional headers there, and S3 answers them.'''
+        url = res.key.generate_url(S3_REDIRECT_EXPIRES, method='GET', response_headers={
+            'response-content-type': self.get_content_type(res),
+        })
+        response = HttpResponse(status=307)
+        response['Location'] = url
+        response['Cache-Control'] = 'no-store'
+        return response
 
     def doPUT(self):
         res = self.get_resource(self.request.path)
@@ -288,12 +795,11 @@ class S3DavServer(DavServer):
         acl = self.get_access(res.get_abs_path())
         if not acl.write:
             return HttpResponseForbidden()
+        self.check_locks(res)
 
         created = not res.exists()
 
-        with res.open('w') as f:
-            shutil.copyfileobj(self.request, f)
-        res.put_file()
+        res.write(self.request)
         if created:
             return HttpResponseCreated()
         else:
@@ -309,11 +815,13 @@ class S3DavServer(DavServer):
             key_name = m.group('key')
             key_name = re.sub(r'/+', '/', key_name)
             s3 = self.get_s3_connection()
-            bucket = s3.get_bucket(bucket_name)
+            bucket = metadata.lookup_bucket(s3, self.request.aws_key, bucket_name)
             if key_name:
-                key = bucket.get_key(key_name)
+                key = resolve_key(bucket, key_name)
             else:
                 key = None
+            if key:
+                key_name = key.name
             return S3DavResource(self, bucket, key, key_name=key_name)
         assert False
 
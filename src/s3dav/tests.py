@@ -1,11 +1,59 @@
 """
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
-
-Replace this with more appropriate tests for your application.
+Tests for the s3dav application. S3 is replaced by in-memory fakes so the
+suite runs offline with "manage.py test s3dav".
 """
 
+import base64
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+from cStringIO import StringIO
+from unittest import skipIf
+from wsgiref.util import FileWrapper
+from xml.etree import ElementTree
+
+from boto.s3.bucket import Bucket
+from boto.s3.key import Key
+from boto.s3.multidelete import MultiDeleteResult, Error
+from boto.s3.prefix import Prefix
+from boto.exception import S3ResponseError
+from boto.resultset import ResultSet
+from django.contrib.auth.models import User
+from django.core.cache import get_cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.http import Http404
 from django.test import TestCase
+from django.test.client import Client, RequestFactory
+from django.test.utils import override_settings
+
+from s3dav.cache import TTLCache, credentials, metadata
+from s3dav.models import DeadProperty, S3Account, path_digest
+from s3dav import django_webdav, metrics
+from s3dav.django_webdav import BLOCK_SIZE, FileHttpResponse, serve_files
+from s3dav.django_webdav import DavCacheLockStore, DavLock, DavLockStore, DavProperty, DavResource
+from s3dav.django_webdav import DavServer, HttpLocked, HttpServiceUnavailable, merge_ranges, parse_range
+from s3dav import fakes3
+from s3dav.objcache import ObjectCache
+from s3dav.pool import ConnectionPool
+from s3dav import server, writeback
+from s3dav.server import S3DavProperty, S3DavResource, resolve_key
+from s3dav.upload import MultipartUploader
+try:
+    import gevent
+except ImportError:
+    gevent = None
+
+from s3dav.writeback import WriteBackJournal
+from s3dav.views import credentials_key, export, is_junk, simple_auth, webdav_export
 
 
 class SimpleTest(TestCase):
@@ -14,3 +62,1306 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+def fake_etag(data):
+    return '"%s"' % hashlib.md5(data).hexdigest()
+
+
+class FakeKey(Key):
+    def set_contents_from_string(self, data):
+        self.bucket.calls.append(('put', self.name))
+        self.bucket.contents[self.name] = data
+        self.etag = fake_etag(data)
+
+    def open_read(self, headers=None):
+        self.bucket.calls.append(('get', self.name, headers))
+        data = self.bucket.contents[self.name]
+        if headers and 'Range' in headers:
+            start, end = headers['Range'][len('bytes='):].split('-')
+            data = data[int(start):int(end) + 1]
+        else:
+            self.etag = fake_etag(data)
+        self.resp = StringIO(data)
+
+    def read(self, size=0):
+        return self.resp.read(size)
+
+    def close(self):
+        self.resp = None
+
+
+class FakeMultiPartUpload(object):
+    def __init__(self, bucket, key_name):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.parts = {}
+        self.failures = 0
+
+    def upload_part_from_file(self, fp, part_num):
+        if self.failures:
+            self.failures -= 1
+            raise IOError('connection reset')
+        self.parts[part_num] = fp.read()
+
+    def complete_upload(self):
+        self.bucket.calls.append(('complete', self.key_name))
+        data = ''.join(self.parts[n] for n in sorted(self.parts))
+        self.bucket.contents[self.key_name] = data
+        completed = FakeKey(self.bucket, self.key_name)
+        completed.etag = fake_etag(data)
+        return completed
+
+    def cancel_upload(self):
+        self.bucket.calls.append(('cancel', self.key_name))
+
+
+class FakeBucket(Bucket):
+    '''A bucket whose listings are served from a dict of key name -> body,
+    paginated by page_size so the marker handling gets exercised.'''
+    page_size = 2
+
+    def __init__(self, name, contents):
+        super(FakeBucket, self).__init__(None, name, key_class=FakeKey)
+        self.contents = dict(contents)
+        self.calls = []
+        self.fail = set()
+
+    def get_all_keys(self, headers=None, **params):
+        self.calls.append(('list', params))
+        prefix = params.get('prefix') or ''
+        delimiter = params.get('delimiter') or ''
+        marker = params.get('marker') or ''
+        entries = []
+        for name in sorted(self.contents):
+            if not name.startswith(prefix):
+                continue
+            rest = name[len(prefix):]
+            folded = bool(delimiter) and delimiter in rest
+            if folded:
+                name = prefix + rest[:rest.index(delimiter) + 1]
+            if name <= marker or (entries and entries[-1][0] == name):
+                continue
+            entries.append((name, folded))
+        page_size = min(self.page_size, params.get('max_keys') or self.page_size)
+        rs = ResultSet()
+        for name, is_prefix in entries[:page_size]:
+            if is_prefix:
+                rs.append(Prefix(self, name))
+            else:
+                key = Key(self, name)
+                key.size = len(self.contents[name])
+                key.etag = fake_etag(self.contents[name])
+                key.last_modified = 'Mon, 01 Jan 2024 00:00:00 GMT'
+                rs.append(key)
+        rs.is_truncated = len(entries) > page_size
+        return rs
+
+    def initiate_multipart_upload(self, key_name):
+        self.calls.append(('initiate', key_name))
+        self.upload = FakeMultiPartUpload(self, key_name)
+        return self.upload
+
+    def copy_key(self, new_key_name, src_bucket_name, src_key_name):
+        self.calls.append(('copy', src_key_name, new_key_name))
+        if src_key_name in self.fail:
+            raise S3ResponseError(403, 'Forbidden')
+        self.contents[new_key_name] = self.contents[src_key_name]
+
+    def delete_key(self, key_name):
+        self.calls.append(('delete', key_name))
+        del self.contents[key_name]
+
+    def delete_keys(self, keys, quiet=False):
+        self.calls.append(('delete_keys', list(keys)))
+        result = MultiDeleteResult(self)
+        for name in keys:
+            if name in self.fail:
+                result.errors.append(Error(name, code='AccessDenied'))
+            else:
+                self.contents.pop(name, None)
+        return result
+
+    def get_key(self, key_name, headers=None, version_id=None,
+                response_headers=None, validate=True):
+        self.calls.append(('head', key_name))
+        if key_name not in self.contents:
+            return None
+        key = Key(self, key_name)
+        key.size = len(self.contents[key_name])
+        key.etag = fake_etag(self.contents[key_name])
+        return key
+
+
+class FakeServer(object):
+    get_s3_connection = None
+
+    def get_root(self):
+        return '/'
+
+
+class FakeS3(object):
+    def __init__(self, *buckets):
+        self.buckets = dict((b.name, b) for b in buckets)
+
+    def get_bucket(self, name, validate=True):
+        return self.buckets[name]
+
+
+class FakeRequest(object):
+    def get_base_url(self):
+        return 'http://testserver'
+
+
+class FakeS3Server(FakeServer):
+    '''A server whose worker threads reach the fake buckets through
+    get_s3_connection.'''
+    request = FakeRequest()
+
+    def __init__(self, *buckets):
+        self.s3 = FakeS3(*buckets)
+
+    def get_s3_connection(self):
+        return self.s3
+
+
+class S3DavResourceTest(TestCase):
+    def setUp(self):
+        self.bucket = FakeBucket('bkt', {
+            'a.txt': 'a',
+            'b.txt': 'bb',
+            'dir/': '',
+            'dir/x.txt': 'x',
+            'dir/sub/y.txt': 'y',
+            'nomarker/z.txt': 'z',
+        })
+        self.server = FakeServer()
+        metadata.clear()
+
+    def use_cache_dir(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.addCleanup(setattr, server, 'S3_CACHE_DIR', server.S3_CACHE_DIR)
+        self.addCleanup(setattr, server, 'objects', server.objects)
+        server.S3_CACHE_DIR = cache_dir
+        server.objects = ObjectCache(cache_dir)
+        return cache_dir
+
+    def test_bucket_root_children(self):
+        res = S3DavResource(self.server, self.bucket, None)
+        names = [(c.key_name, c.isdir()) for c in res.get_children()]
+        self.assertEqual(names, [('a.txt', False), ('b.txt', False),
+                                 ('dir/', True), ('nomarker/', True)])
+        # Four entries at two per page, and no HEAD requests at all.
+        self.assertEqual([c[0] for c in self.bucket.calls], ['list', 'list'])
+
+    def test_folder_children_use_delimiter(self):
+        key = Key(self.bucket, 'dir/')
+        res = S3DavResource(self.server, self.bucket, key)
+        names = [c.key_name for c in res.get_children()]
+        self.assertEqual(names, ['dir/sub/', 'dir/x.txt'])
+        for kind, params in self.bucket.calls:
+            self.assertEqual(params['delimiter'], '/')
+            self.assertEqual(params['prefix'], 'dir/')
+
+    def test_listing_fills_metadata_cache(self):
+        res = S3DavResource(self.server, self.bucket, None)
+        list(res.get_children())
+        del self.bucket.calls[:]
+        self.assertEqual(metadata.lookup_key(self.bucket, 'b.txt').size, 2)
+        self.assertTrue(metadata.lookup_key(self.bucket, 'nomarker/'))
+        self.assertEqual(self.bucket.calls, [])
+        metadata.forget(self.bucket.name, 'b.txt')
+        metadata.lookup_key(self.bucket, 'b.txt')
+        self.assertEqual(self.bucket.calls, [('head', 'b.txt')])
+
+    def test_propfind_children_need_no_head(self):
+        res = S3DavResource(self.server, self.bucket, None)
+        props = DavProperty(self.server)
+        for child in res.get_descendants(depth=1):
+            props.get_propstat(child, ElementTree.Element('{DAV:}response'))
+            child.exists()
+            child.get_parent()
+        self.assertEqual(set(c[0] for c in self.bucket.calls), set(['list']))
+
+    def test_resolve_bare_prefix(self):
+        key = resolve_key(self.bucket, 'nomarker')
+        self.assertEqual(key.name, 'nomarker/')
+        self.assertEqual(resolve_key(self.bucket, 'missing/'), None)
+        del self.bucket.calls[:]
+        self.assertEqual(resolve_key(self.bucket, 'nomarker/').name, 'nomarker/')
+        self.assertEqual(self.bucket.calls, [])
+
+    def test_missing_names_are_cached(self):
+        self.assertEqual(resolve_key(self.bucket, 'new/c.txt'), None)
+        self.assertEqual([c[0] for c in self.bucket.calls], ['head', 'list'])
+        del self.bucket.calls[:]
+        self.assertEqual(resolve_key(self.bucket, 'new/c.txt'), None)
+        self.assertEqual(resolve_key(self.bucket, 'new/c.txt'), None)
+        self.assertEqual(self.bucket.calls, [])
+        # A write drops the entry, and those of the directories above it.
+        resolve_key(self.bucket, 'new')
+        self.bucket.contents['new/c.txt'] = 'c'
+        metadata.forget(self.bucket.name, 'new/c.txt')
+        self.assertEqual(resolve_key(self.bucket, 'new/c.txt').size, 1)
+        self.assertEqual(resolve_key(self.bucket, 'new').name, 'new/')
+
+    def test_write_through_cache(self):
+        cache_dir = self.use_cache_dir()
+        self.addCleanup(setattr, server, 'S3_CACHE_WRITE_THROUGH', server.S3_CACHE_WRITE_THROUGH)
+        res = S3DavResource(self.server, self.bucket, None, key_name='new.txt')
+        cached = os.path.join(cache_dir, 'bkt', 'new.txt')
+
+        server.S3_CACHE_WRITE_THROUGH = True
+        res.write(StringIO('hello'))
+        self.assertEqual(self.bucket.contents['new.txt'], 'hello')
+        self.assertEqual(open(cached).read(), 'hello')
+
+        server.S3_CACHE_WRITE_THROUGH = False
+        res.write(StringIO('world'))
+        self.assertEqual(self.bucket.contents['new.txt'], 'world')
+        self.assertFalse(os.path.exists(cached))
+
+    def test_uncached_range_reads_only_the_range(self):
+        self.use_cache_dir()
+        res = S3DavResource(self.server, self.bucket, None, key_name='b.txt')
+        self.assertEqual(''.join(res.read_range(1, 1)), 'b')
+        self.assertEqual(self.bucket.calls[-1], ('get', 'b.txt', {'Range': 'bytes=1-1'}))
+
+    def test_concurrent_cold_reads_share_one_download(self):
+        self.use_cache_dir()
+        self.bucket.contents['big.bin'] = 'x' * 300000
+        res = S3DavResource(self.server, self.bucket, None, key_name='big.bin')
+        self.assertTrue(res.exists())
+        readers = [res.iter_content(), res.iter_content()]
+        for reader in readers:
+            self.assertEqual(''.join(reader), 'x' * 300000)
+        self.assertEqual([c for c in self.bucket.calls if c[0] == 'get'],
+                         [('get', 'big.bin', None)])
+        self.assertTrue(res.is_cached())
+        self.assertEqual(server.objects.total_bytes, 300000)
+
+    def test_cache_is_validated_by_etag(self):
+        self.use_cache_dir()
+        res = S3DavResource(self.server, self.bucket, None, key_name='a.txt')
+        self.assertTrue(res.exists())
+        self.assertFalse(res.is_cached())
+        res.open('r').close()
+        self.assertTrue(res.is_cached())
+        # Same object, no matter what its timestamps say.
+        res.key.last_modified = 'Fri, 01 Jan 2100 00:00:00 GMT'
+        self.assertTrue(res.is_cached())
+        res.key.etag = fake_etag('changed')
+        self.assertFalse(res.is_cached())
+
+
+class TreeCopyTest(TestCase):
+    def setUp(self):
+        metadata.clear()
+        self.bucket = FakeBucket('bkt', {
+            'src/': '',
+            'src/a': 'a',
+            'src/deep/b': 'b',
+            'other': 'o',
+        })
+        self.server = FakeS3Server(self.bucket)
+        self.src = S3DavResource(self.server, self.bucket, None, key_name='src/')
+        self.dst = S3DavResource(self.server, self.bucket, None, key_name='dst')
+
+    def test_copy_tree(self):
+        self.assertEqual(self.src.copy(self.dst, depth=-1), [])
+        self.assertEqual(sorted(k for k in self.bucket.contents if k.startswith('dst/')),
+                         ['dst/', 'dst/a', 'dst/deep/b'])
+        self.assertTrue('src/deep/b' in self.bucket.contents)
+        # The source is listed recursively, never folder by folder.
+        listings = [call[1] for call in self.bucket.calls
+                    if call[0] == 'list' and not call[1].get('max_keys')]
+        self.assertTrue(listings)
+        for params in listings:
+            self.assertEqual((params['prefix'], params['delimiter']), ('src/', ''))
+
+    def test_move_tree_reports_failures(self):
+        self.bucket.fail.add('src/a')
+        errors = self.src.move(self.dst)
+        self.assertEqual(errors, [('http://testserver/bkt/dst/a', 403)])
+        self.assertEqual(sorted(self.bucket.contents), ['dst/', 'dst/deep/b', 'other', 'src/a'])
+
+    def test_delete_tree_in_batches(self):
+        self.bucket.fail.add('src/deep/b')
+        self.addCleanup(setattr, server, 'S3_DELETE_BATCH_SIZE', server.S3_DELETE_BATCH_SIZE)
+        server.S3_DELETE_BATCH_SIZE = 2
+        errors = self.src.delete()
+        self.assertEqual(errors, [('http://testserver/bkt/src/deep/b', 403)])
+        self.assertEqual(sorted(self.bucket.contents), ['other', 'src/deep/b'])
+        batches = [call[1] for call in self.bucket.calls if call[0] == 'delete_keys']
+        self.assertEqual(sorted(batches), [['src/', 'src/a'], ['src/deep/b']])
+        self.assertFalse([call for call in self.bucket.calls if call[0] == 'delete'])
+
+
+class MultipartUploaderTest(TestCase):
+    def setUp(self):
+        self.bucket = FakeBucket('bkt', {})
+
+    def test_small_body_uses_single_put(self):
+        uploader = MultipartUploader(FakeKey(self.bucket, 'k'), part_size=4)
+        self.assertEqual(uploader.upload(StringIO('abcd')), 4)
+        self.assertEqual(self.bucket.calls, [('put', 'k')])
+        self.assertEqual(self.bucket.contents['k'], 'abcd')
+
+    def test_large_body_uploads_parts(self):
+        body = ''.join(chr(ord('a') + i % 26) for i in range(103))
+        uploader = MultipartUploader(FakeKey(self.bucket, 'k'), part_size=10, concurrency=3)
+        self.assertEqual(uploader.upload(StringIO(body)), 103)
+        self.assertEqual(len(self.bucket.upload.parts), 11)
+        self.assertEqual(self.bucket.contents['k'], body)
+
+    def test_failed_part_is_retried_then_cancels(self):
+        uploader = MultipartUploader(FakeKey(self.bucket, 'k'), part_size=2, concurrency=1, retries=2)
+        self.bucket.initiate_multipart_upload('k').failures = 1
+        self.bucket.initiate_multipart_upload = lambda name: self.bucket.upload
+        self.assertEqual(uploader.upload(StringIO('abcdef')), 6)
+        self.assertEqual(self.bucket.contents['k'], 'abcdef')
+        self.bucket.upload.failures = 2
+        self.assertRaises(IOError, uploader.upload, StringIO('abcdef'))
+        self.assertEqual(self.bucket.calls[-1], ('cancel', 'k'))
+
+
+class ObjectCacheTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def put(self, cache, name, size):
+        path = os.path.join(self.root, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write('x' * size)
+        cache.add(path, size)
+        return path
+
+    def test_evicts_least_recently_used(self):
+        cache = ObjectCache(self.root, max_bytes=10, max_files=3, quotas={})
+        a = self.put(cache, 'b1/a', 4)
+        b = self.put(cache, 'b1/sub/b', 4)
+        cache.touch(a)
+        c = self.put(cache, 'b1/c', 4)
+        self.assertFalse(os.path.exists(b))
+        self.assertFalse(os.path.exists(os.path.dirname(b)))
+        self.assertTrue(os.path.exists(a) and os.path.exists(c))
+        self.assertEqual(cache.total_bytes, 8)
+        self.put(cache, 'b1/d', 1)
+        self.put(cache, 'b1/e', 1)
+        self.assertFalse(os.path.exists(a))
+        self.assertEqual(len(cache.entries), 3)
+
+    def test_bucket_quota(self):
+        cache = ObjectCache(self.root, max_bytes=None, max_files=None, quotas={'small': 5})
+        big = self.put(cache, 'big/a', 50)
+        old = self.put(cache, 'small/a', 3)
+        new = self.put(cache, 'small/b', 3)
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(new) and os.path.exists(big))
+
+    def test_bucket_quota_walks_only_that_bucket(self):
+        cache = ObjectCache(self.root, max_bytes=15, max_files=None, quotas={'small': 6})
+        self.put(cache, 'small/a', 2)
+        self.put(cache, 'big/a', 5)
+        self.put(cache, 'small/b', 2)
+        self.put(cache, 'big/b', 5)
+        cache.touch(os.path.join(self.root, 'small/a'))
+        self.assertEqual(list(cache._bucket_entries['small']), ['small/b', 'small/a'])
+        # Over the byte budget, which takes big/a, and the quota, which takes
+        # the coldest file of small although big/b is colder.
+        self.put(cache, 'small/c', 4)
+        self.assertEqual(list(cache.entries), ['big/b', 'small/a', 'small/c'])
+        self.assertEqual(list(cache._bucket_entries['small']), ['small/a', 'small/c'])
+        self.assertEqual(cache._bucket_bytes['small'], 6)
+        self.assertFalse('small/a' in cache._bucket_entries['big'])
+
+    def test_remove_file_or_tree(self):
+        cache = ObjectCache(self.root, max_bytes=None, max_files=None, quotas={'b': 10})
+        self.put(cache, 'b/d/a', 2)
+        self.put(cache, 'b/d/sub/b', 3)
+        self.put(cache, 'b/e', 4)
+        cache.remove(os.path.join(self.root, 'b/d'))
+        cache.remove(os.path.join(self.root, 'b/d/a'))
+        self.assertEqual(list(cache.entries), ['b/d/sub/b', 'b/e'])
+        cache.remove_tree(os.path.join(self.root, 'b/d'))
+        self.assertEqual(list(cache.entries), ['b/e'])
+        self.assertEqual((cache.total_bytes, cache._bucket_bytes['b']), (4, 4))
+        # The quota goes by the running total.
+        self.put(cache, 'b/f', 6)
+        self.assertEqual(list(cache.entries), ['b/e', 'b/f'])
+        self.put(cache, 'b/g', 1)
+        self.assertEqual(list(cache.entries), ['b/f', 'b/g'])
+
+    def test_index_survives_restart(self):
+        cache = ObjectCache(self.root, max_bytes=None, max_files=None, quotas={}, sync_interval=0)
+        a = self.put(cache, 'b/a', 1)
+        self.put(cache, 'b/b', 1)
+        cache.touch(a)
+        cache.save()
+        reloaded = ObjectCache(self.root, max_bytes=None, max_files=None, quotas={})
+        self.assertEqual(list(reloaded.entries), ['b/b', 'b/a'])
+        os.remove(reloaded.index_path)
+        rebuilt = ObjectCache(self.root, max_bytes=None, max_files=None, quotas={})
+        self.assertEqual(sorted(rebuilt.entries), ['b/a', 'b/b'])
+        self.assertEqual(rebuilt.total_bytes, 2)
+
+
+class FakeConnection(object):
+    closed = False
+
+    def __init__(self, *args):
+        self.args = args
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTest(TestCase):
+    def test_connections_are_per_thread(self):
+        pool = ConnectionPool(FakeConnection, max_size=10, idle_timeout=60)
+        conn = pool.get('key', 'secret', 'host', 80)
+        self.assertTrue(pool.get('key', 'secret', 'host', 80) is conn)
+        self.assertFalse(pool.get('key', 'secret', 'other', 80) is conn)
+        others = []
+        thread = threading.Thread(target=lambda: others.append(pool.get('key', 'secret', 'host', 80)))
+        thread.start()
+        thread.join()
+        self.assertFalse(others[0] is conn)
+        self.assertEqual(pool.stats()['hits'], 1)
+        self.assertEqual(pool.stats()['misses'], 3)
+
+    def test_lru_and_idle_eviction(self):
+        pool = ConnectionPool(FakeConnection, max_size=2, idle_timeout=60)
+        a = pool.get('a', 's', 'host', 80)
+        b = pool.get('b', 's', 'host', 80)
+        pool.get('a', 's', 'host', 80)
+        pool.get('c', 's', 'host', 80)
+        self.assertTrue(b.closed)
+        self.assertFalse(a.closed)
+        pool.idle_timeout = 0.01
+        time.sleep(0.02)
+        pool.get('d', 's', 'host', 80)
+        self.assertTrue(a.closed)
+        self.assertEqual(pool.stats()['size'], 1)
+
+
+class TTLCacheTest(TestCase):
+    def test_lru_and_expiry(self):
+        cache = TTLCache(ttl=60, size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('a', 1, ttl=-1)
+        self.assertEqual(cache.get('a'), None)
+
+
+@override_settings(DAV_ROOT=os.path.abspath('davexport'))
+class PropfindTest(TestCase):
+    def propfind(self, path, depth):
+        body = ('<?xml version="1.0" encoding="utf-8"?><D:propfind xmlns:D="DAV:"><D:prop>'
+                '<D:getcontentlength/><D:resourcetype/></D:prop></D:propfind>')
+        request = RequestFactory().generic('PROPFIND', '/simple' + path, body,
+                                           content_type='text/xml', HTTP_DEPTH=depth)
+        return webdav_export(request, path)
+
+    def test_streamed_multistatus(self):
+        response = self.propfind('/haha', '1')
+        self.assertEqual(response.status_code, 207)
+        self.assertTrue(response.streaming)
+        chunks = list(response.streaming_content)
+        # Header, opening tag, one chunk per resource, closing tag.
+        self.assertEqual(len(chunks), 2 + 3 + 1)
+        msr = ElementTree.fromstring(''.join(chunks))
+        self.assertEqual(msr.tag, '{DAV:}multistatus')
+        hrefs = sorted(el.text for el in msr.iter('{DAV:}href'))
+        self.assertEqual(hrefs, ['http://testserver/simple/haha',
+                                 'http://testserver/simple/haha/hoho.txt',
+                                 'http://testserver/simple/haha/ootey'])
+
+
+class WritableDavServer(DavServer):
+    def get_access(self, path):
+        return self.acl_class(all=True)
+
+
+class LockPath(object):
+    def __init__(self, path):
+        self.path = path
+
+    def get_path(self):
+        return self.path
+
+
+class DavLockTest(TestCase):
+    LOCKINFO = ('<?xml version="1.0" encoding="utf-8"?><D:lockinfo xmlns:D="DAV:">'
+                '<D:lockscope><D:%s/></D:lockscope><D:locktype><D:write/></D:locktype>'
+                '<D:owner><D:href>me</D:href></D:owner></D:lockinfo>')
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        os.mkdir(os.path.join(self.root, 'dir'))
+        with open(os.path.join(self.root, 'doc.txt'), 'w') as f:
+            f.write('doc')
+        self.addCleanup(setattr, django_webdav, 'lock_store', django_webdav.lock_store)
+        django_webdav.lock_store = DavLockStore()
+
+    def request(self, method, path, body='', **headers):
+        request = RequestFactory().generic(method, '/simple' + path, body,
+                                           content_type='text/xml', **headers)
+        with override_settings(DAV_ROOT=self.root):
+            return webdav_export(request, path, server_class=WritableDavServer)
+
+    def lock(self, path, scope='exclusive', **headers):
+        return self.request('LOCK', path, self.LOCKINFO % scope, **headers)
+
+    def test_lock_blocks_writers_without_token(self):
+        response = self.lock('/dir', HTTP_DEPTH='infinity')
+        self.assertEqual(response.status_code, 200)
+        token = response['Lock-Token'][1:-1]
+        activelock = ElementTree.fromstring(response.content).find('.//{DAV:}activelock')
+        self.assertEqual(activelock.find('{DAV:}locktoken/{DAV:}href').text, token)
+        self.assertEqual(activelock.find('{DAV:}owner/{DAV:}href').text, 'me')
+
+        self.assertEqual(self.request('PUT', '/dir/new.txt', 'x').status_code, 423)
+        self.assertEqual(self.lock('/dir/new.txt').status_code, 423)
+        self.assertEqual(self.request('PUT', '/dir/new.txt', 'x', HTTP_IF='(<%s>)' % token).status_code, 201)
+        self.assertEqual(self.request('PUT', '/dir/new.txt', 'x', HTTP_IF='(<opaquelocktoken:x>)').status_code, 412)
+
+        response = self.request('UNLOCK', '/dir/new.txt', HTTP_LOCK_TOKEN='<%s>' % token)
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.request('PUT', '/dir/new.txt', 'y').status_code, 204)
+
+    def test_shared_locks_and_refresh(self):
+        first = self.lock('/doc.txt', scope='shared', HTTP_DEPTH='0')
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(self.lock('/doc.txt', scope='shared', HTTP_DEPTH='0').status_code, 200)
+        self.assertEqual(self.lock('/doc.txt', HTTP_DEPTH='0').status_code, 423)
+        # A depth infinity lock on the parent would cover the locked member.
+        self.assertEqual(self.lock('/', HTTP_DEPTH='infinity').status_code, 423)
+
+        token = first['Lock-Token'][1:-1]
+        response = self.request('LOCK', '/doc.txt', HTTP_IF='(<%s>)' % token, HTTP_TIMEOUT='Second-30')
+        self.assertEqual(response.status_code, 200)
+        timeout = ElementTree.fromstring(response.content).find('.//{DAV:}timeout').text
+        self.assertTrue(timeout in ('Second-29', 'Second-30'))
+
+    def test_move_locked_file_with_untagged_token(self):
+        token = self.lock('/doc.txt', HTTP_DEPTH='0')['Lock-Token'][1:-1]
+        destination = 'http://testserver/simple/moved.txt'
+        self.assertEqual(self.request('MOVE', '/doc.txt', HTTP_DESTINATION=destination).status_code, 423)
+        response = self.request('MOVE', '/doc.txt', HTTP_DESTINATION=destination,
+                                HTTP_IF='(<%s>)' % token)
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(os.path.exists(os.path.join(self.root, 'moved.txt')))
+        # The destination is still guarded by its own locks.
+        other = self.lock('/other.txt')['Lock-Token'][1:-1]
+        response = self.request('COPY', '/moved.txt', HTTP_DESTINATION='http://testserver/simple/other.txt',
+                                HTTP_IF='(<%s>)' % token)
+        self.assertEqual(response.status_code, 412)
+        response = self.request('COPY', '/moved.txt', HTTP_DESTINATION='http://testserver/simple/other.txt',
+                                HTTP_IF='</simple/other.txt> (<%s>)' % other)
+        self.assertEqual(response.status_code, 204)
+
+    def test_lock_unmapped_url_creates_empty_file(self):
+        self.assertEqual(self.lock('/fresh.txt').status_code, 201)
+        self.assertEqual(os.path.getsize(os.path.join(self.root, 'fresh.txt')), 0)
+
+    def test_expired_locks_are_dropped(self):
+        store = DavLockStore()
+        locks = DavLock(None, store)
+        old = locks.acquire(LockPath('a/b'), 'write', 'exclusive', 0, None, 0.01)
+        time.sleep(0.02)
+        self.assertEqual(locks.get(LockPath('a/b')), [])
+        self.assertEqual(locks.get_lock(old['token']), None)
+        new = locks.acquire(LockPath('a/b'), 'write', 'exclusive', 0, None, 60)
+        self.assertEqual(locks.get_below(LockPath('a')), [new])
+        self.assertFalse('token:' + old['token'] in store._data)
+        locks.del_locks(LockPath('a'))
+        self.assertEqual(store._data, {})
+
+    def test_top_level_indexes_are_sharded(self):
+        store = DavLockStore()
+        locks = DavLock(None, store)
+        for i in range(200):
+            locks.acquire(LockPath('bkt/dir/f%d' % i), 'write', 'exclusive', 0, None, 60)
+        self.assertEqual(len(locks.get_below(LockPath(''))), 200)
+        self.assertEqual(len(locks.get_below(LockPath('bkt'))), 200)
+        self.assertEqual(len(store._data['below:bkt/dir']), 200)
+        shards = [index for key, index in store._data.items()
+                  if key.startswith('below:bkt#') or key.startswith('below:#')]
+        self.assertTrue(max(len(index) for index in shards) < 20)
+        self.assertRaises(HttpLocked, locks.acquire, LockPath('bkt'), 'write', 'exclusive', -1, None, 60)
+        locks.del_locks(LockPath(''))
+        self.assertEqual(store._data, {})
+
+    def test_cache_store_mutex_is_never_taken_over(self):
+        store = DavCacheLockStore(get_cache('django.core.cache.backends.locmem.LocMemCache'))
+        store.mutex_timeout = 0.05
+        key = store.prefix + 'mutex'
+        store.cache.add(key, 'other', 60)
+        def update():
+            with store.mutex():
+                self.fail('entered a mutex held elsewhere')
+        self.assertRaises(HttpServiceUnavailable, update)
+        self.assertEqual(store.cache.get(key), 'other')
+        store.cache.delete(key)
+        with store.mutex():
+            # Taken over by another process after it expired.
+            store.cache.set(key, 'other', 60)
+        self.assertEqual(store.cache.get(key), 'other')
+
+
+class PropertyDavServer(WritableDavServer):
+    def __init__(self, request, path, **kw):
+        super(PropertyDavServer, self).__init__(request, path, property_class=S3DavProperty, **kw)
+
+
+class DeadPropertyTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        os.mkdir(os.path.join(self.root, 'dir'))
+        for name in ('a.txt', 'b.txt'):
+            with open(os.path.join(self.root, 'dir', name), 'w') as f:
+                f.write(name)
+
+    def request(self, method, path, body, **headers):
+        request = RequestFactory().generic(method, '/simple' + path, body,
+                                           content_type='text/xml', **headers)
+        with override_settings(DAV_ROOT=self.root):
+            return webdav_export(request, path, server_class=PropertyDavServer)
+
+    def proppatch(self, path, set_xml='', remove_xml=''):
+        body = '<D:propertyupdate xmlns:D="DAV:" xmlns:X="urn:x">'
+        if set_xml:
+            body += '<D:set><D:prop>%s</D:prop></D:set>' % set_xml
+        if remove_xml:
+            body += '<D:remove><D:prop>%s</D:prop></D:remove>' % remove_xml
+        response = self.request('PROPPATCH', path, body + '</D:propertyupdate>')
+        self.assertEqual(response.status_code, 207)
+        msr = ElementTree.fromstring(response.content)
+        return dict((prop.tag, propstat.find('{DAV:}status').text)
+                    for propstat in msr.iter('{DAV:}propstat')
+                    for prop in propstat.find('{DAV:}prop'))
+
+    def test_proppatch_and_batched_propfind(self):
+        statuses = self.proppatch('/dir/a.txt', '<X:color>red</X:color><X:tag X:kind="a">old</X:tag>')
+        self.assertEqual(statuses, {'{urn:x}color': 'HTTP/1.1 200 OK', '{urn:x}tag': 'HTTP/1.1 200 OK'})
+        self.proppatch('/dir/b.txt', '<X:color>blue</X:color>', '<X:gone/>')
+        self.proppatch('/dir/a.txt', '<X:tag X:kind="b">new</X:tag>')
+
+        # The body is produced lazily, under the settings of the request.
+        with override_settings(DAV_ROOT=self.root):
+            response = self.request('PROPFIND', '/dir', '', HTTP_DEPTH='1')
+            with self.assertNumQueries(1):
+                msr = ElementTree.fromstring(''.join(response.streaming_content))
+        colors = sorted(el.text for el in msr.iter('{urn:x}color'))
+        self.assertEqual(colors, ['blue', 'red'])
+        tag = msr.find('.//{urn:x}tag')
+        self.assertEqual((tag.text, tag.get('{urn:x}kind')), ('new', 'b'))
+
+        self.proppatch('/dir/a.txt', remove_xml='<X:color/>')
+        self.assertEqual(DeadProperty.objects.filter(name='{urn:x}color').count(), 1)
+
+    def test_protected_property_fails_whole_update(self):
+        statuses = self.proppatch('/dir/a.txt', '<D:getetag>x</D:getetag><X:color>red</X:color>')
+        self.assertEqual(statuses, {'{DAV:}getetag': 'HTTP/1.1 403 Forbidden',
+                                    '{urn:x}color': 'HTTP/1.1 424 Failed Dependency'})
+        self.assertFalse(DeadProperty.objects.exists())
+
+    def test_move_carries_properties_of_members(self):
+        props = S3DavProperty(None)
+        DeadProperty.objects.create(bucket='bkt', key='src/a', name='n', value='<n/>')
+        DeadProperty.objects.create(bucket='bkt', key='src', name='n', value='<n/>')
+        DeadProperty.objects.create(bucket='bkt', key='srcx', name='n', value='<n/>')
+        props.copy_props(LockPath('bkt/src'), LockPath('bkt/dst'), move=True)
+        self.assertEqual(sorted(DeadProperty.objects.values_list('key', flat=True)),
+                         ['dst', 'dst/a', 'srcx'])
+        for prop in DeadProperty.objects.all():
+            self.assertEqual(prop.digest, path_digest('bkt', prop.key))
+        props.del_props(LockPath('bkt/dst'))
+        self.assertEqual(list(DeadProperty.objects.values_list('key', flat=True)), ['srcx'])
+
+    def test_long_keys_are_looked_up_by_digest(self):
+        key = u'd\xe9j\xe0/' + 'k' * 1000
+        DeadProperty.objects.create(bucket='bkt', key=key, name='n', value='<n/>')
+        self.assertEqual(DeadProperty.objects.get(digest=path_digest('bkt', key)).key, key)
+        self.assertEqual(S3DavProperty(None).get_dead_names(LockPath('bkt/' + key)), ['n'])
+
+
+class StubbornResource(DavResource):
+    '''Cannot delete or move b.txt, as S3 refuses single keys at times.'''
+    def delete(self):
+        if self.get_name() == 'b.txt':
+            return [(self.get_url(), 403)]
+        if not self.isdir():
+            return super(StubbornResource, self).delete()
+        errors = []
+        for child in self.get_children():
+            errors.extend(child.delete() or [])
+        if not errors:
+            os.rmdir(self.get_abs_path())
+        return errors
+
+    def move(self, destination):
+        if self.get_name() == 'b.txt':
+            return [(destination.get_url(), 403)]
+        if not self.isdir():
+            return super(StubbornResource, self).move(destination)
+        destination.mkdir()
+        errors = []
+        for child in self.get_children():
+            path = os.path.join(destination.get_path(), child.get_name())
+            errors.extend(child.move(self.__class__(self.server, path)) or [])
+        if not errors:
+            os.rmdir(self.get_abs_path())
+        return errors
+
+
+class StubbornDavServer(PropertyDavServer):
+    def __init__(self, request, path, **kw):
+        super(StubbornDavServer, self).__init__(request, path, resource_class=StubbornResource, **kw)
+
+
+class PartialFailureTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        os.mkdir(os.path.join(self.root, 'dir'))
+        for name in ('a.txt', 'b.txt'):
+            with open(os.path.join(self.root, 'dir', name), 'w') as f:
+                f.write(name)
+            DeadProperty.objects.create(bucket='dir', key=name, name='n', value='<n/>')
+        DeadProperty.objects.create(bucket='dir', key='', name='n', value='<n/>')
+        self.addCleanup(setattr, django_webdav, 'lock_store', django_webdav.lock_store)
+        django_webdav.lock_store = DavLockStore()
+        response = self.request('LOCK', '/dir/b.txt', DavLockTest.LOCKINFO % 'exclusive')
+        self.token = response['Lock-Token'][1:-1]
+
+    def request(self, method, path, body='', **headers):
+        request = RequestFactory().generic(method, '/simple' + path, body,
+                                           content_type='text/xml', **headers)
+        with override_settings(DAV_ROOT=self.root):
+            return webdav_export(request, path, server_class=StubbornDavServer)
+
+    def test_delete_keeps_locks_and_properties_of_survivors(self):
+        response = self.request('DELETE', '/dir', HTTP_IF='</simple/dir/b.txt> (<%s>)' % self.token)
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual(os.listdir(os.path.join(self.root, 'dir')), ['b.txt'])
+        self.assertEqual(sorted(DeadProperty.objects.values_list('key', flat=True)), ['', 'b.txt'])
+        self.assertEqual(self.request('PUT', '/dir/b.txt', 'x').status_code, 423)
+
+    def test_move_leaves_locks_and_properties_of_what_stayed(self):
+        response = self.request('MOVE', '/dir', HTTP_DESTINATION='http://testserver/simple/moved',
+                                HTTP_IF='</simple/dir/b.txt> (<%s>)' % self.token)
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual(os.listdir(os.path.join(self.root, 'moved')), ['a.txt'])
+        self.assertEqual(sorted(DeadProperty.objects.values_list('bucket', 'key')),
+                         [('dir', ''), ('dir', 'b.txt'), ('moved', ''), ('moved', 'a.txt')])
+        self.assertEqual(self.request('PUT', '/dir/b.txt', 'x').status_code, 423)
+
+
+def canonical(el):
+    return (el.tag, (el.text or '').strip(), sorted(el.attrib.items()), [canonical(c) for c in el])
+
+
+class MultistatusTemplateTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        os.mkdir(os.path.join(self.root, 'dir'))
+        for name in ('a&b <c>.txt', 'empty.txt'):
+            with open(os.path.join(self.root, 'dir', name), 'w') as f:
+                f.write(name if name != 'empty.txt' else '')
+        DeadProperty.objects.create(bucket='dir', key='empty.txt', name='{urn:x}color',
+                                    value='<ns0:color xmlns:ns0="urn:x">red</ns0:color>')
+
+    def render(self, templates, *names):
+        request = RequestFactory().generic('PROPFIND', '/simple/dir', '', HTTP_DEPTH='1')
+        with override_settings(DAV_ROOT=self.root):
+            server = PropertyDavServer(request, '/dir')
+            res = server.get_resource('/dir')
+            resources = list(res.get_descendants(depth=1, include_self=True))
+            if templates:
+                chunks = list(server.props.render_responses(resources, *names))
+            else:
+                chunks = [ElementTree.tostring(el, 'utf-8')
+                          for el in server.props.get_responses(resources, *names)]
+        # Rendered chunks rely on the prefix being declared by the multistatus element.
+        return [canonical(ElementTree.fromstring('<D:multistatus xmlns:D="DAV:">%s</D:multistatus>' % chunk))
+                for chunk in chunks]
+
+    def test_templates_match_element_tree(self):
+        for names in [(), ('{DAV:}getcontentlength', '{DAV:}resourcetype', '{DAV:}quota'),
+                      ('{DAV:}displayname', '{urn:x}color')]:
+            self.assertEqual(self.render(True, *names), self.render(False, *names))
+        # The resource with a dead property took the ElementTree path.
+        self.assertTrue("'{urn:x}color', 'red'" in repr(self.render(True)))
+
+
+class PropstatTest(TestCase):
+    def test_one_propstat_per_status(self):
+        class Resource(object):
+            calls = 0
+            def get_size(self):
+                self.calls += 1
+                return 3
+            def get_name(self):
+                return 'x.txt'
+        res = Resource()
+        response = ElementTree.Element('{DAV:}response')
+        DavProperty(None).get_propstat(res, response, '{DAV:}getcontentlength',
+                                       '{DAV:}displayname', '{urn:x}missing')
+        propstats = response.findall('{DAV:}propstat')
+        self.assertEqual([[prop.tag for prop in propstat.find('{DAV:}prop')] for propstat in propstats],
+                         [['{DAV:}getcontentlength', '{DAV:}displayname'], ['{urn:x}missing']])
+        self.assertEqual([propstat.find('{DAV:}status').text for propstat in propstats],
+                         ['HTTP/1.1 200 OK', 'HTTP/1.1 404 Not Found'])
+        self.assertEqual(res.calls, 1)
+
+
+class ParseRangeTest(TestCase):
+    def test_parse_range(self):
+        self.assertEqual(parse_range('bytes=0-4', 10), [(0, 4)])
+        self.assertEqual(parse_range('bytes=5-', 10), [(5, 9)])
+        self.assertEqual(parse_range('bytes=-3', 10), [(7, 9)])
+        self.assertEqual(parse_range('bytes=8-20, 0-0', 10), [(8, 9), (0, 0)])
+        self.assertEqual(parse_range('bytes=10-20', 10), [])
+        self.assertEqual(parse_range('bytes=4-2', 10), None)
+        self.assertEqual(parse_range('items=0-1', 10), None)
+        self.assertEqual(parse_range('bytes=a-b', 10), None)
+
+    def test_merge_ranges(self):
+        self.assertEqual(merge_ranges([(8, 9), (0, 0)]), [(0, 0), (8, 9)])
+        self.assertEqual(merge_ranges([(4, 6), (0, 2), (3, 3), (5, 9)]), [(0, 9)])
+        self.assertEqual(merge_ranges([(0, 0), (2, 2)]), [(0, 0), (2, 2)])
+
+
+@override_settings(DAV_ROOT=os.path.abspath('davexport'))
+class RangeGetTest(TestCase):
+    def get(self, path, **headers):
+        request = RequestFactory().get('/simple' + path, **headers)
+        return webdav_export(request, path)
+
+    def test_single_range(self):
+        response = self.get('/placeholder.txt', HTTP_RANGE='bytes=4-7')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 4-7/14')
+        self.assertEqual(''.join(response.streaming_content), "it's")
+
+    def test_multiple_ranges(self):
+        response = self.get('/placeholder.txt', HTTP_RANGE='bytes=0-1,-5')
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response['Content-Type'].startswith('multipart/byteranges'))
+        body = ''.join(response.streaming_content)
+        self.assertTrue('Content-Range: bytes 0-1/14\r\n\r\nOK\r\n' in body)
+        self.assertTrue('Content-Range: bytes 9-13/14\r\n\r\nhere\n\r\n' in body)
+
+    def test_ranges_are_merged_and_capped(self):
+        response = self.get('/placeholder.txt', HTTP_RANGE='bytes=2-3,0-1,1-2')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 0-3/14')
+        many = ','.join('%d-%d' % (i, i) for i in range(0, 14, 2))
+        self.assertEqual(self.get('/placeholder.txt', HTTP_RANGE='bytes=' + many).status_code, 206)
+        self.addCleanup(setattr, django_webdav, 'DAV_MAX_RANGES', django_webdav.DAV_MAX_RANGES)
+        django_webdav.DAV_MAX_RANGES = 6
+        response = self.get('/placeholder.txt', HTTP_RANGE='bytes=' + many)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(''.join(response.streaming_content), "OK, it's here\n")
+
+    def test_unsatisfiable_and_if_range(self):
+        response = self.get('/placeholder.txt', HTTP_RANGE='bytes=100-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */14')
+        response = self.get('/placeholder.txt', HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+
+class SimpleAuthTest(TestCase):
+    def setUp(self):
+        credentials.clear()
+        user = User.objects.create_user('alice', password='secret')
+        self.account = S3Account.objects.create(user=user, aws_access_key='AKIA',
+                                                aws_secret='shh')
+
+    def auth(self, password='secret'):
+        header = 'Basic ' + base64.b64encode('alice:' + password)
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION=header)
+        simple_auth(request)
+        return request.aws_key, request.aws_secret
+
+    def test_resolved_credentials_are_cached(self):
+        self.assertEqual(self.auth(), ('AKIA', 'shh'))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.auth(), ('AKIA', 'shh'))
+        self.assertEqual(self.auth('wrong'), ('alice', 'wrong'))
+
+    def test_saving_account_invalidates(self):
+        self.auth()
+        self.account.aws_secret = 'rotated'
+        self.account.save()
+        self.assertEqual(self.auth(), ('AKIA', 'rotated'))
+
+
+class JunkNameTest(TestCase):
+    def test_names(self):
+        for name in ('.DS_Store', 'dir/._a.txt', 'Dir/DESKTOP.INI', 'x/Thumbs.db', '.Trashes/'):
+            self.assertTrue(is_junk(name), name)
+        for name in ('a.txt', '._', 'x.DS_Store', 'Thumbs.db/a.txt', 'desktop.ini.bak'):
+            self.assertFalse(is_junk(name), name)
+
+    def test_known_misses_are_refused_before_authentication(self):
+        self.addCleanup(metadata.clear)
+        for name in ('dir/.DS_Store', '._a.txt', 'dir/a.txt'):
+            metadata.add_missing('b', name)
+        factory = RequestFactory()
+        for method in ('get', 'head', 'options'):
+            request = getattr(factory, method)('/b/dir/.DS_Store')
+            self.assertRaises(Http404, export, request, 'b', 'dir/.DS_Store')
+        request = factory.generic('PROPFIND', '/b/._a.txt')
+        self.assertRaises(Http404, export, request, 'b', '._a.txt')
+        # Writes go through, here to ask for credentials, and so do other names.
+        request = factory.put('/b/dir/.DS_Store', '')
+        self.assertEqual(export(request, 'b', 'dir/.DS_Store').status_code, 401)
+        request = factory.get('/b/dir/a.txt')
+        self.assertEqual(export(request, 'b', 'dir/a.txt').status_code, 401)
+
+
+class BenchmarkCommandTest(TestCase):
+    def test_runs_every_scenario_against_fake_s3(self):
+        out = StringIO()
+        call_command('benchmark', iterations=2, files=4, small_kb=1, large_kb=16, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 12)
+        self.assertTrue(lines[-1].startswith('peak RSS: '))
+        self.assertTrue('DeleteObjects=1' in lines[-2])
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self, parse=json.loads):
+        logging.Handler.__init__(self)
+        self.parse = parse
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(self.parse(record.getMessage()))
+
+
+class FakeS3TestCase(TestCase):
+    '''Runs requests through the views against a fake S3 endpoint.'''
+    def setUp(self):
+        self.fake = fakes3.FakeS3Server().start()
+        self.addCleanup(self.fake.shutdown)
+        self.fake.s3.buckets['b'] = {}
+        self.fake.s3.put('b', 'blob', 'x' * 2048)
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, True)
+        self.addCleanup(setattr, server, 'objects', server.objects)
+        server.objects = ObjectCache(cache_dir)
+        self.addCleanup(setattr, server, 'S3_CACHE_DIR', server.S3_CACHE_DIR)
+        server.S3_CACHE_DIR = cache_dir
+        self.addCleanup(server.connection_pool.clear)
+        self.addCleanup(metadata.clear)
+        metadata.clear()
+        endpoint = override_settings(AWS_HOST='127.0.0.1', AWS_PORT=self.fake.port)
+        endpoint.enable()
+        self.addCleanup(endpoint.disable)
+        auth = 'Basic ' + base64.b64encode('key:secret')
+        credentials.set(credentials_key(auth), ('key', 'secret'))
+        self.client = Client(HTTP_AUTHORIZATION=auth)
+
+    def request(self, method, path, **extra):
+        response = self.client.generic(method, path, **extra)
+        if response.streaming:
+            response.body = ''.join(response.streaming_content)
+        else:
+            response.body = response.content
+        return response
+
+
+class MetricsTest(FakeS3TestCase):
+    def setUp(self):
+        super(MetricsTest, self).setUp()
+        self.handler = RecordingHandler()
+        metrics.logger.addHandler(self.handler)
+        self.addCleanup(metrics.logger.removeHandler, self.handler)
+
+    def get(self, path):
+        self.assertEqual(self.request('GET', path).body, 'x' * 2048)
+        return self.handler.records[-1]
+
+    def test_records_s3_calls_and_cache_use_per_request(self):
+        record = self.get('/b/blob')
+        self.assertEqual((record['method'], record['path'], record['status']), ('GET', '/b/blob', 200))
+        self.assertEqual(record['s3_calls'], {'HeadBucket': 1, 'HeadObject': 1, 'GetObject': 1})
+        self.assertTrue(record['bytes_in'] >= 2048)
+        self.assertTrue(record['cache']['object_misses'])
+        self.assertFalse('object_hits' in record['cache'])
+
+        record = self.get('/b/blob')
+        self.assertEqual(record['s3_calls'], {})
+        self.assertEqual(record['bytes_in'], 0)
+        self.assertEqual(record['cache']['metadata_hits'], 2)
+        self.assertFalse('object_misses' in record['cache'])
+
+    def test_metrics_endpoint_is_staff_only(self):
+        self.get('/b/blob')
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+        self.assertTrue('this_is_the_login_form' in self.client.get('/metrics').content)
+        User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.assertTrue(self.client.login(username='admin', password='pw'))
+        text = self.client.get('/metrics').content
+        self.assertTrue('s3dav_s3_calls_total{operation="GetObject"}' in text)
+        self.assertTrue('s3dav_requests_total{method="GET",status="200"}' in text)
+        self.assertTrue('s3dav_request_duration_seconds_bucket{method="GET",le="+Inf"}' in text)
+        self.assertTrue('s3dav_connection_pool_size' in text)
+
+
+class WriteBackTest(FakeS3TestCase):
+    def setUp(self):
+        super(WriteBackTest, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+        self.addCleanup(setattr, server, 'journal', server.journal)
+        self.gate = threading.Event()
+        self.addCleanup(self.gate.set)
+        server.journal = self.journal(self.gated_upload)
+
+    def journal(self, upload):
+        return WriteBackJournal(self.root, upload, server.pending_uploaded, workers=2,
+                                retry_delay=0.01)
+
+    def gated_upload(self, entry):
+        self.gate.wait()
+        return server.upload_pending(entry)
+
+    def start(self, journal):
+        journal.start()
+        self.addCleanup(journal.stop)
+        # Cleanups run last first: let held uploads through before stopping.
+        self.addCleanup(self.gate.set)
+        return journal
+
+    def put(self, path, body):
+        return self.request('PUT', path, data=body, content_type='text/plain')
+
+    def test_put_is_acknowledged_before_upload_and_read_back(self):
+        self.start(server.journal)
+        self.assertEqual(self.put('/b/new.txt', 'hello').status_code, 201)
+        self.assertFalse('new.txt' in self.fake.s3.buckets['b'])
+        self.assertEqual(self.request('GET', '/b/new.txt').body, 'hello')
+        listing = self.request('PROPFIND', '/b/', HTTP_DEPTH='1').body
+        self.assertTrue('/b/new.txt</' in listing and '>5</' in listing, listing)
+
+        self.gate.set()
+        self.assertTrue(server.journal.settle('b', 'new.txt', timeout=5))
+        self.assertEqual(self.fake.s3.buckets['b']['new.txt'].data, 'hello')
+        self.assertEqual([n for n in os.listdir(self.root) if n != '.lock'], [])
+        self.fake.s3.reset_calls()
+        self.assertEqual(self.request('GET', '/b/new.txt').body, 'hello')
+        self.assertEqual(self.fake.s3.calls.get('GetObject'), None)
+
+    def test_pending_uploads_are_served_by_us(self):
+        self.start(server.journal)
+        self.assertEqual(self.put('/b/new.txt', 'hello').status_code, 201)
+        self.addCleanup(setattr, server, 'S3_REDIRECT_BUCKETS', server.S3_REDIRECT_BUCKETS)
+        server.S3_REDIRECT_BUCKETS = {'*': 0}
+        response = self.request('GET', '/b/new.txt', HTTP_USER_AGENT='curl/7.88.1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.body, 'hello')
+        with override_settings(DAV_USE_SENDFILE='x-accel-redir /internal'):
+            response = self.request('GET', '/b/new.txt')
+        self.assertFalse(response.has_header('X-Accel-Redirect'))
+        self.assertEqual(response.body, 'hello')
+
+    def test_recovery_uploads_the_last_version(self):
+        crashed = server.journal
+        crashed.add('b', 'doc', 'key', 'secret', StringIO('one'))
+        crashed.add('b', 'doc', 'key', 'secret', StringIO('two'))
+        open(os.path.join(self.root, '1-unacknowledged.data'), 'w').close()
+        self.gate.set()
+        journal = self.start(self.journal(self.gated_upload))
+        self.assertRaises(ImproperlyConfigured, self.journal(None).start)
+        self.assertTrue(journal.settle('b', 'doc', timeout=5))
+        self.assertEqual(self.fake.s3.buckets['b']['doc'].data, 'two')
+        self.assertEqual(self.fake.s3.calls['PutObject'], 1)
+        self.assertEqual([n for n in os.listdir(self.root) if n != '.lock'], [])
+
+    def test_failed_uploads_are_retried_or_kept(self):
+        attempts = []
+        def upload(entry):
+            attempts.append(entry.key)
+            if entry.key == 'gone':
+                raise S3ResponseError(404, 'Not Found', '<Error><Code>NoSuchBucket</Code></Error>')
+            if attempts.count(entry.key) < 3:
+                # Rotated credentials, then throttling.
+                raise S3ResponseError(attempts.count(entry.key) == 1 and 403 or 503, 'Error')
+            return server.upload_pending(entry)
+        handler = RecordingHandler(parse=str)
+        writeback.logger.addHandler(handler)
+        self.addCleanup(writeback.logger.removeHandler, handler)
+        failures = metrics.write_back_failures_total.values[('b',)]
+        journal = self.start(self.journal(upload))
+        journal.add('b', 'flaky', 'key', 'secret', StringIO('f'))
+        journal.add('b', 'gone', 'key', 'secret', StringIO('d'))
+        self.assertTrue(journal.settle('b', '', timeout=5))
+        self.assertEqual(self.fake.s3.buckets['b']['flaky'].data, 'f')
+        self.assertEqual(attempts.count('flaky'), 3)
+        self.assertEqual(attempts.count('gone'), 1)
+        self.assertEqual(len([n for n in os.listdir(self.root) if n.endswith('.failed')]), 1)
+        self.assertEqual(metrics.write_back_failures_total.values[('b',)], failures + 1)
+        self.assertTrue('b/gone' in handler.records[0] and 'NoSuchBucket' in handler.records[0])
+
+    def test_delete_drops_pending_upload(self):
+        # Workers not started, the upload stays pending.
+        self.assertEqual(self.put('/b/new.txt', 'hello').status_code, 201)
+        self.assertEqual(self.request('DELETE', '/b/new.txt').status_code, 204)
+        self.assertEqual(os.listdir(self.root), [])
+        self.assertEqual(server.journal.get('b', 'new.txt'), None)
+        self.assertFalse('new.txt' in self.fake.s3.buckets.get('b', {}))
+
+
+class RedirectTest(FakeS3TestCase):
+    def setUp(self):
+        super(RedirectTest, self).setUp()
+        self.fake.s3.put('b', 'small', 'x' * 10)
+        self.fake.s3.put('other', 'blob', 'x' * 2048)
+        self.addCleanup(setattr, server, 'S3_REDIRECT_BUCKETS', server.S3_REDIRECT_BUCKETS)
+        server.S3_REDIRECT_BUCKETS = {'b': 1024}
+
+    def get(self, path, agent='curl/7.88.1'):
+        return self.request('GET', path, HTTP_USER_AGENT=agent)
+
+    def test_large_objects_redirect_to_presigned_url(self):
+        response = self.get('/b/blob')
+        self.assertEqual(response.status_code, 307)
+        url = response['Location']
+        self.assertTrue(url.startswith('http://127.0.0.1:%d/b/blob?' % self.fake.port), url)
+        self.assertTrue('Signature=' in url and 'Expires=' in url, url)
+        self.assertEqual(urllib2.urlopen(url).read(), 'x' * 2048)
+        self.assertEqual(self.fake.s3.calls['GetObject'], 1)
+
+    def test_rules(self):
+        self.assertEqual(self.get('/b/small').status_code, 200)
+        self.assertEqual(self.get('/other/blob').status_code, 200)
+        self.assertEqual(self.get('/b/blob', agent='WebDAVFS/3.0.0 (03008000) Darwin/22.1.0').status_code, 200)
+        self.assertEqual(self.request('HEAD', '/b/blob', HTTP_USER_AGENT='curl/7.88.1').status_code, 200)
+        server.S3_REDIRECT_BUCKETS = {'*': 0}
+        self.assertEqual(self.get('/other/blob').status_code, 307)
+        self.assertEqual(self.get('/b/small').status_code, 307)
+
+
+class JunkFileTest(FakeS3TestCase):
+    def test_junk_misses_are_remembered_until_written(self):
+        self.assertEqual(self.request('HEAD', '/b/desktop.ini').status_code, 404)
+        self.assertEqual(self.fake.s3.calls['HeadObject'], 1)
+        self.assertEqual(self.request('HEAD', '/b/desktop.ini').status_code, 404)
+        self.assertEqual(self.fake.s3.calls['HeadObject'], 1)
+        expires, value = metadata.missing._data[('b', 'desktop.ini')]
+        self.assertTrue(expires - time.time() > metadata.missing.ttl)
+        self.assertEqual(self.request('PUT', '/b/desktop.ini', data='[x]',
+                                      content_type='text/plain').status_code, 201)
+        self.assertEqual(self.request('GET', '/b/desktop.ini').body, '[x]')
+
+    def test_existing_junk_files_are_served_and_deleted(self):
+        # Written by another S3 tool.
+        self.fake.s3.put('b', 'dir/._a.txt', 'apple')
+        self.fake.s3.put('b', 'dir/.DS_Store', 'finder')
+        self.assertEqual(self.request('GET', '/b/dir/._a.txt').body, 'apple')
+        self.assertEqual(self.request('DELETE', '/b/dir/.DS_Store').status_code, 204)
+        self.assertFalse('dir/.DS_Store' in self.fake.s3.buckets['b'])
+
+
+class FileServingTest(FakeS3TestCase):
+    def test_file_response_streams_blocks(self):
+        path = os.path.join(server.S3_CACHE_DIR, 'f')
+        with open(path, 'wb') as f:
+            f.write('\0' * (BLOCK_SIZE * 2 + 1))
+        response = FileHttpResponse(open(path, 'rb'))
+        self.assertEqual([len(b) for b in response.streaming_content], [BLOCK_SIZE, BLOCK_SIZE, 1])
+
+        app = serve_files(lambda environ, start_response: FileHttpResponse(open(path, 'rb')))
+        body = app({'wsgi.file_wrapper': FileWrapper}, None)
+        self.assertTrue(isinstance(body, FileWrapper))
+        self.assertEqual(len(''.join(body)), BLOCK_SIZE * 2 + 1)
+        body.close()
+        self.assertTrue(body.filelike.f.closed)
+        self.assertEqual(app({}, None).file_to_stream.read(3), '\0' * 3)
+
+    def test_cached_objects_are_sent_from_disk(self):
+        response = self.request('GET', '/b/blob')
+        self.assertFalse(isinstance(response, FileHttpResponse))
+        response = self.request('GET', '/b/blob')
+        self.assertTrue(isinstance(response, FileHttpResponse))
+        self.assertEqual(response.body, 'x' * 2048)
+        self.assertEqual(self.fake.s3.calls['GetObject'], 1)
+
+    def test_accel_redirect_only_for_cached_objects(self):
+        with override_settings(DAV_USE_SENDFILE='x-accel-redir /internal'):
+            response = self.request('GET', '/b/blob')
+            self.assertFalse(response.has_header('X-Accel-Redirect'))
+            self.assertEqual(response.body, 'x' * 2048)
+            response = self.request('GET', '/b/blob')
+        self.assertEqual(response['X-Accel-Redirect'],
+                         '/internal' + os.path.join(server.S3_CACHE_DIR, 'b', 'blob'))
+        self.assertEqual(response.body, '')
+
+
+# Runs in a process of its own, as bridge.green patches the standard library.
+GREEN_CLIENTS = '''
+import base64, httplib, json, sys, tempfile, time
+from bridge import green
+import gevent
+from django.conf import settings
+from s3dav import server
+from s3dav.cache import credentials
+from s3dav.fakes3 import FakeS3Server
+from s3dav.objcache import ObjectCache
+from s3dav.views import credentials_key
+
+fake = FakeS3Server().start()
+fake.s3.latency = 0.2
+for i in range(50):
+    fake.s3.put('b', 'f%d' % i, 'x' * 1024)
+settings.AWS_HOST, settings.AWS_PORT = '127.0.0.1', fake.port
+server.S3_CACHE_DIR = tempfile.mkdtemp()
+server.objects = ObjectCache(server.S3_CACHE_DIR)
+auth = 'Basic ' + base64.b64encode('key:secret')
+credentials.set(credentials_key(auth), ('key', 'secret'))
+dav = green.make_server(('127.0.0.1', 0), log=None)
+dav.start()
+
+def get(i):
+    conn = httplib.HTTPConnection('127.0.0.1', dav.server_port)
+    conn.request('GET', '/b/f%d' % i, headers={'Authorization': auth})
+    response = conn.getresponse()
+    return response.status, len(response.read())
+
+start = time.time()
+results = [g.get() for g in [gevent.spawn(get, i) for i in range(50)]]
+json.dump({'results': results, 'seconds': time.time() - start,
+           'connections': server.connection_pool.stats()['size']}, sys.stdout)
+'''
+
+
+class GreenServerTest(TestCase):
+    @skipIf(gevent is None, 'gevent is not installed')
+    def test_serves_concurrent_clients_from_one_thread(self):
+        cwd = os.path.dirname(os.path.dirname(os.path.abspath(server.__file__)))
+        proc = subprocess.Popen([sys.executable, '-c', GREEN_CLIENTS], cwd=cwd,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        self.assertEqual(proc.returncode, 0, err)
+        out = json.loads(out)
+        self.assertEqual(out['results'], [[200, 1024]] * 50)
+        # Each GET waits on S3 three times, 30 seconds when served one by one.
+        self.assertTrue(out['seconds'] < 5, out['seconds'])
+        self.assertEqual(out['connections'], 1)
@@ -0,0 +1,132 @@
+import threading
+import Queue
+from cStringIO import StringIO
+import boto.s3.multipart
+from django.conf import settings
+
+# Bodies that fit in a single part go up with one plain PUT. S3 requires
+# every part but the last to be at least 5MB.
+S3_MULTIPART_PART_SIZE = getattr(settings, 'S3_MULTIPART_PART_SIZE', 8 * 1024 * 1024)
+S3_MULTIPART_CONCURRENCY = getattr(settings, 'S3_MULTIPART_CONCURRENCY', 4)
+S3_MULTIPART_RETRIES = getattr(settings, 'S3_MULTIPART_RETRIES', 3)
+
+def read_block(stream, size):
+    '''Read size bytes from stream, or fewer only if the stream ends. Request
+    bodies are allowed to return short reads, so keep reading until satisfied.'''
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        data = stream.read(remaining)
+        if not data:
+            break
+        chunks.append(data)
+        remaining -= len(data)
+    return ''.join(chunks)
+
+class TeeReader(object):
+    '''A file-like wrapper that copies everything read from stream into sink.'''
+    def __init__(self, stream, sink):
+        self.stream = stream
+        self.sink = sink
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if data:
+            self.sink.write(data)
+        return data
+
+class MultipartUploader(object):
+    '''Upload a stream to a key, cutting it into parts that are sent on a bounded
+    pool of threads while the rest of the stream is still being read. At most
+    about 2 * concurrency parts are held in memory at once.
+
+    connect, if given, is called once per worker thread to get a connection of
+    its own, since boto connections must not be shared between threads.'''
+    def __init__(self, key, connect=None, part_size=S3_MULTIPART_PART_SIZE,
+                 concurrency=S3_MULTIPART_CONCURRENCY, retries=S3_MULTIPART_RETRIES):
+        self.key = key
+        self.connect = connect
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.retries = retries
+
+    def upload(self, stream):
+        '''Send the whole stream and return the number of bytes uploaded. The key's
+        size and etag are updated to those of the stored object.'''
+        first = read_block(stream, self.part_size)
+        second = ''
+        if len(first) == self.part_size:
+            second = read_block(stream, self.part_size)
+        if not second:
+            self.key.set_contents_from_string(first)
+            self.key.size = len(first)
+            return self.key.size
+
+        mp = self.key.bucket.initiate_multipart_upload(self.key.name)
+        try:
+            return self._upload_parts(mp, stream, first, second)
+        except:
+            mp.cancel_upload()
+            raise
+
+    def _part_upload(self, mp):
+        '''Return a MultiPartUpload handle usable from the calling thread.'''
+        if self.connect is None:
+            return mp
+        bucket = self.connect().get_bucket(mp.bucket.name, validate=False)
+        handle = boto.s3.multipart.MultiPartUpload(bucket)
+        handle.key_name = mp.key_name
+        handle.id = mp.id
+        return handle
+
+    def _upload_parts(self, mp, stream, first, second):
+        parts = Queue.Queue(self.concurrency)
+        errors = []
+
+        def worker():
+            try:
+                handle = self._part_upload(mp)
+            except Exception, e:
+                errors.append(e)
+                handle = None
+            while True:
+                item = parts.get()
+                if item is None:
+                    return
+                if errors:
+                    # Keep draining so the producer never blocks on a full queue.
+                    continue
+                part_num, data = item
+                for attempt in range(self.retries):
+                    try:
+                        handle.upload_part_from_file(StringIO(data), part_num)
+                        break
+                    except Exception, e:
+                        if attempt == self.retries - 1:
+                            errors.append(e)
+
+        workers = [threading.Thread(target=worker) for i in range(self.concurrency)]
+        for t in workers:
+            t.daemon = True
+            t.start()
+
+        size = 0
+        try:
+            part_num = 1
+            parts.put((part_num, first))
+            data = second
+            while data and not errors:
+                part_num += 1
+                parts.put((part_num, data))
+                size += len(data)
+                data = read_block(stream, self.part_size)
+        finally:
+            for t in workers:
+                parts.put(None)
+            for t in workers:
+                t.join()
+        if errors:
+            raise errors[0]
+        self.key.etag = mp.complete_upload().etag
+        self.key.size = len(first) + size
+        return self.key.size
@@ -1,11 +1,20 @@
 import base64
-import re
+import hashlib
+import hmac
+from django.conf import settings
 from django.http import HttpResponse, Http404
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.models import User
 
+from s3dav import metrics
 from s3dav.django_webdav import DavServer
 from s3dav.server import S3DavServer
 from s3dav.models import S3Account
+from s3dav.cache import credentials, is_junk, metadata
+
+# Reads of junk names (see s3dav.cache.is_junk) S3 recently said do not exist
+# are answered 404 without authenticating.
+S3_JUNK_METHODS = getattr(settings, 'S3_JUNK_METHODS', ('GET', 'HEAD', 'OPTIONS', 'PROPFIND'))
 
 def notfound(request, **kw):
     raise Http404
@@ -23,7 +32,35 @@ def log_error(func):
 @log_error
 def webdav_export(request, path, server_class=DavServer):
     '''Default Django-WebDAV view.'''
-    return server_class(request, path).get_response()
+    stats = request.dav_stats = metrics.RequestStats(
+        request.method, request.path, request.META.get('HTTP_DEPTH'))
+    metrics.activate(stats)
+    try:
+        response = server_class(request, path).get_response()
+    except Exception, e:
+        metrics.finish(stats, 500, repr(e))
+        raise
+    finally:
+        metrics.deactivate()
+    # Local files may be sent by wsgi.file_wrapper, bypassing streaming_content,
+    # and cost no S3 requests while they are.
+    if response.streaming and getattr(response, 'file_to_stream', None) is None:
+        response.streaming_content = metrics.finish_streaming(
+            stats, response, response.streaming_content)
+    else:
+        metrics.finish(stats, response.status_code)
+    return response
+
+@staff_member_required
+def export_metrics(request):
+    '''Request and S3 counters in the Prometheus text format.'''
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4')
+
+def credentials_key(auth):
+    '''Checking the password is deliberately slow, so simple_auth remembers what
+    an Authorization header resolved to. Only a keyed digest of the header is
+    kept as cache key.'''
+    return hmac.new(settings.SECRET_KEY, auth, hashlib.sha256).hexdigest()
 
 def simple_auth(request):
     username = None
@@ -31,6 +68,11 @@ def simple_auth(request):
     
     auth = request.META.get('HTTP_AUTHORIZATION')
     if auth:
+        digest = credentials_key(auth)
+        cached = credentials.get(digest)
+        if cached is not None:
+            request.aws_key, request.aws_secret = cached
+            return
         auth = auth.split()
         if len(auth) == 2 and auth[0].lower() == 'basic':
             username, password = base64.b64decode(auth[1]).split(':')
@@ -52,12 +94,13 @@ def simple_auth(request):
             aws_secret = account.aws_secret
         except S3Account.DoesNotExist:
             pass
+    credentials.set(digest, (aws_key, aws_secret))
     request.aws_key = aws_key
     request.aws_secret = aws_secret
     
 @log_error
 def export(request, bucket=None, key=None):
-    if re.search(r'\._[^/]+$', key) and (request.method in ('OPTIONS', 'PROPFIND')):
+    if request.method in S3_JUNK_METHODS and is_junk(key) and metadata.is_missing(bucket, key):
         raise Http404
     simple_auth(request)
     if (not getattr(request, 'aws_key', None) or 
@@ -0,0 +1,348 @@
+'''
+A durable journal of uploads that have been acknowledged to the client but not
+yet stored in S3.
+
+Each pending upload is a pair of files in the journal directory: the body,
+<name>.data, and a JSON record, <name>.json, naming the bucket, key and
+credentials. Both are fsynced before the upload is acknowledged, and the record
+is only renamed into place once complete, so after a crash every record found
+describes a whole body. The record is removed once the upload has succeeded.
+
+Background workers drain the journal. Only the newest version of a path is
+uploaded, and never two versions of a path at the same time, so S3 ends up
+with the last one written. Failed uploads are retried with exponential backoff,
+including those refused for credentials that may yet be fixed. Those S3 refuses
+for good are logged, counted and renamed to <name>.failed for inspection.
+
+The journal belongs to one process, as do the pending versions only it can
+serve; it is locked against others.
+'''
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+import uuid
+import Queue
+from boto.exception import S3ResponseError
+from django.core.exceptions import ImproperlyConfigured
+from s3dav import metrics
+from s3dav.django_webdav import BLOCK_SIZE
+
+logger = logging.getLogger('s3dav.writeback')
+
+MAX_RETRY_DELAY = 300
+# Client errors that do not mean the upload can never succeed: timeouts,
+# throttling, and credentials or permissions that may be rotated or fixed.
+RETRY_STATUS = (403, 408, 409, 429)
+RETRY_ERROR_CODES = ('RequestTimeout', 'RequestTimeTooSkewed', 'ExpiredToken', 'TokenRefreshRequired',
+                     'InvalidAccessKeyId', 'SignatureDoesNotMatch', 'SlowDown', 'OperationAborted')
+
+def is_permanent(e):
+    '''Return True if S3 refused an upload for good.'''
+    return (isinstance(e, S3ResponseError) and 400 <= e.status < 500 and
+            e.status not in RETRY_STATUS and e.error_code not in RETRY_ERROR_CODES)
+
+class PendingUpload(object):
+    def __init__(self, root, name, bucket, key, aws_key, aws_secret, size, etag, mtime):
+        self.root = root
+        self.name = name
+        self.bucket = bucket
+        self.key = key
+        self.aws_key = aws_key
+        self.aws_secret = aws_secret
+        self.size = size
+        self.etag = etag
+        self.mtime = mtime
+        self.attempts = 0
+
+    @property
+    def seq(self):
+        return int(self.name.split('-')[0])
+
+    @property
+    def path(self):
+        '''The body of the upload.'''
+        return os.path.join(self.root, self.name + '.data')
+
+    @property
+    def record_path(self):
+        return os.path.join(self.root, self.name + '.json')
+
+    def as_dict(self):
+        return dict((attr, getattr(self, attr)) for attr in
+                    ('name', 'bucket', 'key', 'aws_key', 'aws_secret', 'size', 'etag', 'mtime'))
+
+    def remove(self):
+        for path in (self.record_path, self.path):
+            try:
+                os.remove(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+def write_synced(path, chunks):
+    '''Write chunks to a new file only the owner can read, and fsync it.'''
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+    with os.fdopen(fd, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class WriteBackJournal(object):
+    '''Pending uploads by (bucket, key). upload(entry) stores an entry in S3 and
+    returns its key; uploaded(entry, key) is then called if no newer version of
+    the path has come in meanwhile, before the entry leaves the journal.'''
+    def __init__(self, root, upload, uploaded=None, workers=4, retry_delay=1):
+        self.root = root
+        self.upload = upload
+        self.uploaded = uploaded
+        self.workers = workers
+        self.retry_delay = retry_delay
+        self._pending = {}
+        self._inflight = set()
+        self._queued = set()
+        self._queue = Queue.Queue()
+        self._cond = threading.Condition()
+        self._last_seq = 0
+        self._lock_file = None
+        self._threads = []
+        self._stopped = False
+
+    def start(self):
+        '''Lock the journal, pick up what an earlier process left in it and start
+        the workers.'''
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root, 0700)
+        self._lock_file = open(os.path.join(self.root, '.lock'), 'a')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            raise ImproperlyConfigured('write-back journal %s is in use by another process'
+                                       % self.root)
+        self._recover()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def stop(self):
+        '''Stop the workers once they are done with the upload at hand and unlock
+        the journal. What is still pending is picked up by the next start().'''
+        self._stopped = True
+        for t in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _recover(self):
+        newest = {}
+        records = set()
+        for filename in os.listdir(self.root):
+            base, ext = os.path.splitext(filename)
+            if ext == '.failed':
+                records.add(base)
+            elif ext == '.json':
+                records.add(base)
+                try:
+                    with open(os.path.join(self.root, filename)) as f:
+                        entry = PendingUpload(self.root, **json.load(f))
+                except (IOError, ValueError, TypeError):
+                    traceback.print_exc()
+                    continue
+                try:
+                    complete = os.path.getsize(entry.path) == entry.size
+                except OSError:
+                    complete = False
+                if not complete:
+                    # Its body went to the cache after the upload succeeded.
+                    entry.remove()
+                    continue
+                # Later versions win.
+                older = newest.get((entry.bucket, entry.key))
+                if older is not None and older.seq > entry.seq:
+                    older, entry = entry, older
+                if older is not None:
+                    older.remove()
+                newest[(entry.bucket, entry.key)] = entry
+                self._last_seq = max(self._last_seq, entry.seq)
+        for filename in os.listdir(self.root):
+            base, ext = os.path.splitext(filename)
+            if ext == '.tmp' or (ext == '.data' and base not in records):
+                # Left by a write that was never acknowledged.
+                os.remove(os.path.join(self.root, filename))
+        for path, entry in newest.iteritems():
+            self._pending[path] = entry
+            self._enqueue(path)
+
+    def _next_name(self):
+        with self._cond:
+            self._last_seq = max(self._last_seq + 1, int(time.time() * 1000000))
+            return '%d-%s' % (self._last_seq, uuid.uuid4().hex)
+
+    def add(self, bucket_name, key_name, aws_key, aws_secret, stream):
+        '''Journal the body read from stream as the new content of key_name and
+        return the entry once it is on disk.'''
+        name = self._next_name()
+        md5 = hashlib.md5()
+        sizes = []
+        def chunks():
+            while True:
+                data = stream.read(BLOCK_SIZE)
+                if not data:
+                    break
+                md5.update(data)
+                sizes.append(len(data))
+                yield data
+        entry = PendingUpload(self.root, name, bucket_name, key_name, aws_key, aws_secret,
+                              0, None, time.time())
+        try:
+            write_synced(entry.path, chunks())
+            entry.size = sum(sizes)
+            entry.etag = '"%s"' % md5.hexdigest()
+            tmp_path = entry.record_path + '.tmp'
+            write_synced(tmp_path, [json.dumps(entry.as_dict())])
+            os.rename(tmp_path, entry.record_path)
+            fsync_dir(self.root)
+        except:
+            entry.remove()
+            raise
+        path = (bucket_name, key_name)
+        with self._cond:
+            older = self._pending.get(path)
+            self._pending[path] = entry
+            if path not in self._inflight:
+                if older is not None:
+                    older.remove()
+                self._enqueue(path)
+        return entry
+
+    def get(self, bucket_name, key_name):
+        '''Return the pending version of key_name, if any.'''
+        with self._cond:
+            return self._pending.get((bucket_name, key_name))
+
+    def children(self, bucket_name, prefix):
+        '''Return key name -> pending version for the files directly in prefix.'''
+        with self._cond:
+            return dict((key, entry) for (bucket, key), entry in self._pending.iteritems()
+                        if bucket == bucket_name and key.startswith(prefix)
+                        and '/' not in key[len(prefix):])
+
+    def settle(self, bucket_name, key_name, discard=False, timeout=None):
+        '''Wait until nothing is pending at key_name or below it. With discard, versions
+        that are not being uploaded right now are dropped instead. Returns False if
+        uploads were still pending after timeout seconds.'''
+        below = key_name.rstrip('/') + '/'
+        def matching():
+            return [path for path in self._pending if path[0] == bucket_name and
+                    (not key_name or path[1] == key_name or path[1].startswith(below))]
+        deadline = timeout is not None and time.time() + timeout
+        with self._cond:
+            while True:
+                paths = matching()
+                if discard:
+                    for path in paths:
+                        if path not in self._inflight:
+                            self._pending.pop(path).remove()
+                    paths = matching()
+                if not paths:
+                    return True
+                remaining = deadline and deadline - time.time()
+                if deadline and remaining <= 0:
+                    return False
+                self._cond.wait(remaining or 1)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'pending': len(self._pending),
+                'pending_bytes': sum(entry.size for entry in self._pending.itervalues()),
+                'uploading': len(self._inflight),
+            }
+
+    def _enqueue(self, path):
+        with self._cond:
+            if path in self._queued or path in self._inflight or path not in self._pending:
+                return
+            self._queued.add(path)
+        self._queue.put(path)
+
+    def _work(self):
+        while True:
+            path = self._queue.get()
+            if self._stopped:
+                return
+            with self._cond:
+                self._queued.discard(path)
+                entry = self._pending.get(path)
+                if entry is None or path in self._inflight:
+                    continue
+                self._inflight.add(path)
+            try:
+                key = self.upload(entry)
+            except Exception, e:
+                traceback.print_exc()
+                self._failed(path, entry, e)
+            else:
+                self._succeeded(path, entry, key)
+
+    def _succeeded(self, path, entry, key):
+        with self._cond:
+            current = self._pending.get(path) is entry
+        try:
+            if current and self.uploaded is not None:
+                self.uploaded(entry, key)
+        except Exception:
+            traceback.print_exc()
+        entry.remove()
+        with self._cond:
+            self._inflight.discard(path)
+            if self._pending.get(path) is entry:
+                del self._pending[path]
+            self._cond.notify_all()
+        # A newer version came in while this one was on its way.
+        self._enqueue(path)
+
+    def _failed(self, path, entry, e):
+        entry.attempts += 1
+        permanent = is_permanent(e)
+        with self._cond:
+            self._inflight.discard(path)
+            current = self._pending.get(path) is entry
+            if current and permanent:
+                del self._pending[path]
+            self._cond.notify_all()
+        if not current:
+            entry.remove()
+            self._enqueue(path)
+        elif permanent:
+            failed_path = os.path.join(self.root, entry.name + '.failed')
+            os.rename(entry.record_path, failed_path)
+            metrics.write_back_failures_total.inc((entry.bucket,))
+            logger.error('Gave up uploading %s/%s after S3 refused it with %s %s; '
+                         'its body is kept with %s', entry.bucket, entry.key,
+                         e.status, e.error_code or e.reason, failed_path)
+        else:
+            delay = min(self.retry_delay * 2 ** (entry.attempts - 1), MAX_RETRY_DELAY)
+            timer = threading.Timer(delay, self._enqueue, [path])
+            timer.daemon = True
+            timer.start()